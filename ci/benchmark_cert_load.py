@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time Cert.load for 1,000 certificates using the Jinja2 templates and the structured builder.
+
+    python ci/benchmark_cert_load.py [count]
+"""
+from __future__ import print_function
+
+import sys
+import timeit
+from os.path import abspath
+from os.path import dirname
+from os.path import join
+
+base_path = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(base_path, "src"))
+
+from loguru import logger  # noqa: E402
+
+from knox.certificate import Cert  # noqa: E402
+
+
+class Settings(dict):
+    def get(self, key, default=None):
+        return super().get(key, default)
+
+
+def load(settings):
+    cert = Cert(settings, common_name="www.company.com")
+    cert.load(pub=join(base_path, "examples", "cert-pub.pem"),
+              key=join(base_path, "examples", "cert-key.pem"),
+              certtype="PEM")
+    return cert
+
+
+def main(count=1000):
+    logger.remove()
+    templates = Settings(KNOX_VAULT_MOUNT="certificate", CERT_TEMPLATES=True)
+    structured = Settings(KNOX_VAULT_MOUNT="certificate")
+    assert load(templates).data == load(structured).data, "builders disagree"
+    for name, settings in (("templates", templates), ("structured", structured)):
+        seconds = min(timeit.repeat(lambda: load(settings), number=count, repeat=3))
+        print("{0:>10}: {1:.3f}s per {2} certs".format(name, seconds, count))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
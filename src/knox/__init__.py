@@ -1,3 +1,17 @@
 __version__ = '0.1.11'
+import importlib
+import sys
+
 from . import cli  # noqa: F401
-from .knox import Knox  # noqa: F401
+
+
+def __getattr__(name: str):
+    """Knox loads the configuration and store engines, import it on first use"""
+    if name == 'Knox':
+        return importlib.import_module('.knox', __name__).Knox
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+if sys.version_info < (3, 7):
+    """Module __getattr__ (PEP 562) is not available, import it up front"""
+    Knox = __getattr__('Knox')
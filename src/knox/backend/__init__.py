@@ -14,10 +14,43 @@ distributed under the License is distributed on an "AS IS" BASIS,
 WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License."""
-from .store import Store  # noqa: F401
-from .store_acm import ACMStoreEngine  # noqa: F401
-from .store_engine import StoreEngine  # noqa: F401
-from .store_file import FileStoreEngine  # noqa: F401
-from .store_object import StoreObject  # noqa: F401
-from .store_vault import VaultClient  # noqa: F401
-from .store_vault import VaultStoreEngine  # noqa: F401
+import importlib
+import sys
+
+_exports = {
+    'Store': '.store',
+    'ACMStoreEngine': '.store_acm',
+    'AsyncStoreEngine': '.store_async',
+    'AsyncVaultStoreEngine': '.store_vault_async',
+    'StoreCache': '.store_cache',
+    'StoreEngine': '.store_engine',
+    'FileStoreEngine': '.store_file',
+    'SanIndex': '.store_index',
+    'StoreIndex': '.store_index',
+    'StoreObject': '.store_object',
+    'PackedLog': '.store_packed',
+    'VaultClient': '.store_vault',
+    'VaultStoreEngine': '.store_vault',
+}
+__all__ = list(_exports)
+
+
+def __getattr__(name: str):
+    """Import engines on first use, so loading knox does not pull in every SDK (boto3, hvac)"""
+    if name in _exports:
+        return getattr(importlib.import_module(_exports[name], __name__), name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
+
+
+if sys.version_info < (3, 7):
+    """Module __getattr__ (PEP 562) is not available, import everything up front"""
+    for _name in __all__:
+        try:
+            globals()[_name] = __getattr__(_name)
+        except ImportError:
+            """Optional dependency not installed, i.e. aiohttp for AsyncVaultStoreEngine"""
+            pass
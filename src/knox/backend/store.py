@@ -14,13 +14,17 @@ distributed under the License is distributed on an "AS IS" BASIS,
 WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License."""
+import asyncio
+import importlib
+import inspect
+import sys
+import threading
+
 from loguru import logger
 
-from .store_acm import ACMStoreEngine
+from .store_async import AsyncStoreEngine
 from .store_engine import StoreEngine
-from .store_file import FileStoreEngine
 from .store_object import StoreObject
-from .store_vault import VaultStoreEngine
 
 
 class Store:
@@ -28,10 +32,13 @@ class Store:
     _engine: StoreEngine
     _engine_name: str
     _engine_map = {
-        'vault': VaultStoreEngine,
-        'file': FileStoreEngine,
-        'aws': ACMStoreEngine
+        'vault': ('.store_vault', 'VaultStoreEngine'),
+        'file': ('.store_file', 'FileStoreEngine'),
+        'aws': ('.store_acm', 'ACMStoreEngine'),
+        'vault-async': ('.store_vault_async', 'AsyncVaultStoreEngine')
     }
+    _loop: asyncio.AbstractEventLoop  #: Runs the coroutines of asynchronous engines, None for blocking engines
+    _thread: threading.Thread         #: Thread running _loop
 
     def __init__(self, settings, engine_name: str = None) -> None:
         """Dynamically load StoreEngine type from .env via Dynaconf
@@ -44,35 +51,122 @@ class Store:
         """
         try:
             self._engine_name = engine_name if engine_name is not None else settings.STORE_ENGINE
-            self._engine = self._engine_map.get(self._engine_name).__call__(settings)
+            self._engine = self.engine_class(self._engine_name)(settings)
         except Exception:
             logger.error(
                 f'StoreEngineFailure KNOX_STORE_ENGINE={self._engine_name} is invalid. Valid options are {self._engine_map.keys()}')  # noqa: E501
             raise
 
         self._engine.settings = settings
+        self._loop = None
+        self._thread = None
+        self._closed = False
+        if isinstance(self._engine, AsyncStoreEngine):
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self._loop.run_forever, name='knox-store-loop', daemon=True)
+            self._thread.start()
         logger.debug(f'Loaded {self._engine.__class__}')
 
-    def save(self, obj: StoreObject) -> bool:
-        """Save the given object to persistence"""
-        return self._engine.write(obj)
+    @classmethod
+    def engine_class(cls, engine_name: str) -> type:
+        """Resolve a StoreEngine class by name, importing its module, and SDK, only when it is used
+
+            :param engine_name: Key of _engine_map
+            :type engine_name: str
+            :return: StoreEngine subclass
+        """
+        module, name = cls._engine_map[engine_name]
+        return getattr(importlib.import_module(module, __package__), name)
+
+    @property
+    def engine(self) -> StoreEngine:
+        """The engine behind this store, await its methods directly when it is an AsyncStoreEngine"""
+        return self._engine
+
+    def save(self, obj: StoreObject, force: bool = False) -> bool:
+        """Save the given object to persistence, unchanged objects are only written again when forced"""
+        return self._wait(self._engine.write(obj, force=force))
 
     def get(self, path: str, name: str, type=None) -> StoreObject:
         """Given path read object"""
-        return self._engine.read(path, name, type)
+        return self._wait(self._engine.read(path, name, type))
+
+    def get_many(self, items) -> list:
+        """Given (path, name, type) for each object read them all, None where an object could not be read"""
+        return self._wait(self._engine.read_many(list(items)))
 
     def delete(self, path: str, name: str) -> bool:
         """Remove the object from the store"""
         """[TODO 5/13/20] ljohnson implement soft delete and hard deletes"""
-        return self._engine.delete(path, name)
+        return self._wait(self._engine.delete(path, name))
 
-    def find(self, pattern: str) -> list:
+    def find(self, pattern: str, live: bool = False) -> list:
         """Given a pattern, return collection of all objects
            Search patterns : abc.8x8.com, abc.8x8.com/*, 8x8.com/*
+           Set live to bypass the local index, if the engine keeps one
+        """
+        return self._wait(self._engine.find(pattern, live=live))
+
+    def iterfind(self, pattern: str, live: bool = False):
+        """Same as find, yielding objects as the engine discovers them so callers can stop early
         """
-        return self._engine.find(pattern)
+        results = self._engine.iterfind(pattern, live=live)
+        if inspect.isasyncgen(results):
+            return self._iterate(results)
+        return results
 
-    def subjectaltfind(self, pattern: str) -> list:
+    def subjectaltfind(self, pattern: str, live: bool = False) -> list:
         """Fetch the certificate information based on subject alternative name
         """
-        return self._engine.subjectaltfind(pattern)
+        return self._wait(self._engine.subjectaltfind(pattern, live=live))
+
+    def expiring(self, days: int, live: bool = False) -> list:
+        """Search results of the certificates expiring within the given number of days, soonest first
+        """
+        return self._wait(self._engine.expiring(days, live=live))
+
+    def close(self) -> None:
+        """Close the engine, and stop the event loop of an asynchronous engine. Closing again does nothing."""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._wait(self._engine.close())
+        finally:
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._thread.join()
+                self._loop.close()
+                self._loop = None
+
+    def _wait(self, result):
+        """Blocking engines return their result, coroutines of asynchronous engines are run to completion on the
+        store's event loop. The loop runs in its own thread so any thread, i.e. knox serve handlers, may wait on it.
+        Failures exit like they do with the blocking engines, the engine has logged them.
+        """
+        if not inspect.isawaitable(result):
+            return result
+        if not asyncio.iscoroutine(result):
+            result = self._await(result)
+        try:
+            return asyncio.run_coroutine_threadsafe(result, self._loop).result()
+        except StopAsyncIteration:
+            raise
+        except Exception as err:
+            logger.debug(f'{self._engine.__class__.__name__} failed: {err!r}')
+            sys.exit(2)
+
+    @staticmethod
+    async def _await(awaitable):
+        return await awaitable
+
+    def _iterate(self, results):
+        """Blocking generator over an asynchronous one, closing it closes the engine's generator"""
+        try:
+            while True:
+                try:
+                    yield self._wait(results.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            self._wait(results.aclose())
@@ -17,27 +17,147 @@ limitations under the License.
 """
 import ast
 import sys
+import threading
+import time
+from binascii import hexlify
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from datetime import timezone
+from fnmatch import fnmatch
 
 import boto3
+from botocore.exceptions import BotoCoreError
 from botocore.exceptions import ClientError
-from botocore.exceptions import EndpointConnectionError
+from botocore.exceptions import ProfileNotFound
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
 from dynaconf import LazySettings
-from jinja2 import Environment
-from jinja2 import FileSystemLoader
 from loguru import logger
 
+from ..config import Templates
 from .store_engine import StoreEngine
+from .store_index import SanIndex
 from .store_object import StoreObject
 
 
+class ACMIndex:
+    """Certificate summaries of one region, with a domain and subject alternative name lookup to their ARNs"""
+    summaries: dict       #: ARN -> certificate summary from list_certificates
+    names: SanIndex       #: DomainName and SANs -> ARNs
+    built: float          #: time.monotonic() of the listing
+
+    def __init__(self, summaries: list) -> None:
+        """Constructor for ACMIndex
+
+            :param summaries: CertificateSummaryList entries of every page
+            :type summaries: list
+        """
+        self.summaries = {}
+        self.names = SanIndex()
+        self.built = time.monotonic()
+        for summary in summaries:
+            arn = summary['CertificateArn']
+            self.summaries[arn] = summary
+            self.names.add(arn, {'subject': {'alternativeNames': self.alt_names(summary)}})
+
+    @staticmethod
+    def alt_names(summary: dict) -> list:
+        return [summary['DomainName']] + list(summary.get('SubjectAlternativeNameSummaries', []))
+
+    def age(self) -> float:
+        return time.monotonic() - self.built
+
+    def named(self, name: str) -> list:
+        """Summaries whose DomainName is name, most recently expiring first"""
+        return sorted([summary for summary in self.summaries.values() if summary['DomainName'] == name],
+                      key=lambda summary: str(summary.get('NotAfter', '')), reverse=True)
+
+    def covering(self, name: str) -> list:
+        """Summaries whose DomainName or SANs cover name, wildcards included"""
+        return [self.summaries[arn] for arn in self.names.lookup(name)]
+
+
+class ACMTarget:
+    """One AWS account and region certificates are imported to, with its own session, acm client and index"""
+    profile_name: str     #: AWS profile, None for the default credentials
+    region: str           #: AWS region
+    endpoint_url: str     #: ACM endpoint, i.e. a local moto server, None for AWS
+    index_ttl: float      #: Seconds a listing of the region is reused
+
+    __key_types = ['RSA_1024', 'RSA_2048', 'RSA_3072', 'RSA_4096', 'EC_prime256v1', 'EC_secp384r1', 'EC_secp521r1']
+
+    def __init__(self, profile_name: str, region: str, endpoint_url: str = None, index_ttl: float = 300) -> None:
+        """Constructor for ACMTarget
+
+            :param profile_name: AWS profile
+            :type profile_name: str
+            :param region: AWS region
+            :type region: str
+            :param endpoint_url: ACM endpoint, None for AWS
+            :type endpoint_url: str
+            :param index_ttl: Seconds a listing of the region is reused
+            :type index_ttl: float
+        """
+        self.profile_name = profile_name
+        self.region = region
+        self.endpoint_url = endpoint_url
+        self.index_ttl = index_ttl
+        self.__session = None
+        self.__acm = None
+        self.__index = None
+        self.__lock = threading.Lock()
+
+    def __str__(self) -> str:
+        return f'{self.profile_name or "default"}:{self.region}'
+
+    @property
+    def session(self) -> boto3.session.Session:
+        """The boto3 session of the profile, raises ProfileNotFound when the profile is not configured"""
+        if self.__session is None:
+            self.__session = boto3.Session(profile_name=self.profile_name, region_name=self.region)
+        return self.__session
+
+    @property
+    def acm(self):
+        """The acm client of the target, created once and reused by every operation"""
+        with self.__lock:
+            if self.__acm is None:
+                self.__acm = self.session.client('acm', endpoint_url=self.endpoint_url)
+            return self.__acm
+
+    def index(self, refresh: bool = False) -> ACMIndex:
+        """Summaries of every certificate in the region, listed page by page and kept for index_ttl seconds
+
+            :param refresh: List again regardless of the age of the index
+            :type refresh: bool
+            :return: ACMIndex
+        """
+        acm = self.acm
+        with self.__lock:
+            if self.__index is None or refresh or self.__index.age() > self.index_ttl:
+                summaries = []
+                for page in acm.get_paginator('list_certificates').paginate(Includes={'keyTypes': self.__key_types}):
+                    summaries.extend(page.get('CertificateSummaryList', []))
+                self.__index = ACMIndex(summaries)
+                logger.debug(f'Listed {len(summaries)} ACM certificates in {self}')
+            return self.__index
+
+    def invalidate(self) -> None:
+        """Forget the listing, the next lookup lists the region again"""
+        with self.__lock:
+            self.__index = None
+
+
 class ACMStoreEngine(StoreEngine):
     """
     ACMStoreEngine Class
-    CRUD operations for Aws Certificate Manager
+    CRUD operations for Aws Certificate Manager, fanned out concurrently to every configured account and region
     """
 
-    __AwsErrors = (ClientError, EndpointConnectionError)
-    __session: boto3.session.Session
+    __AwsErrors = (ClientError, BotoCoreError)
+    targets: list         #: ACMTarget for each KNOX_AWS_TARGETS entry
+    results: list         #: Outcome of the last write on each target
 
     def __init__(self, settings: LazySettings = None):
         super().__init__()
@@ -45,92 +165,238 @@ class ACMStoreEngine(StoreEngine):
         self.region = settings.AWS_REGION
         self.CertArn = None
         self.__path = None
-        self._jinja = Environment(loader=FileSystemLoader('templates'))
-        self._tmpl_tags = self._jinja.get_template('tags_template.js')
+        self.targets = [ACMTarget(profile, region, settings.get('AWS_ENDPOINT_URL'), float(settings.get('AWS_INDEX_TTL', 300)))
+                        for profile, region in self.parse_targets(settings.get('AWS_TARGETS'), self.profile_name, self.region)]
+        self.results = []
+        self.__workers = int(settings.get('AWS_WORKERS', 16))
+        self._tmpl_tags = Templates.get('tags_template.js', settings)
         if self.initialize():
-            logger.debug('Connected to ACM')
+            logger.debug(f'Connected to ACM {", ".join(map(str, self.targets))}')
         else:
-            logger.error('No AWS profiles found')
+            logger.error('AWS profiles not found')
             sys.exit(1)
 
+    @staticmethod
+    def parse_targets(targets, profile_name: str, region: str) -> list:
+        """The (profile, region) pairs of KNOX_AWS_TARGETS, profile:region entries in a list or a comma separated
+        string. Entries without a profile use profile_name, without any entry profile_name:region is the only target.
+
+            :param targets: KNOX_AWS_TARGETS
+            :type targets: list or str
+            :param profile_name: Default AWS profile
+            :type profile_name: str
+            :param region: Default AWS region
+            :type region: str
+            :return: list of tuple
+        """
+        if isinstance(targets, str):
+            targets = targets.replace(' ', ',').split(',')
+        pairs = []
+        for target in targets or []:
+            if target:
+                profile, _, target_region = target.rpartition(':')
+                pair = (profile or profile_name, target_region or region)
+                if pair not in pairs:
+                    pairs.append(pair)
+        return pairs or [(profile_name, region)]
+
     def initialize(self) -> bool:
-        self.__session = boto3.Session(profile_name=self.profile_name, region_name=self.region)
-        return len(self.__session.available_profiles) > 0
+        available = True
+        for target in self.targets:
+            try:
+                target.session
+            except ProfileNotFound as e:
+                logger.error(f'[ACMStoreEngine]: {target} {e}')
+                available = False
+        return available
 
-    def find(self, pattern: str) -> [StoreObject]:
-        certs = []
-        try:
-            acm_res = self.__session.client('acm').list_certificates(
-                CertificateStatuses=['ISSUED'],
-                MaxItems=123
-            )
-            acm_certs = acm_res.get('CertificateSummaryList')
-            for acm in acm_certs:
-                domainname = acm['DomainName']
-                arn = acm['CertificateArn']
-                if domainname == pattern:
-                    certs.append(self.get(name=domainname, arn=arn))
+    def fanout(self, method, *args) -> list:
+        """Call method(target, *args) for every target concurrently. An AWS error on one target does not stop the others.
 
-        except self.__AwsErrors as e:
-            logger.error(f'[AWSCert]: Exception listing certificates from ACM {e}')
-            sys.exit(1)
+            :param method: Called with the ACMTarget and args
+            :type method: callable
+            :return: list of (target, result, error) in the order of the targets, error is None on success
+        """
+        def attempt(target):
+            try:
+                return target, method(target, *args), None
+            except self.__AwsErrors as e:
+                logger.error(f'[ACMStoreEngine]: {target} {e}')
+                return target, None, e
+
+        if len(self.targets) == 1:
+            return [attempt(self.targets[0])]
+        with ThreadPoolExecutor(max_workers=min(self.__workers, len(self.targets)), thread_name_prefix='knox-acm') as pool:
+            return list(pool.map(attempt, self.targets))
+
+    def find(self, pattern: str, live: bool = False) -> list:
+        """Certificates whose domain or alternative names match pattern in every target, answered from the cached listings.
+        Targets that cannot be listed are logged and left out.
+
+            :param pattern: Domain name, i.e. www.example.com also finds *.example.com, or a glob i.e. *.example.com
+            :type pattern: str
+            :param live: List the regions again instead of using the cached listings
+            :type live: bool
+            :return: list of dict
+        """
+        pattern = pattern.replace('wildcard', '*', 1)
+        name = pattern[2:] if pattern.startswith('*.') else pattern
+        if pattern == '*':
+            match = lambda index: list(index.summaries.values())  # noqa: E731
+        elif any(char in name for char in '*?['):
+            match = lambda index: [summary for summary in index.summaries.values()  # noqa: E731
+                                   if any(fnmatch(alt, pattern) for alt in ACMIndex.alt_names(summary))]
         else:
-            return certs
+            match = lambda index: index.covering(pattern)  # noqa: E731
 
-    def get(self, name: str, arn: str) -> StoreObject:
+        results = []
+        for target, summaries, error in self.fanout(lambda target: match(target.index(refresh=live))):
+            results += [self.search_result(target, summary) for summary in summaries or []]
+        return results
+
+    def subjectaltfind(self, pattern: str, live: bool = False) -> list:
+        """Certificates whose alternative names cover pattern"""
+        return self.find(pattern, live=live)
+
+    @staticmethod
+    def search_result(target: ACMTarget, summary: dict) -> dict:
+        """Find result of a certificate summary, shaped like the results of the other engines"""
+        not_before, not_after = summary.get('NotBefore'), summary.get('NotAfter')
+        return {'common_name': summary['DomainName'],
+                'acm_cert_arn': summary['CertificateArn'],
+                'profile': target.profile_name,
+                'region': target.region,
+                'status': summary.get('Status', ''),
+                'cert_issue_date': f'{not_before:%Y-%m-%d %H:%M:%S}' if not_before else '',
+                'cert_expiry_date': f'{not_after:%Y-%m-%d %H:%M:%S}' if not_after else '',
+                'days_to_expire': (not_after - datetime.now(timezone.utc)).days if not_after else '',
+                'alternativeNames': summary.get('SubjectAlternativeNameSummaries', [])}
+
+    def get(self, name: str, arn: str, path: str = None, type=None, target: ACMTarget = None) -> StoreObject:
+        target = target or self.targets[0]
         try:
-            acm_res = self.__session.client('acm').get_certificate(
+            acm_res = target.acm.get_certificate(
                 CertificateArn=arn
             )
-            cert = StoreObject(name=name)
-            cert.public = acm_res.get('Certificate')
-            if hasattr(acm_res, 'CertificateChain'):
-                cert.chain = acm_res.get('CertificateChain')
+            body = {'public': acm_res.get('Certificate'), 'chain': acm_res.get('CertificateChain', '')}
+            cert = StoreObject(name=name, path=path, body=body, info={'arn': arn}, type=type)
+            cert._data = {'cert_body': body, 'cert_info': cert.info}
 
         except self.__AwsErrors as e:
-            logger.error(f'[AWSCert]: Exception listing certificates from ACM {e}')
+            logger.error(f'[AWSCert]: Exception getting certificate {arn} from ACM {e}')
             sys.exit(1)
         return cert
 
-    def read(self, name: str, path: str = None, type=None) -> StoreObject:
-        certs = self.find(name)
-        for cert in certs:
-            if cert.name == name:
-                return cert
+    def read(self, path: str, name: str, type=None) -> StoreObject:
+        """The certificate imported for name in the first target holding one, the one expiring last when there are
+        several. ACM does not return private keys, the body holds the public certificate and chain.
 
-    def write(self, cert: StoreObject) -> bool:
-        """ ACM Store Engine Write the certificate to specified region and account
+            :param path: Store path, kept on the returned object
+            :type path: str
+            :param name: Domain name, wildcard.example.com for *.example.com
+            :type name: str
+            :param type: StoreObject type
+            :type type: str
+            :return: StoreObject, None when no target holds a certificate for name
+        """
+        for target, summaries, error in self.fanout(lambda target: target.index().named(name.replace('wildcard', '*', 1))):
+            if summaries:
+                return self.get(name=name, arn=summaries[0]['CertificateArn'], path=path, type=type, target=target)
+        return None
+
+    def write(self, cert: StoreObject, force: bool = False) -> bool:
+        """ ACM Store Engine Write the certificate to every target concurrently, the outcome on each is kept in results
 
             :param cert: The StoreObject to persist in AWS ACM Store
             :type cert: Cert
-            :return: bool
-
+            :param force: Import even if ACM already holds the certificate
+            :type force: bool
+            :return: bool, True when every target holds the certificate
         """
         logger.trace(f'[ACMStoreEngine]:\nPUB  :{cert.public}\nKEY  :REDACTED\nCHAIN:{cert.chain}\n')
+        tags = ast.literal_eval(self._tmpl_tags.render(cert=cert))
 
-        try:
-            if len(cert.data['cert_body']['chain']) > 0:
-                acm_res = self.__session.client('acm').import_certificate(
-                    Certificate=cert.data['cert_body']['public'],
-                    PrivateKey=cert.data['cert_body']['private'],
-                    CertificateChain=cert.data['cert_body']['chain'],
-                    Tags=ast.literal_eval(self._tmpl_tags.render(cert=cert))
-                )
-            else:
-                acm_res = self.__session.client('acm').import_certificate(
-                    Certificate=cert.data['cert_body']['public'],
-                    PrivateKey=cert.data['cert_body']['private'],
-                    Tags=ast.literal_eval(self._tmpl_tags.render(cert=cert))
-                )
-
-            cert.arn = acm_res.get('CertificateArn')
-            logger.trace(
-                f'[ACMStoreEngine]: Certificate uploaded:\n'
-                f'Region: {self.region}\n'
-                f'Account: {self.profile_name}\n'
-                f'CertARN: {cert.arn}')
-            return True
+        self.results = []
+        for target, imported, error in self.fanout(self.__import, cert, tags, force):
+            arn, status = imported or (None, 'failed')
+            self.results.append({'name': cert.name, 'profile': target.profile_name, 'region': target.region, 'arn': arn,
+                                 'status': status, 'error': str(error) if error else None})
+        arns = [result['arn'] for result in self.results if result['arn']]
+        if arns:
+            cert.arn = arns[0]
+        failed = len(self.results) - len(arns)
+        if failed:
+            logger.error(f'[ACMStoreEngine]: {cert.name} failed on {failed} of {len(self.results)} targets')
+        return failed == 0
 
-        except self.__AwsErrors as e:
-            logger.error(f'[ACMStoreEngine]: Exception importing certificates to ACM {e}')
-            sys.exit(1)
+    def __import(self, target: ACMTarget, cert: StoreObject, tags: list, force: bool) -> tuple:
+        """Import the certificate to one target. When the target already holds a certificate for the domain an identical
+        one is skipped and a renewed one is re-imported into the same ARN, otherwise a new ARN is created.
+
+            :return: tuple (CertificateArn, 'imported', 'reimported' or 'unchanged')
+        """
+        body = cert.data['cert_body']
+        request = {'Certificate': body['public'], 'PrivateKey': body['private']}
+        if len(body['chain']) > 0:
+            request['CertificateChain'] = body['chain']
+
+        existing = [summary for summary in target.index().named(self.domain_name(cert)) if summary.get('Type') == 'IMPORTED']
+        if existing:
+            arn = existing[0]['CertificateArn']
+            if not force and self.unchanged(target, arn, cert):
+                logger.debug(f'[ACMStoreEngine]: {cert.name} unchanged in {target} {arn}')
+                return arn, 'unchanged'
+            """Tags are kept from the first import, ACM rejects them when re-importing"""
+            target.acm.import_certificate(CertificateArn=arn, **request)
+            status = 'reimported'
+        else:
+            arn = target.acm.import_certificate(Tags=tags, **request).get('CertificateArn')
+            status = 'imported'
+        target.invalidate()
+        logger.trace(
+            f'[ACMStoreEngine]: Certificate uploaded:\n'
+            f'Region: {target.region}\n'
+            f'Account: {target.profile_name}\n'
+            f'CertARN: {arn}')
+        return arn, status
+
+    @staticmethod
+    def domain_name(cert: StoreObject) -> str:
+        """The DomainName ACM lists for the certificate, its subject common name"""
+        common_name = cert.data.get('cert_info', {}).get('subject', {}).get('commonName')
+        return common_name or cert.name.replace('wildcard', '*', 1)
+
+    @staticmethod
+    def serial_forms(serial_number: int) -> tuple:
+        """ACM describes serial numbers as colon separated hex bytes, i.e. 0a:1b, some ACM compatible endpoints in decimal"""
+        digits = f'{serial_number:x}'
+        digits = digits.zfill(len(digits) + len(digits) % 2)
+        return ':'.join(digits[i:i + 2] for i in range(0, len(digits), 2)), f'{serial_number}'
+
+    @staticmethod
+    def unchanged(target: ACMTarget, arn: str, cert: StoreObject) -> bool:
+        """Whether the certificate at arn is the one being written. The serial number from describe_certificate settles a
+        renewal, the certificate is only fetched to compare fingerprints when the serial numbers match.
+
+            :param target: Target holding arn
+            :type target: ACMTarget
+            :param arn: CertificateArn of the existing certificate
+            :type arn: str
+            :param cert: The certificate being written
+            :type cert: StoreObject
+            :return: bool, False as well when the serial numbers or the stored certificate do not parse
+        """
+        key_details = cert.data.get('cert_info', {}).get('key_details', {})
+        if not key_details.get('serial_number') or not key_details.get('fingerprint_sha256'):
+            return False
+        try:
+            serial = target.acm.describe_certificate(CertificateArn=arn)['Certificate'].get('Serial', '').lower()
+            if serial not in ACMStoreEngine.serial_forms(int(key_details['serial_number'])):
+                return False
+            pem = target.acm.get_certificate(CertificateArn=arn)['Certificate']
+            fingerprint = x509.load_pem_x509_certificate(pem.encode(), default_backend()).fingerprint(hashes.SHA256())
+        except ValueError as e:
+            """A serial number or certificate that does not parse can not be compared, import it again"""
+            logger.debug(f'[ACMStoreEngine]: Can not compare {arn} in {target}, treated as changed {e}')
+            return False
+        return hexlify(fingerprint).decode() == key_details['fingerprint_sha256']
@@ -0,0 +1,73 @@
+"""
+Apache Software License 2.0
+
+Copyright (c) 2020, 8x8, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License."""
+from datetime import datetime
+from datetime import timedelta
+
+from .store_engine import StoreEngine
+from .store_object import StoreObject
+
+
+class AsyncStoreEngine(StoreEngine):
+    """StoreEngine whose operations are coroutines, so one thread can keep hundreds of requests in flight. Store
+    recognizes these engines and runs them on its own event loop, existing callers keep using the blocking Store
+    methods while asyncio callers can await the engine directly.
+
+    iterfind is an asynchronous generator, results come in the order they are found.
+    """
+
+    async def open(self) -> bool:
+        """Initialize access to the persistence"""
+        pass
+
+    async def close(self) -> bool:
+        """Close access to the persistence"""
+        pass
+
+    async def read(self, path: str, name: str, type=None) -> StoreObject:
+        """Read from the store"""
+        pass
+
+    async def read_many(self, items) -> list:
+        """Read many (path, name, type) objects, None for those that could not be read"""
+        pass
+
+    async def write(self, obj: StoreObject, force: bool = False) -> bool:
+        """Write to the store, force rewrites objects the store already holds"""
+        pass
+
+    async def delete(self, path: str, name: str) -> bool:
+        """Delete from the store"""
+        pass
+
+    async def find(self, pattern: str, live: bool = False) -> list:
+        """Search the store"""
+        return [result async for result in self.iterfind(pattern, live=live)]
+
+    async def iterfind(self, pattern: str, live: bool = False):
+        """Yield search results as they are found"""
+        for result in []:
+            yield result
+
+    async def subjectaltfind(self, pattern: str, live: bool = False) -> list:
+        """Search the store by subject alternative name"""
+        pass
+
+    async def expiring(self, days: int, live: bool = False) -> list:
+        """Certificates expiring within the given number of days, soonest first"""
+        before = (datetime.now() + timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+        return sorted([result async for result in self.iterfind('*', live=live) if result.get('cert_expiry_date', '') < before],
+                      key=lambda result: result['cert_expiry_date'])
@@ -0,0 +1,216 @@
+"""
+Apache Software License 2.0
+
+Copyright (c) 2020, 8x8, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License."""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from cryptography.fernet import Fernet
+from cryptography.fernet import InvalidToken
+from loguru import logger
+
+
+class StoreCache:
+    """Read-through cache of StoreObject body and info, keyed by store path and the KV versions they were read at.
+    Entries younger than the TTL are served as is, older ones are served again once the store confirms their
+    versions are still current. Recently used entries are kept in memory, least recently used first out. With a
+    directory and a Fernet key, entries are also kept encrypted on disk so they survive between runs."""
+    __entries: OrderedDict  #: path -> entry, in least recently used order
+    __size: int             #: Entries kept in memory
+    __ttl: float            #: Seconds an entry is served without checking its versions
+    __directory: str        #: Encrypted on disk entries, None when memory only
+    __disk_limit: int       #: Bytes kept on disk before the oldest entries are removed
+    __fernet: Fernet
+
+    def __init__(self, store: str, size: int = 128, ttl: float = 60, directory: str = None, key: str = None,
+                 disk_limit: int = 64 * 1024 * 1024) -> None:
+        """Constructor for StoreCache
+
+            :param store: Name of the store being cached, i.e. Vault url and mount
+            :type store: str
+            :param size: Entries kept in memory
+            :type size: int
+            :param ttl: Seconds an entry is served without checking its versions with the store
+            :type ttl: float
+            :param directory: Keep encrypted entries in this directory too
+            :type directory: str
+            :param key: Fernet key encrypting the on disk entries, required with directory
+            :type key: str
+            :param disk_limit: Bytes kept in directory
+            :type disk_limit: int
+        """
+        self.__store = store
+        self.__entries = OrderedDict()
+        self.__size = size
+        self.__ttl = ttl
+        self.__directory = None
+        self.__disk_limit = disk_limit
+        self.__lock = threading.RLock()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.evictions = 0
+        if directory:
+            if not key:
+                logger.warning('KNOX_CACHE_KEY is not set, certificates are only cached in memory')
+            else:
+                self.__fernet = Fernet(key.encode('utf-8') if isinstance(key, str) else key)
+                self.__directory = os.path.expanduser(directory)
+                os.makedirs(self.__directory, mode=0o700, exist_ok=True)
+
+    @classmethod
+    def from_settings(cls, settings, store: str):
+        """Build the cache configured by KNOX_CACHE_*, None when caching is off
+
+            :param settings: Knox settings
+            :type settings: LazySettings
+            :param store: Name of the store being cached
+            :type store: str
+            :return: StoreCache
+        """
+        size = int(settings.get('CACHE_SIZE', 0))
+        directory = settings.get('CACHE_PATH')
+        if size <= 0 and not directory:
+            return None
+        return cls(store,
+                   size=max(size, 0),
+                   ttl=float(settings.get('CACHE_TTL', 60)),
+                   directory=directory,
+                   key=settings.get('CACHE_KEY'),
+                   disk_limit=int(settings.get('CACHE_DISK_LIMIT', 64 * 1024 * 1024)))
+
+    @property
+    def stats(self) -> dict:
+        """Counters for entries served fresh, served after a version check, read from the store and evicted"""
+        return {'hits': self.hits, 'revalidated': self.revalidated, 'misses': self.misses, 'evictions': self.evictions}
+
+    def get(self, path: str, versions=None):
+        """Cached (versions, body, info) for path, None when missing or stale
+
+            :param path: Store path of the object
+            :type path: str
+            :param versions: Called with no argument for the current versions in the store, once the TTL has passed
+            :type versions: callable
+            :return: tuple
+        """
+        with self.__lock:
+            entry = self.__entries.get(path) or self.__load(path)
+            fresh = entry is not None and time.time() - entry['stored'] < self.__ttl
+        """The version check goes to the store, do not hold up other readers meanwhile"""
+        current = entry is not None and (fresh or (versions is not None and tuple(versions()) == tuple(entry['versions'])))
+        with self.__lock:
+            if not current:
+                if entry is not None:
+                    self.discard(path)
+                self.misses += 1
+                return None
+            if fresh:
+                self.hits += 1
+            else:
+                entry['stored'] = time.time()
+                self.revalidated += 1
+                if self.__directory:
+                    self.__save(path, entry)
+            self.__remember(path, entry)
+            return tuple(entry['versions']), entry['body'], entry['info']
+
+    def put(self, path: str, versions: tuple, body, info) -> None:
+        """Cache what was just read from the store
+
+            :param path: Store path of the object
+            :type path: str
+            :param versions: KV versions of body and info
+            :type versions: tuple
+            :param body: The objects body
+            :param info: The objects info
+        """
+        entry = {'versions': list(versions), 'stored': time.time(), 'body': body, 'info': info}
+        with self.__lock:
+            self.__remember(path, entry)
+            if self.__directory:
+                self.__save(path, entry)
+
+    def discard(self, path: str) -> None:
+        """Forget path, i.e. after it was written"""
+        with self.__lock:
+            self.__entries.pop(path, None)
+            if self.__directory:
+                try:
+                    os.unlink(self.__filename(path))
+                except FileNotFoundError:
+                    pass
+
+    def __remember(self, path: str, entry: dict) -> None:
+        if self.__size <= 0:
+            return
+        self.__entries[path] = entry
+        self.__entries.move_to_end(path)
+        while len(self.__entries) > self.__size:
+            self.__entries.popitem(last=False)
+            self.evictions += 1
+
+    def __filename(self, path: str) -> str:
+        digest = hashlib.sha256(f'{self.__store}{path}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.__directory, f'{digest}.cache')
+
+    def __load(self, path: str):
+        if not self.__directory:
+            return None
+        try:
+            with open(self.__filename(path), 'rb') as fp:
+                entry = json.loads(self.__fernet.decrypt(fp.read()))
+        except FileNotFoundError:
+            return None
+        except (InvalidToken, ValueError):
+            logger.debug(f'Dropping unreadable cache entry for {path}')
+            self.discard(path)
+            return None
+        return entry if entry.get('path') == path else None
+
+    def __save(self, path: str, entry: dict) -> None:
+        filename = self.__filename(path)
+        temp = f'{filename}.{os.getpid()}.{threading.get_ident()}'
+        try:
+            fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(self.__fernet.encrypt(json.dumps(dict(entry, path=path)).encode('utf-8')))
+            os.replace(temp, filename)
+        except OSError as err:
+            logger.warning(f'Could not cache {path} on disk: {err}')
+            return
+        self.__trim()
+
+    def __trim(self) -> None:
+        """Remove the oldest on disk entries until the directory fits the disk limit"""
+        files = []
+        with os.scandir(self.__directory) as entries:
+            for item in entries:
+                if item.name.endswith('.cache') and item.is_file():
+                    stat = item.stat()
+                    files.append((stat.st_mtime, stat.st_size, item.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, filename in sorted(files):
+            if total <= self.__disk_limit:
+                break
+            try:
+                os.unlink(filename)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
@@ -14,15 +14,29 @@ distributed under the License is distributed on an "AS IS" BASIS,
 WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License."""
+import json
+import re
+import time
+from datetime import datetime
+from datetime import timedelta
+
+import validators
+from loguru import logger
+
+from .store_index import SanIndex
 from .store_object import StoreObject
 
 
 class StoreEngine:
     """The abstract persistence strategy for storing the certificates """
     settings: object
+    _store_path = re.compile(r'^/?[\w.-]+(/[\w.-]+)*/?$')  #: Patterns that are already a store path i.e. com/example/www
 
     def __init__(self) -> None:
         """Constructor for StoreEngine"""
+        self._san = None          #: SanIndex built from the last full scan, engines without a persistent index use it
+        self._san_results = {}    #: Search results of the last full scan by location
+        self._san_built = 0.0     #: Monotonic time of that scan
 
     def open(self) -> bool:
         """Initialize access to the persistence"""
@@ -40,10 +54,168 @@ class StoreEngine:
         """Read from the store"""
         pass
 
-    def write(self, obj: StoreObject) -> bool:
-        """Write to the store"""
+    def read_many(self, items) -> list:
+        """Read many (path, name, type) objects, None for those that could not be read. Engines that can read
+        concurrently override this"""
+        return [self.read(path, name, type) for path, name, type in items]
+
+    def write(self, obj: StoreObject, force: bool = False) -> bool:
+        """Write to the store, force rewrites objects the store already holds"""
         pass
 
     def delete(self, path: str, name: str) -> bool:
         """Delete from the store"""
         pass
+
+    def find(self, pattern: str, live: bool = False) -> list:
+        """Search the store, live skips any local index"""
+        pass
+
+    def iterfind(self, pattern: str, live: bool = False):
+        """Yield search results as they are found, engines that can stream override this"""
+        yield from self.find(pattern, live=live) or []
+
+    def subjectaltfind(self, pattern: str, live: bool = False) -> list:
+        """Search the store by subject alternative name, live skips any local index"""
+        pass
+
+    def expiring(self, days: int, live: bool = False) -> list:
+        """Certificates expiring within the given number of days, soonest first. Engines with an index override this"""
+        before = (datetime.now() + timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+        return sorted([result for result in self.iterfind('*', live=live) if result.get('cert_expiry_date', '') < before],
+                      key=lambda result: result['cert_expiry_date'])
+
+    @staticmethod
+    def search_result(common_name: str, location_key: str, location: str, cert_info: dict, pattern: str = None) -> dict:
+        """Build the find result for a certificate when its info matches the pattern, shared by every engine
+
+            :param common_name: Name the certificate is stored under
+            :type common_name: str
+            :param location_key: Result key holding where the certificate is, i.e. vault_cert_path
+            :type location_key: str
+            :param location: Where the certificate is stored
+            :type location: str
+            :param cert_info: The certificates 'cert_info'
+            :type cert_info: dict
+            :param pattern: Unaltered search pattern, * matches everything
+            :type pattern: str
+            :return: dict or None
+        """
+        if len(cert_info.keys()) == 0:
+            return None
+        if pattern != "*":
+            """Free text, matched against the whole document. Listing everything skips serializing it"""
+            cert_info_str = json.dumps(cert_info)
+            logger.trace(f'does {pattern} match {cert_info_str}')
+            if cert_info_str.find(pattern) <= 0:
+                logger.trace(f'no, {pattern} not found {location}')
+                return None
+            logger.trace(f'yes, {pattern} matches {cert_info_str}')
+
+        current_date = datetime.now()
+        cert_expiry_date = datetime.strptime(cert_info['validity']['not_valid_after'],
+                                             '%Y-%m-%d %H:%M:%S')
+        days_to_expire = cert_expiry_date - current_date
+        results_dict = {'common_name': common_name,
+                        location_key: location,
+                        'cert_issue_date': cert_info['validity']['not_valid_before'],
+                        'cert_expiry_date': cert_info['validity']['not_valid_after'],
+                        'days_to_expire': days_to_expire.days
+                        }
+        if 'commonName' in cert_info['issuer']:
+            results_dict['issuer'] = cert_info['issuer']['commonName']
+        else:
+            results_dict['issuer'] = ""
+
+        if 'alternativeNames' in cert_info['subject']:
+            results_dict['alternativeNames'] = cert_info['subject']['alternativeNames']
+        else:
+            results_dict['alternativeNames'] = ""
+
+        return results_dict
+
+    def index_san(self, results: list, location_key: str) -> None:
+        """Rebuild the in memory SAN index from the search results of a full scan
+
+            :param results: Every search result of the store
+            :type results: list
+            :param location_key: Result key identifying the certificate, i.e. 'vault_cert_path'
+            :type location_key: str
+        """
+        san = SanIndex()
+        san_results = {}
+        for result in results:
+            san_results[result[location_key]] = result
+            san.add(result[location_key], {'subject': {'alternativeNames': result['alternativeNames']}})
+        self._san, self._san_results, self._san_built = san, san_results, time.monotonic()
+        logger.debug(f'SAN index built with {len(san)} names')
+
+    def san_lookup(self, pattern: str, scan, ttl: float, live: bool = False) -> list:
+        """Search results whose subject alternative names cover pattern, from the last full scan while it is younger
+        than ttl seconds and nothing was written since
+
+            :param pattern: DNS name
+            :type pattern: str
+            :param scan: Runs a full scan of the store, which calls index_san
+            :type scan: callable
+            :param ttl: Seconds the last scan is used, i.e. KNOX_INDEX_TTL
+            :type ttl: float
+            :param live: Scan again regardless
+            :type live: bool
+            :return: list
+        """
+        if self.san_stale(ttl, live):
+            scan()
+        return [self._san_results[key] for key in self._san.lookup(pattern)]
+
+    def san_stale(self, ttl: float, live: bool = False) -> bool:
+        """Whether the SAN index is missing, older than ttl seconds or live asks for a new scan
+
+            :return: bool
+        """
+        return self._san is None or live or time.monotonic() - self._san_built > ttl
+
+    def discard_san(self) -> None:
+        """Drop the SAN index after the store changed, the next lookup scans again"""
+        self._san = None
+
+    @staticmethod
+    def to_store_path(common_name: str) -> str:
+        """Store path of a common name, www.example.com becomes /com/example/www. Cert.to_store_path uses it too, so
+        the paths certificates are saved under and the paths find prunes to always agree
+
+            :return: str
+        """
+        return "/" + "/".join(reversed(common_name.split('.')))
+
+    @classmethod
+    def search_path(cls, pattern: str) -> tuple:
+        """Translate a find pattern into the store sub tree that holds every possible match, so engines only walk
+        that prefix. Free text patterns can match anywhere and return (None, None) for a full scan.
+
+            www.example.com  -> /com/example/www/www.example.com/
+            *.example.com    -> /com/example/ and the glob *.example.com to filter common names
+            example.com/*    -> /com/example/
+            com/example/www  -> /com/example/www/
+
+            :param pattern: Search pattern
+            :type pattern: str
+            :return: tuple of (path, glob)
+        """
+        pattern = pattern.strip() if pattern else ''
+        if pattern in ('', '*'):
+            return None, None
+        if pattern.endswith('/*'):
+            domain = pattern[:-2]
+            if validators.domain(domain):
+                return cls.to_store_path(domain) + '/', None
+        elif pattern.startswith('*.'):
+            domain = pattern[2:]
+            if validators.domain(domain):
+                return cls.to_store_path(domain) + '/', pattern
+        elif validators.domain(pattern.replace('*', 'wildcard')):
+            name = pattern.replace('*', 'wildcard')
+            return f'{cls.to_store_path(name)}/{name}/', None
+        elif '/' in pattern and cls._store_path.match(pattern):
+            return '/' + pattern.strip('/') + '/', None
+        return None, None
@@ -14,19 +14,292 @@ distributed under the License is distributed on an "AS IS" BASIS,
 WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License."""
-import os  # noqa: F401
+import json
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime
+from datetime import timedelta
+from fnmatch import fnmatch
 
+import validators
 from loguru import logger
 
 from .store_engine import StoreEngine
+from .store_object import StoreObject
+from .store_packed import PackedLog
 
 
 class FileStoreEngine(StoreEngine):
-    """"""
+    """Local directory implementation of the StoreEngine interface, for air gapped hosts and tests. Certificates use
+    the Vault layout below KNOX_FILE_HOME, i.e. www.example.com is kept in com/example/www/www.example.com/PEM/ as
+
+        cert_info.json  non sensitive details, the only file find reads
+        cert_body.json  public certificate, private key and chain, readable by its owner only
+
+    With KNOX_FILE_LAYOUT=packed every cert_info is kept in a single log instead, see PackedLog.
+    """
     __file_home: str
+    __packed: PackedLog   #: Packed layout, None for the directory tree
+    __san_ttl: float      #: Seconds a full scan answers SAN lookups, KNOX_INDEX_TTL
 
     def __init__(self, settings) -> None:
         """Constructor for FileStore"""
         super().__init__()
-        self.__file_home = settings.FILE_HOME
+        self.__file_home = os.path.abspath(os.path.expanduser(settings.FILE_HOME))
+        self.__san_ttl = float(settings.get('INDEX_TTL', 300))
         logger.debug(f'📂 File backend configuration loaded. {self.__file_home}')
+        self.initialize()
+        self.__packed = None
+        if settings.get('FILE_LAYOUT', 'tree') == 'packed':
+            self.__packed = PackedLog(self.__file_home,
+                                      key=settings.get('FILE_KEY'),
+                                      compact_ratio=float(settings.get('FILE_COMPACT_RATIO', 0.5)))
+
+    def initialize(self) -> bool:
+        """Create KNOX_FILE_HOME when missing"""
+        os.makedirs(self.__file_home, mode=0o700, exist_ok=True)
+        return True
+
+    def close(self) -> bool:
+        """Save the packed index"""
+        if getattr(self, '_FileStoreEngine__packed', None) is not None:
+            self.__packed.close()
+        return True
+
+    def __del__(self):
+        """Best effort, modules may already be torn down at interpreter exit"""
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def location(self, path: str, name: str, type=None) -> str:
+        """Directory holding an object, mirroring VaultClient.upsert: domains below their path, others in client/"""
+        if validators.domain(name):
+            parts = [path, name, type]
+        else:
+            parts = ['client', name, type]
+        return os.path.join(self.__file_home, *[part.strip('/') for part in parts if part])
+
+    def write(self, obj: StoreObject, force: bool = False) -> bool:
+        """Write cert_info.json and cert_body.json of obj, unless the same object is already stored
+
+            :param obj: The StoreObject to persist
+            :type obj: StoreObject
+            :param force: Write even when the files hold the same object
+            :type force: bool
+            :return: bool
+        """
+        directory = self.location(obj.path, obj.name, obj.type)
+        documents = {'cert_info': obj.data['cert_info'], 'cert_body': obj.data['cert_body']}
+        try:
+            if not force and self.__load(directory) == documents:
+                logger.info(f'Skipped {directory}, identical to the stored version')
+                return True
+            self.discard_san()
+            if self.__packed is not None:
+                self.__packed.put(self.__key(directory), documents['cert_info'], documents['cert_body'])
+                logger.info(f'Successfully stored {directory}')
+                return True
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            """Body first, a cert_info.json is only visible to find once the certificate is complete"""
+            self.replace(os.path.join(directory, 'cert_body.json'), documents['cert_body'], 0o600)
+            self.replace(os.path.join(directory, 'cert_info.json'), documents['cert_info'], 0o644)
+        except OSError as err:
+            logger.error(f'Failed to write StoreObject to {directory}: {err}')
+            sys.exit(2)
+        logger.info(f'Successfully stored {directory}')
+        return True
+
+    def read(self, path: str, name: str, type=None) -> StoreObject:
+        """Using the provided path and name read the object files and create a new StoreObject
+
+            :param path: Store path to the object
+            :type path: str
+            :param name: Name of the object to retrieve
+            :type name: str
+            :param type: StoreObject type, if known
+            :type type: str
+            :return: StoreObject
+        """
+        directory = self.location(path, name, type)
+        documents = self.__load(directory)
+        if documents is None:
+            logger.error(f'Failed to read StoreObject {directory}')
+            sys.exit(2)
+        cert = StoreObject(name=name, path=path, body=documents['cert_body'], info=documents['cert_info'], type=type)
+        cert._data = documents
+        logger.info(f' Successfully read {cert.path_name}')
+        return cert
+
+    def read_many(self, items) -> list:
+        """Read many (path, name, type) objects, None for those that could not be read"""
+        results = []
+        for path, name, type in items:
+            try:
+                results.append(self.read(path, name, type))
+            except SystemExit:
+                results.append(None)
+        return results
+
+    def delete(self, path: str, name: str) -> bool:
+        """Remove an object, every type of it
+
+            :param path: Store path to the object
+            :type path: str
+            :param name: Name of the object
+            :type name: str
+            :return: bool, False when there was nothing to delete
+        """
+        directory = self.location(path, name)
+        self.discard_san()
+        if self.__packed is not None:
+            key = self.__key(directory)
+            return any([self.__packed.delete(stored) for stored in self.__packed.keys(key) if stored.startswith(key + '/')])
+        if not os.path.isdir(directory):
+            return False
+        shutil.rmtree(directory)
+        return True
+
+    def find(self, pattern, live: bool = False) -> list:
+        """Search certificate info for a given search pattern, domain patterns only walk the matching sub tree
+
+            :param pattern: Search glob pattern
+                ex: *, abc.8x8.com, abc.8x8.com/*, 8x8.com/*
+            :type pattern: str
+            :param live: Accepted for compatibility, the files are always searched directly
+            :type live: bool
+            :return: list
+        """
+        return list(self.iterfind(pattern, live=live))
+
+    def iterfind(self, pattern, live: bool = False):
+        """Generator version of find, results are yielded as the directories are walked
+
+            :param pattern: Search glob pattern
+            :type pattern: str
+            :param live: Accepted for compatibility
+            :type live: bool
+            :return: generator of dict
+        """
+        rootpath, glob = self.search_path(pattern)
+        scanned = [] if pattern == '*' else None
+        for directory, cert_info in self.walk(rootpath or '/'):
+            result = self.search_result(directory.split(os.sep)[-2],
+                                        'file_cert_path',
+                                        directory,
+                                        cert_info,
+                                        '*' if rootpath else pattern)
+            if result is None:
+                continue
+            if scanned is not None:
+                scanned.append(result)
+            if not glob or fnmatch(result['common_name'].lower(), glob.lower()):
+                yield result
+        if scanned is not None:
+            self.index_san(scanned, 'file_cert_path')
+
+    def subjectaltfind(self, pattern: str, live: bool = False) -> list:
+        """Find the certificates listing pattern as a subject alternative name
+
+            :param pattern: DNS name
+            :type pattern: str
+            :param live: Scan the files again instead of using the last scan
+            :type live: bool
+            :return: list
+        """
+        return self.san_lookup(pattern, lambda: self.find('*'), self.__san_ttl, live=live)
+
+    def expiring(self, days: int, live: bool = False) -> list:
+        """Certificates expiring within the given number of days, soonest first
+
+            :param days: Size of the window from now
+            :type days: int
+            :param live: Accepted for compatibility
+            :type live: bool
+            :return: list
+        """
+        before = (datetime.now() + timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+        return sorted([result for result in self.iterfind('*') if result['cert_expiry_date'] < before],
+                      key=lambda result: result['cert_expiry_date'])
+
+    def walk(self, rootpath: str = '/'):
+        """Yield (directory, cert_info) for every certificate below rootpath, depth first in name order. Only
+        cert_info.json files are opened.
+
+            :param rootpath: Store path to start from, i.e. /com/example/
+            :type rootpath: str
+            :return: generator of tuple
+        """
+        if self.__packed is not None:
+            prefix = rootpath.strip('/') + '/' if rootpath.strip('/') else ''
+            for key, cert_info in self.__packed.scan(prefix):
+                yield os.path.join(self.__file_home, key), cert_info
+            return
+        stack = [os.path.join(self.__file_home, rootpath.strip('/'))]
+        while stack:
+            directory = stack.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    children = sorted((entry.name, entry.is_dir(follow_symlinks=False)) for entry in entries)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            if ('cert_info.json', False) in children:
+                try:
+                    with open(os.path.join(directory, 'cert_info.json'), 'r') as fp:
+                        yield directory, json.load(fp)
+                except (OSError, ValueError) as err:
+                    logger.warning(f'Skipping unreadable {directory}/cert_info.json: {err}')
+                continue
+            stack.extend(os.path.join(directory, name) for name, is_dir in reversed(children) if is_dir)
+
+    @staticmethod
+    def replace(filename: str, document: dict, mode: int) -> None:
+        """Write document as JSON next to filename, fsync it and rename it into place
+
+            :param filename: File to replace
+            :type filename: str
+            :param document: Content
+            :type document: dict
+            :param mode: Permissions of the new file
+            :type mode: int
+        """
+        directory = os.path.dirname(filename)
+        fd, temp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(document, fp, sort_keys=True)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.chmod(temp, mode)
+            os.replace(temp, filename)
+        except BaseException:
+            os.unlink(temp)
+            raise
+        dirfd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+
+    def __key(self, directory: str) -> str:
+        return os.path.relpath(directory, self.__file_home).replace(os.sep, '/')
+
+    def __load(self, directory: str):
+        if self.__packed is not None:
+            try:
+                stored = self.__packed.get(self.__key(directory))
+            except (OSError, ValueError) as err:
+                logger.warning(f'Unreadable body for {directory}: {err}')
+                return None
+            return None if stored is None else {'cert_info': stored[0], 'cert_body': stored[1]}
+        documents = {}
+        for document in ('cert_info', 'cert_body'):
+            try:
+                with open(os.path.join(directory, f'{document}.json'), 'r') as fp:
+                    documents[document] = json.load(fp)
+            except (OSError, ValueError):
+                return None
+        return documents
@@ -0,0 +1,256 @@
+"""
+Apache Software License 2.0
+
+Copyright (c) 2020, 8x8, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License."""
+import ast
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from loguru import logger
+
+
+class SanIndex:
+    """In memory inverted index from each DNS name in 'subject.alternativeNames' to the certificates listing it.
+    Lookups follow certificate wildcard semantics, *.example.com covers api.example.com but neither example.com
+    nor api.eu.example.com."""
+    __names: dict         #: DNS name -> keys of the certificates listing it
+
+    def __init__(self) -> None:
+        """Constructor for SanIndex"""
+        self.__names = {}
+
+    def __len__(self) -> int:
+        return len(self.__names)
+
+    @staticmethod
+    def candidates(name: str) -> list:
+        """SAN entries that would cover name, the name itself and the wildcard of its parent domain
+
+            :param name: DNS name being looked up
+            :type name: str
+            :return: list
+        """
+        name = name.strip().lower()
+        labels = name.split('.', 1)
+        if labels[0] == '*' or len(labels) < 2:
+            return [name]
+        return [name, f'*.{labels[1]}']
+
+    def add(self, key: str, cert_info: dict) -> None:
+        """Index the alternative names of a certificate
+
+            :param key: Identifies the certificate, i.e. its store path
+            :type key: str
+            :param cert_info: The certificates 'cert_info'
+            :type cert_info: dict
+        """
+        for name in StoreIndex.alt_names(cert_info):
+            self.__names.setdefault(name.lower(), set()).add(key)
+
+    def lookup(self, name: str) -> list:
+        """Keys of the certificates covering name, sorted
+
+            :param name: DNS name
+            :type name: str
+            :return: list
+        """
+        keys = set()
+        for candidate in self.candidates(name):
+            keys.update(self.__names.get(candidate, ()))
+        return sorted(keys)
+
+
+class StoreIndex:
+    """Local SQLite index of the non sensitive 'cert_info' documents of a store. Rows are keyed by store path and
+    carry the version they were read at, so a refresh only needs to re-read entries that changed."""
+    __db: sqlite3.Connection
+    __store: str          #: Identifies the store being indexed, i.e. Vault url and mount
+
+    __schema = '''
+        CREATE TABLE IF NOT EXISTS cert_info (
+            store TEXT NOT NULL,
+            path TEXT NOT NULL,
+            version INTEGER,
+            updated_time TEXT,
+            common_name TEXT,
+            issuer TEXT,
+            not_valid_before TEXT,
+            not_valid_after TEXT,
+            info TEXT,
+            PRIMARY KEY (store, path)
+        );
+        CREATE INDEX IF NOT EXISTS cert_info_common_name ON cert_info (store, common_name);
+        CREATE INDEX IF NOT EXISTS cert_info_issuer ON cert_info (store, issuer);
+        CREATE INDEX IF NOT EXISTS cert_info_not_valid_after ON cert_info (store, not_valid_after);
+        CREATE TABLE IF NOT EXISTS san (
+            store TEXT NOT NULL,
+            name TEXT NOT NULL,
+            path TEXT NOT NULL,
+            PRIMARY KEY (store, name, path)
+        );
+        CREATE INDEX IF NOT EXISTS san_path ON san (store, path);
+        CREATE TABLE IF NOT EXISTS refreshed (
+            store TEXT PRIMARY KEY,
+            at REAL
+        );
+    '''
+
+    def __init__(self, filename: str, store: str) -> None:
+        """Constructor for StoreIndex
+
+            :param filename: SQLite database file, created if missing
+            :type filename: str
+            :param store: Name of the store being indexed
+            :type store: str
+        """
+        filename = os.path.expanduser(filename)
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.__filename = filename
+        self.__store = store
+        self.__lock = threading.RLock()
+        self.__db = sqlite3.connect(filename, check_same_thread=False)
+        self.__db.executescript(self.__schema)
+        logger.debug(f'🗂 Store index {filename} loaded for {store}')
+
+    @staticmethod
+    def alt_names(cert_info: dict) -> list:
+        """DNS names from 'subject.alternativeNames', stored by Cert as the quoted repr of a list
+
+            :param cert_info: The certificates 'cert_info'
+            :type cert_info: dict
+            :return: list
+        """
+        names = cert_info.get('subject', {}).get('alternativeNames', '')
+        if isinstance(names, list):
+            return names
+        names = names.strip().strip('"')
+        if not names.startswith('['):
+            return []
+        try:
+            return [name for name in ast.literal_eval(names) if isinstance(name, str)]
+        except (ValueError, SyntaxError):
+            return []
+
+    def versions(self) -> dict:
+        """Map of every indexed path to the version it was read at"""
+        return dict(self.__query('SELECT path, version FROM cert_info WHERE store = ?', (self.__store,)))
+
+    def upsert(self, path: str, version: int, updated_time: str, cert_info: dict) -> None:
+        """Add or replace the entry for path
+
+            :param path: Store path of the certificate
+            :type path: str
+            :param version: Store version of cert_info
+            :type version: int
+            :param updated_time: When the store last changed cert_info
+            :type updated_time: str
+            :param cert_info: The certificates 'cert_info'
+            :type cert_info: dict
+        """
+        issuer = cert_info.get('issuer', {}).get('commonName', '')
+        validity = cert_info.get('validity', {})
+        with self.__lock, self.__db:
+            self.__db.execute('INSERT OR REPLACE INTO cert_info VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                              (self.__store, path, version, updated_time, path.rstrip('/').split('/')[-2], issuer,
+                               validity.get('not_valid_before'), validity.get('not_valid_after'),
+                               json.dumps(cert_info)))
+            self.__db.execute('DELETE FROM san WHERE store = ? AND path = ?', (self.__store, path))
+            self.__db.executemany('INSERT OR IGNORE INTO san VALUES (?, ?, ?)',
+                                  [(self.__store, name.lower(), path) for name in self.alt_names(cert_info)])
+
+    def remove(self, paths: list) -> None:
+        """Drop entries no longer present in the store"""
+        with self.__lock, self.__db:
+            for path in paths:
+                self.__db.execute('DELETE FROM cert_info WHERE store = ? AND path = ?', (self.__store, path))
+                self.__db.execute('DELETE FROM san WHERE store = ? AND path = ?', (self.__store, path))
+
+    def touch(self) -> None:
+        """Record that the index has just been synchronized with the store"""
+        with self.__lock, self.__db:
+            self.__db.execute('INSERT OR REPLACE INTO refreshed VALUES (?, ?)', (self.__store, time.time()))
+
+    def age(self) -> float:
+        """Seconds since the last refresh, infinite when never refreshed"""
+        rows = self.__query('SELECT at FROM refreshed WHERE store = ?', (self.__store,))
+        return time.time() - rows[0][0] if rows else float('inf')
+
+    def find(self, prefix: str = None, text: str = None, common_name: str = None, issuer: str = None) -> list:
+        """Indexed lookup of cert_info entries, in store path order
+
+            :param prefix: Only entries below this store path
+            :type prefix: str
+            :param text: Only entries whose cert_info contains this text
+            :type text: str
+            :param common_name: Only entries stored under this common name
+            :type common_name: str
+            :param issuer: Only entries issued by this common name
+            :type issuer: str
+            :return: list of (path, cert_info)
+        """
+        query = 'SELECT path, info FROM cert_info WHERE store = ?'
+        args = [self.__store]
+        if prefix:
+            """Range scan on the primary key instead of LIKE, paths may contain % and _"""
+            query += ' AND path >= ? AND path < ?'
+            args += [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+        if text:
+            query += ' AND instr(info, ?) > 0'
+            args.append(text)
+        if common_name:
+            query += ' AND common_name = ?'
+            args.append(common_name)
+        if issuer:
+            query += ' AND issuer = ?'
+            args.append(issuer)
+        rows = self.__query(query + ' ORDER BY path', args)
+        return [(path, json.loads(info)) for path, info in rows]
+
+    def subjectaltfind(self, name: str) -> list:
+        """Entries whose subject alternative names cover name, see SanIndex for the wildcard rules
+
+            :param name: DNS name
+            :type name: str
+            :return: list of (path, cert_info)
+        """
+        candidates = SanIndex.candidates(name)
+        rows = self.__query('SELECT DISTINCT c.path, c.info FROM san s JOIN cert_info c '
+                            'ON c.store = s.store AND c.path = s.path '
+                            f'WHERE s.store = ? AND s.name IN ({", ".join("?" * len(candidates))}) '
+                            'ORDER BY c.path', [self.__store] + candidates)
+        return [(path, json.loads(info)) for path, info in rows]
+
+    def expiring(self, before: str) -> list:
+        """Entries whose 'not_valid_after' is earlier than before, soonest first
+
+            :param before: Date formatted as '%Y-%m-%d %H:%M:%S'
+            :type before: str
+            :return: list of (path, cert_info)
+        """
+        rows = self.__query('SELECT path, info FROM cert_info WHERE store = ? AND not_valid_after < ? '
+                            'ORDER BY not_valid_after', (self.__store, before))
+        return [(path, json.loads(info)) for path, info in rows]
+
+    def close(self) -> None:
+        self.__db.close()
+
+    def __query(self, query: str, args) -> list:
+        """Run a read query, the connection is shared by every thread using the index"""
+        with self.__lock:
+            return self.__db.execute(query, args).fetchall()
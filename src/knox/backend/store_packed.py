@@ -0,0 +1,367 @@
+"""
+Apache Software License 2.0
+
+Copyright (c) 2020, 8x8, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License."""
+import contextlib
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+
+from cryptography.fernet import Fernet
+from cryptography.fernet import InvalidToken
+from loguru import logger
+
+try:
+    import fcntl
+except ImportError:
+    """Not available on Windows, only a single process may use the store there"""
+    fcntl = None
+
+
+class PackedLog:
+    """Packed storage for FileStoreEngine, KNOX_FILE_LAYOUT=packed. Every cert_info lives in one append only log
+    so listing 100k certificates is a sequential read of a single memory mapped file:
+
+        cert_info.log   header, then one record per write or delete: length, crc32, op and the JSON payload
+        cert_info.idx   offset of the live record of every key, and how much of the log it covers
+        cert_info.lock  flock held by the process writing
+        bodies/         one file per cert_body, Fernet encrypted with KNOX_FILE_KEY when set, removed once the
+                        record replacing or deleting it is committed
+
+    The index is only a shortcut, a missing, stale or torn one is rebuilt by replaying the log. Records past the
+    last complete one, left by a crash mid write, are ignored and truncated by the next writer. Compaction
+    rewrites the live records into a new log and swaps it in with os.replace, readers holding the old map keep
+    reading the old file until they notice the change. Readers never lock, records are immutable once written.
+    """
+    magic = b'KNOXLOG1'
+    header = struct.Struct('<II B')   #: payload length, crc32 of payload, op
+    PUT = 1
+    DELETE = 2
+
+    def __init__(self, home: str, key: str = None, compact_ratio: float = 0.5, compact_min: int = 1024 * 1024) -> None:
+        """Constructor for PackedLog
+
+            :param home: Directory holding the log, index and bodies
+            :type home: str
+            :param key: Fernet key encrypting the bodies, plain JSON readable by the owner only when None
+            :type key: str
+            :param compact_ratio: Compact once this share of the log is superseded records
+            :type compact_ratio: float
+            :param compact_min: Never compact logs smaller than this many bytes
+            :type compact_min: int
+        """
+        self.__home = home
+        self.__log = os.path.join(home, 'cert_info.log')
+        self.__idx = os.path.join(home, 'cert_info.idx')
+        self.__bodies = os.path.join(home, 'bodies')
+        self.__fernet = Fernet(key.encode('utf-8') if isinstance(key, str) else key) if key else None
+        self.__compact_ratio = compact_ratio
+        self.__compact_min = compact_min
+        self.__lock = threading.RLock()
+        self.__lockfile = None
+        self.__depth = 0
+        self.__map = None
+        self.__seen = None        #: (inode, size) of the log last replayed
+        self.__generation = None  #: Identifies a log file, changes on every compaction
+        self.__size = 0           #: Bytes of the log made of complete records
+        self.__dead = 0           #: Bytes of superseded records
+        self.__offsets = {}       #: key -> offset of its live record
+        self.__bodyfiles = {}     #: key -> body file name
+        self.__replayed = 0
+        os.makedirs(self.__bodies, mode=0o700, exist_ok=True)
+        with self.__exclusive():
+            if not os.path.exists(self.__log):
+                self.__create(self.__log, [])
+        self.refresh()
+
+    def __len__(self) -> int:
+        return len(self.__offsets)
+
+    def close(self) -> None:
+        """Persist the index so the next process does not replay the log, and release the map"""
+        with self.__lock:
+            if self.__replayed:
+                with self.__exclusive():
+                    self.refresh()
+                    self.__save_index()
+            if self.__map is not None:
+                self.__map.close()
+                self.__map = None
+            if self.__lockfile is not None:
+                os.close(self.__lockfile)
+                self.__lockfile = None
+
+    def keys(self, prefix: str = '') -> list:
+        """Keys of the live records starting with prefix, sorted"""
+        self.refresh()
+        with self.__lock:
+            return sorted(key for key in self.__offsets if key.startswith(prefix))
+
+    def info(self, key: str):
+        """The cert_info stored for key, None when missing"""
+        self.refresh()
+        with self.__lock:
+            offset = self.__offsets.get(key)
+            return None if offset is None else self.__record(offset)[2]['i']
+
+    def get(self, key: str):
+        """(cert_info, cert_body) stored for key, None when missing"""
+        while True:
+            self.refresh()
+            with self.__lock:
+                offset = self.__offsets.get(key)
+                if offset is None:
+                    return None
+                payload = self.__record(offset)[2]
+            try:
+                with open(os.path.join(self.__bodies, payload['b']), 'rb') as fp:
+                    content = fp.read()
+                break
+            except FileNotFoundError:
+                """Superseded or deleted by a writer since the record was read, look again"""
+                with self.__lock:
+                    if self.__seen == self.__stat():
+                        raise
+        if self.__fernet is not None:
+            try:
+                content = self.__fernet.decrypt(content)
+            except InvalidToken:
+                raise ValueError(f'The body of {key} can not be decrypted with this key')
+        return payload['i'], json.loads(content)
+
+    def scan(self, prefix: str = ''):
+        """Yield (key, cert_info) of every live record whose key starts with prefix, in log order. Only the log is
+        read, bodies are never opened."""
+        self.refresh()
+        with self.__lock:
+            view = self.__map
+            offsets = sorted(offset for key, offset in self.__offsets.items() if key.startswith(prefix))
+        for offset in offsets:
+            _, _, payload = self.__record(offset, view)
+            yield payload['k'], payload['i']
+
+    def put(self, key: str, info: dict, body: dict) -> None:
+        """Store the cert_info and cert_body of key, replacing what was stored
+
+            :param key: Store location, i.e. com/example/www/www.example.com/PEM
+            :type key: str
+            :param info: cert_info
+            :type info: dict
+            :param body: cert_body, private
+            :type body: dict
+        """
+        content = json.dumps(body, sort_keys=True).encode('utf-8')
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        bodyfile = f'{digest[:2]}/{digest}-{hashlib.sha256(content).hexdigest()[:16]}.body'
+        """The body goes first under its own content addressed name, the record pointing at it is the commit"""
+        self.__write_file(os.path.join(self.__bodies, bodyfile),
+                          self.__fernet.encrypt(content) if self.__fernet else content)
+        self.__append(self.PUT, {'k': key, 'i': info, 'b': bodyfile})
+
+    def delete(self, key: str) -> bool:
+        """Remove key, False when it was not stored"""
+        self.refresh()
+        if key not in self.__offsets:
+            return False
+        self.__append(self.DELETE, {'k': key})
+        return True
+
+    def refresh(self) -> None:
+        """Catch up with records appended, or a compaction done, by other writers since the last call"""
+        with self.__lock:
+            seen = self.__stat()
+            if self.__seen == seen:
+                return
+            if self.__seen is None or self.__seen[0] != seen[0]:
+                self.__load_index()
+            with open(self.__log, 'rb') as fp:
+                generation = fp.read(len(self.magic) + 16)[len(self.magic):]
+                if generation != self.__generation:
+                    """Index of another log, i.e. a crash between the two renames of a compaction"""
+                    self.__reset(generation)
+                """Scans in progress keep the previous map, it is released once they are done with it"""
+                self.__map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            self.__replay(seen[1])
+            self.__seen = seen
+
+    def compact(self, force: bool = True) -> bool:
+        """Rewrite the live records into a new log, dropping superseded and deleted ones and bodies left by crashed writes
+
+            :param force: Compact even when the log has little to gain
+            :type force: bool
+            :return: bool, True when the log was compacted
+        """
+        with self.__exclusive():
+            self.refresh()
+            if not force and (self.__size < self.__compact_min or self.__dead < self.__size * self.__compact_ratio):
+                return False
+            before = self.__size
+            records = [self.__record(self.__offsets[key])[2] for key in sorted(self.__offsets)]
+            self.__create(self.__log, records)
+            self.refresh()
+            self.__save_index()
+            used = set(self.__bodyfiles.values())
+            """Recent bodies may belong to a write about to append its record"""
+            settled = time.time() - 3600
+            for directory, _, files in os.walk(self.__bodies):
+                for name in files:
+                    filename = os.path.join(directory, name)
+                    relative = os.path.relpath(filename, self.__bodies).replace(os.sep, '/')
+                    if relative not in used and os.stat(filename).st_mtime < settled:
+                        os.unlink(filename)
+            logger.debug(f'Compacted {self.__log} from {before} to {self.__size} bytes')
+            return True
+
+    def __append(self, op: int, payload: dict) -> None:
+        data = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+        record = self.header.pack(len(data), zlib.crc32(data), op) + data
+        with self.__exclusive():
+            self.refresh()
+            previous = self.__bodyfiles.get(payload['k'])
+            with open(self.__log, 'r+b') as fp:
+                """Drop a torn record left by a writer that crashed"""
+                fp.truncate(self.__size)
+                fp.seek(self.__size)
+                fp.write(record)
+                fp.flush()
+                os.fsync(fp.fileno())
+            self.refresh()
+            if self.__replayed >= 1000:
+                self.__save_index()
+            if previous is not None and previous != payload.get('b'):
+                """The record is committed, the body it replaced holds a private key nothing points at anymore"""
+                self.__unlink_body(previous)
+        if self.__dead >= self.__compact_min and self.__dead >= self.__size * self.__compact_ratio:
+            self.compact(force=False)
+
+    def __replay(self, end: int) -> None:
+        """Apply the complete records between the covered size and end"""
+        offset = self.__size
+        while offset + self.header.size <= end:
+            length, crc, op = self.header.unpack_from(self.__map, offset)
+            start = offset + self.header.size
+            if start + length > end or zlib.crc32(self.__map[start:start + length]) != crc:
+                logger.debug(f'Ignoring incomplete record at {offset} of {self.__log}')
+                break
+            payload = json.loads(self.__map[start:start + length])
+            key = payload['k']
+            previous = self.__offsets.pop(key, None)
+            if previous is not None:
+                self.__dead += self.header.size + self.header.unpack_from(self.__map, previous)[0]
+            self.__bodyfiles.pop(key, None)
+            if op == self.PUT:
+                self.__offsets[key] = offset
+                self.__bodyfiles[key] = payload['b']
+            else:
+                self.__dead += self.header.size + length
+            offset = start + length
+            self.__replayed += 1
+        self.__size = offset
+
+    def __unlink_body(self, bodyfile: str) -> None:
+        try:
+            os.unlink(os.path.join(self.__bodies, bodyfile))
+        except FileNotFoundError:
+            pass
+
+    def __stat(self) -> tuple:
+        stat = os.stat(self.__log)
+        return stat.st_ino, stat.st_size
+
+    def __record(self, offset: int, view=None) -> tuple:
+        view = view if view is not None else self.__map
+        length, crc, op = self.header.unpack_from(view, offset)
+        start = offset + self.header.size
+        return length, op, json.loads(view[start:start + length])
+
+    def __reset(self, generation: bytes) -> None:
+        self.__generation = generation
+        self.__size = len(self.magic) + 16
+        self.__dead = 0
+        self.__offsets = {}
+        self.__bodyfiles = {}
+
+    def __load_index(self) -> None:
+        """Start from the saved index when there is one, otherwise the log is replayed from its beginning"""
+        try:
+            with open(self.__idx, 'r') as fp:
+                index = json.load(fp)
+            self.__generation = bytes.fromhex(index['generation'])
+            self.__size = index['size']
+            self.__dead = index['dead']
+            self.__offsets = index['offsets']
+            self.__bodyfiles = index['bodies']
+            self.__replayed = 0
+        except (OSError, ValueError, KeyError):
+            self.__generation = None
+
+    def __save_index(self) -> None:
+        index = {'generation': self.__generation.hex(),
+                 'size': self.__size,
+                 'dead': self.__dead,
+                 'offsets': self.__offsets,
+                 'bodies': self.__bodyfiles}
+        self.__write_file(self.__idx, json.dumps(index).encode('utf-8'))
+        self.__replayed = 0
+
+    def __create(self, filename: str, records: list) -> None:
+        """Write a new log holding records and rename it over filename"""
+        chunks = [self.magic, uuid.uuid4().bytes]
+        for payload in records:
+            data = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+            chunks.append(self.header.pack(len(data), zlib.crc32(data), self.PUT) + data)
+        self.__write_file(filename, b''.join(chunks))
+
+    def __write_file(self, filename: str, content: bytes) -> None:
+        directory = os.path.dirname(filename)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(content)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(temp, filename)
+        except BaseException:
+            os.unlink(temp)
+            raise
+        dirfd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+
+    @contextlib.contextmanager
+    def __exclusive(self):
+        """Hold the writer lock, in this process and against other processes sharing the directory"""
+        with self.__lock:
+            if self.__lockfile is None:
+                self.__lockfile = os.open(os.path.join(self.__home, 'cert_info.lock'), os.O_RDWR | os.O_CREAT, 0o600)
+            self.__depth += 1
+            try:
+                if self.__depth == 1 and fcntl is not None:
+                    fcntl.flock(self.__lockfile, fcntl.LOCK_EX)
+                yield
+            finally:
+                self.__depth -= 1
+                if self.__depth == 0 and fcntl is not None:
+                    fcntl.flock(self.__lockfile, fcntl.LOCK_UN)
@@ -14,33 +14,184 @@ distributed under the License is distributed on an "AS IS" BASIS,
 WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License."""
+import heapq
 import json
 import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from contextlib import contextmanager
 from datetime import datetime
+from datetime import timedelta
+from fnmatch import fnmatch
 
 import hvac
 import requests
 import validators
 from dynaconf import LazySettings
 from loguru import logger
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from .store_cache import StoreCache
 from .store_engine import StoreEngine
+from .store_index import StoreIndex
 from .store_object import StoreObject
 
 
+class VaultToken:
+    """Caches the AppRole client token for the lifetime of its lease. The token is renewed lazily shortly before it
+    expires and a fresh login is only performed when the lease can not be renewed, its uses are exhausted or Vault
+    rejects it.
+
+    The hvac client sends whatever token it holds when a request runs. A token with unlimited uses is shared by
+    concurrent requests, a token with a use limit (token_num_uses > 0) is held by one request at a time so every
+    use is counted and no thread spends a use another thread was promised."""
+    __client: hvac.Client
+    __token: str          #: Cached client token
+    __expires: float      #: Monotonic time the lease ends, 0 when the lease never ends
+    __renewable: bool     #: Lease can be extended with renew-self
+    __limited: bool       #: The token has a use limit
+    __uses: int           #: Remaining uses of a limited token
+    __fresh: bool         #: The token comes from a login no request has used yet
+
+    def __init__(self, client: hvac.Client, approle: str, secretid: str, renew_before: int = 30) -> None:
+        """Constructor for VaultToken
+
+            :param client: hvac client used to login and renew, its token is kept in sync
+            :type client: hvac.Client
+            :param approle: Application Role ID
+            :type approle: str
+            :param secretid: Application Role Secret ID
+            :type secretid: str
+            :param renew_before: Seconds before the lease ends to renew or login again
+            :type renew_before: int
+        """
+        self.__client = client
+        self.__approle = approle
+        self.__secretid = secretid
+        self.__renew_before = int(renew_before)
+        self.__lock = threading.RLock()
+        self.__token = None
+        self.__expires = 0
+        self.__renewable = False
+        self.__limited = False
+        self.__uses = 0
+        self.__fresh = False
+        self.logins = 0
+        self.renewals = 0
+        self.logins_avoided = 0
+
+    def get(self) -> str:
+        """Return a usable client token, renewing or logging in only when required. No use is spent, requests go
+        through use()
+
+            :return: str
+        """
+        with self.__lock:
+            self.__ensure()
+            return self.__token
+
+    @contextmanager
+    def use(self, renew: bool = False):
+        """Hold a usable token for one request and set it on the hvac client. A limited token stays locked until the
+        request completes and one of its uses is counted.
+
+            :param renew: Discard the cached token first, i.e. after Vault answered 403
+            :type renew: bool
+            :return: contextmanager yielding the token
+        """
+        with self.__lock:
+            if renew:
+                self.__token = None
+            self.__ensure()
+            if self.__fresh:
+                self.__fresh = False
+            else:
+                """Logged in, or renewed, for an earlier request"""
+                self.logins_avoided += 1
+            token = self.__token
+            self.__client.token = token
+            if self.__limited:
+                self.__uses -= 1
+                if self.__uses <= 0:
+                    """Last use handed out, the next request needs a new token"""
+                    self.__token = None
+                yield token
+                return
+        yield token
+
+    def invalidate(self) -> None:
+        """Forget the cached token, i.e. after Vault answered 403"""
+        with self.__lock:
+            self.__token = None
+
+    @property
+    def stats(self) -> dict:
+        """Counters for logins performed, leases renewed and logins avoided by reusing the cached token"""
+        return {'logins': self.logins, 'renewals': self.renewals, 'logins_avoided': self.logins_avoided}
+
+    def __ensure(self) -> None:
+        """Make the cached token usable"""
+        if self.__token is None:
+            self.__login()
+        elif self.__expiring():
+            """renew-self spends a use of a limited token without restoring any, log in again instead"""
+            if self.__limited or not (self.__renewable and self.__renew()):
+                self.__login()
+
+    def __expiring(self) -> bool:
+        return self.__expires > 0 and time.monotonic() >= self.__expires - self.__renew_before
+
+    def __lease(self, auth: dict) -> None:
+        duration = int(auth.get('lease_duration') or 0)
+        self.__expires = time.monotonic() + duration if duration > 0 else 0
+        self.__renewable = bool(auth.get('renewable'))
+
+    def __login(self) -> None:
+        logger.trace(f'Connecting to Vault approle: {self.__approle} secret_id: {self.__secretid}')
+        resp = self.__client.auth_approle(role_id=self.__approle, secret_id=self.__secretid, use_token=True)
+        auth = resp['auth']
+        self.__token = auth['client_token']
+        self.__uses = int(auth.get('num_uses') or 0)
+        self.__limited = self.__uses > 0
+        self.__lease(auth)
+        self.__fresh = True
+        self.logins += 1
+        logger.trace(f'client_token: {self.__token}')
+
+    def __renew(self) -> bool:
+        self.__client.token = self.__token
+        try:
+            resp = self.__client.auth.token.renew_self()
+        except hvac.exceptions.VaultError as err:
+            logger.debug(f'Unable to renew Vault token, logging in again: {err}')
+            return False
+        self.__lease(resp['auth'])
+        self.renewals += 1
+        return True
+
+
 class VaultClient:
     """Client commands not available via hvac"""
 
     __vault_client: hvac.Client
+    __tokens: VaultToken
 
-    __headers = {'Content-Type': 'application/json',
-                 'X-Vault-Token': ''}
+    __headers: dict       #: Headers for raw REST API calls
     __url: str            #: Vault server URL
     __token: str          #: Auth token
     __approle: str        #: Application Role ID
     __secretid: str       #: Application Role Secret ID
     __mount: str          #: Engine mount path
     __mounts: json        #: Map of Vault mounts
+    __session: requests.Session  #: Connection pool shared by hvac and the raw REST helpers
+    __timeout: float      #: Seconds to wait on Vault before giving up on a request
+    __search_workers: int  #: Concurrent requests while walking the tree
+    __read_pool: ThreadPoolExecutor  #: Reads the secrets of an object side by side
+    __policies: set       #: Policy names known to exist, listed once per session
 
     match = 'False'
 
@@ -51,9 +202,51 @@ class VaultClient:
         self.__secretid = settings.VAULT_SECRET_ID
         self.__mount = settings.VAULT_MOUNT
         self.__mounts = {}
-        self.__vault_client = hvac.Client(url=self.__url)
+        self.__headers = {'Content-Type': 'application/json',
+                          'X-Vault-Token': ''}
+        self.__timeout = float(settings.get('VAULT_TIMEOUT', 30))
+        self.__search_workers = int(settings.get('VAULT_SEARCH_WORKERS', 8))
+        self.__read_pool = ThreadPoolExecutor(max_workers=int(settings.get('VAULT_READ_WORKERS', 8)))
+        self.__policies = None
+        self.__policy_lock = threading.Lock()
+        self.__session = self.new_session(settings)
+        self.__vault_client = hvac.Client(url=self.__url, session=self.__session, timeout=self.__timeout)
+        self.__tokens = VaultToken(self.__vault_client,
+                                   approle=self.__approle,
+                                   secretid=self.__secretid,
+                                   renew_before=settings.get('VAULT_TOKEN_RENEW_BEFORE', 30))
         self.__settings = settings
 
+    @staticmethod
+    def new_session(settings: LazySettings) -> requests.Session:
+        """Build the keep-alive connection pool used for all Vault traffic. Idempotent requests are retried with an
+        exponential backoff when Vault or its load balancer is briefly unavailable.
+
+            KNOX_VAULT_POOL_SIZE    Connections kept open per Vault host
+            KNOX_VAULT_RETRIES      Retries on connection errors and 5xx responses
+            KNOX_VAULT_BACKOFF      Backoff factor in seconds between retries
+
+            :param settings: Dynaconf settings
+            :type settings: LazySettings
+            :return: requests.Session
+        """
+        pool_size = int(settings.get('VAULT_POOL_SIZE', 10))
+        retry_args = {'total': int(settings.get('VAULT_RETRIES', 3)),
+                      'backoff_factor': float(settings.get('VAULT_BACKOFF', 0.3)),
+                      'status_forcelist': (500, 502, 503, 504),
+                      'raise_on_status': False}
+        methods = frozenset(['HEAD', 'GET', 'PUT', 'DELETE', 'OPTIONS', 'TRACE', 'LIST'])
+        try:
+            retries = Retry(allowed_methods=methods, **retry_args)
+        except TypeError:
+            """urllib3 < 1.26"""
+            retries = Retry(method_whitelist=methods, **retry_args)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
     def initialize(self) -> bool:
         """During initialization, if in admin mode, ensure the kv mount point has been registered with Vault. To enable
         admin mode use the hidden param --admin with any command.
@@ -65,15 +258,18 @@ class VaultClient:
         else:
             return self.connect()
 
-    def connect(self) -> bool:
-        """Knox uses an approle scheme to authenticate with Vault. This requires fetching a fresh, short lived, API
-        token for every call to the API."""
+    def connect(self, force: bool = False) -> bool:
+        """Knox uses an approle scheme to authenticate with Vault. The short lived API token is cached by VaultToken
+        and only renewed or fetched again when it is about to expire, or when force is set after Vault rejected it.
+
+            :param force: Discard the cached token and login again
+            :type force: bool
+            :return: Boolean
+        """
         try:
-            logger.trace(f'Connecting to Vault approle: {self.__approle} secret_id: {self.__secretid}')
-            resp = self.__vault_client.auth_approle(role_id=self.__approle, secret_id=self.__secretid, use_token=True)
-            self.__token = resp['auth']['client_token']
-            logger.trace(f'client_token: {self.__token}')
-            self.__headers['X-Vault-Token'] = self.__token
+            if force:
+                self.__tokens.invalidate()
+            self.__token = self.__tokens.get()
         except requests.exceptions.ConnectionError as err:
             logger.error(f'Failed to connect to {self.__url}: {err}')
             sys.exit(2)
@@ -95,8 +291,55 @@ class VaultClient:
     def token(self) -> str:
         return self.__token
 
+    @property
+    def token_stats(self) -> dict:
+        return self.__tokens.stats
+
     def logout(self) -> bool:
-        return self.__vault_client.logout()
+        logger.debug(f'Vault token usage {self.__tokens.stats}')
+        self.__tokens.invalidate()
+        self.__vault_client.logout()
+        self.__read_pool.shutdown(wait=False)
+        self.__session.close()
+        return True
+
+    def _call(self, method, *args, **kwargs):
+        """Invoke an hvac method with the cached token, logging in again once if Vault rejects the token
+
+            :param method: Bound hvac client method
+            :type method: callable
+            :return: The hvac response
+        """
+        self.connect()
+        with self.__tokens.use():
+            try:
+                return method(*args, **kwargs)
+            except hvac.exceptions.Forbidden:
+                logger.debug('Vault token rejected, logging in again')
+        with self.__tokens.use(renew=True):
+            return method(*args, **kwargs)
+
+    def _request(self, method: str, path: str, data: json = None) -> requests.Response:
+        """Issue a raw REST API call with the cached token, logging in again once on 403
+
+            :param method: HTTP verb
+            :type method: str
+            :param path: Vault API path
+            :type path: str
+            :param data: Optional request body
+            :type data: JSON
+            :return: requests.Response object
+        """
+        self.connect()
+        for renew in (False, True):
+            with self.__tokens.use(renew=renew) as token:
+                response = self.__session.request(method, url=f'{self.__url}{path}', data=data, timeout=self.__timeout,
+                                                  headers=dict(self.__headers, **{'X-Vault-Token': token}))
+            if response.status_code != 403:
+                break
+            logger.debug('Vault token rejected, logging in again')
+        response.raise_for_status()
+        return response
 
     def _get(self, path: str) -> json:
         """GET REST API wrapper method
@@ -106,10 +349,7 @@ class VaultClient:
             :return: JSON paylod
         """
         try:
-            """Connect refreshes the temp Vault auth token"""
-            self.connect()
-            response = requests.get(url=f'{self.__url}{path}', headers=self.__headers)
-            response.raise_for_status()
+            response = self._request('GET', path)
 
             return json.loads(response.content.decode('utf-8'))
 
@@ -132,10 +372,7 @@ class VaultClient:
             :return: requests.Response object
         """
         try:
-            """Connect refreshes the temp Vault auth token"""
-            self.connect()
-            response = requests.post(url=f'{self.__url}{path}', headers=self.__headers, data=data)
-            response.raise_for_status()
+            response = self._request('POST', path, data)
 
             return json.loads(response.content.decode('utf-8'))
 
@@ -158,10 +395,7 @@ class VaultClient:
             :return: requests.Response object
         """
         try:
-            """Connect refreshes the temp Vault auth token"""
-            self.connect()
-            response = requests.put(url=f'{self.__url}{path}', headers=self.__headers, data=data)
-            response.raise_for_status()
+            response = self._request('PUT', path, data)
 
             return response
 
@@ -197,52 +431,49 @@ class VaultClient:
             self.__mounts = self._get("/v1/sys/mounts")
         return bool(self.__mounts)
 
-    def upsert(self, obj: StoreObject) -> bool:
+    @staticmethod
+    def object_path(obj: StoreObject) -> str:
+        """Path of the object below the mount, client certificates are kept below client/"""
+        if validators.domain(obj.name):
+            return obj.path_name
+        return f'client/{obj.name}/{obj.type}'
+
+    def upsert(self, obj: StoreObject, force: bool = False) -> bool:
         """Given a StoreObject create or update it into Vault. Metadata and content are stored separately to allow
-        querying of non sensitive details.
+        querying of non sensitive details. Objects identical to the stored version are not written again, so the
+        KV version history only records real changes.
 
             :param obj: The object to store
             :type obj: StoreObject
+            :param force: Write even when the stored version is identical
+            :type force: bool
             :return: Boolean
         """
         client = self.__vault_client
-        if validators.domain(obj.name):
-            mp = self.mount
-            op = obj.path_name
-        else:
-            mp = f'{self.mount}'
-            op = f'client/{obj.name}/{obj.type}'
+        mp = self.mount
+        op = self.object_path(obj)
 
         policyname = ""
 
         try:
-            self.connect()
+            if not force and self.unchanged(mp, op, obj):
+                logger.info(f'Skipped {op}, identical to the stored version')
+                """The read policy may have been removed since the certificate was stored"""
+                policyname = self.ensure_policy(obj, op)
+                return True
+
             logger.trace(f'updating secret {mp}/{op}/cert_body')
-            client.secrets.kv.v2.create_or_update_secret(path=f'{op}/cert_body',
-                                                         mount_point=mp,
-                                                         secret=obj.data['cert_body'])
+            self._call(client.secrets.kv.v2.create_or_update_secret,
+                       path=f'{op}/cert_body',
+                       mount_point=mp,
+                       secret=obj.data['cert_body'])
 
-            self.connect()
             logger.trace(f'updating secret {mp}/{op}/cert_info')
-            client.secrets.kv.v2.create_or_update_secret(path=f'{op}/cert_info',
-                                                         mount_point=mp,
-                                                         secret=obj.data['cert_info'])
-            self.connect()
-            list_policies_resp = client.sys.list_policies()['data']['policies']
-            if 'commonName' in obj.data['cert_info']['subject']:
-                commonname = obj.data['cert_info']['subject']['commonName']
-            else:
-                commonname = obj.name
-
-            policyname = f'knox-read-{commonname}'
-            if policyname in list_policies_resp:
-                pass
-            else:
-                policy = obj.data['cert_policy']
-                logger.debug(f'Creating explict read access policy {policyname} for {op}/cert_body')
-                logger.trace(f'{self.__class__}::upsert {policyname}:\n{policy}')
-                self.connect()
-                client.sys.create_or_update_policy(name=policyname, policy=policy)
+            self._call(client.secrets.kv.v2.create_or_update_secret,
+                       path=f'{op}/cert_info',
+                       mount_point=mp,
+                       secret=obj.data['cert_info'])
+            policyname = self.ensure_policy(obj, op)
 
         except hvac.exceptions.Forbidden as ve:
             policyphrase = ""
@@ -269,8 +500,89 @@ class VaultClient:
             logger.info(f'Successfully stored {op} and {policyname}')
             return True
 
+    def ensure_policy(self, obj: StoreObject, op: str) -> str:
+        """Create the explicit read access policy of obj when it does not exist
+
+            :param obj: The stored object
+            :type obj: StoreObject
+            :param op: Store path of obj, see object_path
+            :type op: str
+            :return: str policy name
+        """
+        if 'commonName' in obj.data['cert_info']['subject']:
+            commonname = obj.data['cert_info']['subject']['commonName']
+        else:
+            commonname = obj.name
+
+        policyname = f'knox-read-{commonname}'
+        if not self.has_policy(policyname):
+            policy = obj.data['cert_policy']
+            logger.debug(f'Creating explict read access policy {policyname} for {op}/cert_body')
+            logger.trace(f'{self.__class__}::upsert {policyname}:\n{policy}')
+            self._call(self.__vault_client.sys.create_or_update_policy, name=policyname, policy=policy)
+            self.__policies.add(policyname)
+        return policyname
+
+    def has_policy(self, name: str) -> bool:
+        """Whether the policy exists. All policy names are listed once per session and remembered, names missing
+        from that list are confirmed by reading the single policy, it may have been created since. The shipped admin
+        policy only grants update on sys/policy/*, a forbidden read counts as missing and the policy is written.
+
+            :param name: Policy name
+            :type name: str
+            :return: bool
+        """
+        client = self.__vault_client
+        with self.__policy_lock:
+            if self.__policies is None:
+                try:
+                    self.__policies = set(self._call(client.sys.list_policies)['data']['policies'])
+                except hvac.exceptions.Forbidden:
+                    logger.debug('Not allowed to list policies, reading them one at a time')
+                    self.__policies = set()
+        if name in self.__policies:
+            return True
+        try:
+            self._call(client.sys.read_policy, name=name)
+        except hvac.exceptions.InvalidPath:
+            return False
+        except hvac.exceptions.Forbidden:
+            logger.debug(f'Not allowed to read policy {name}, treating it as missing')
+            return False
+        self.__policies.add(name)
+        return True
+
+    def unchanged(self, mount: str, path: str, obj: StoreObject) -> bool:
+        """True when the object stored at path holds the same cert_body and cert_info as obj. The stored cert_info
+        is read first, a different certificate fingerprint settles it without reading the private cert_body.
+
+            :param mount: KV mount
+            :type mount: str
+            :param path: Path of the object, holding cert_body and cert_info
+            :type path: str
+            :param obj: The object about to be written
+            :type obj: StoreObject
+            :return: bool
+        """
+        read = self.__vault_client.secrets.kv.v2.read_secret_version
+        try:
+            stored_info = self._call(read, path=f'{path}/cert_info', mount_point=mount)['data']['data']
+        except hvac.exceptions.InvalidPath:
+            return False
+        fingerprint = obj.data['cert_info'].get('key_details', {}).get('fingerprint_sha256')
+        if fingerprint != stored_info.get('key_details', {}).get('fingerprint_sha256'):
+            return False
+        if StoreObject.md5(stored_info) != StoreObject.md5(obj.data['cert_info']):
+            return False
+        try:
+            stored_body = self._call(read, path=f'{path}/cert_body', mount_point=mount)['data']['data']
+        except hvac.exceptions.InvalidPath:
+            return False
+        return StoreObject.md5(stored_body) == StoreObject.md5(obj.data['cert_body'])
+
     def read(self, path: str, name: str, type: str = None) -> tuple:
-        """Given a path and name retrieve a tuple of dictionaries to create a StoreObject
+        """Given a path and name retrieve a tuple of dictionaries to create a StoreObject, both are requested
+        at the same time
             cert_body
             cert_info
 
@@ -290,13 +602,15 @@ class VaultClient:
             fullpathinfo = f'{path}/{name}/cert_info'
 
         try:
-            self.connect()
             logger.trace(f'Attempting to read \n\tbody:{fullpathbody}\n\tinfo:{fullpathinfo}')
             logger.trace(f'client.url: {client.url}')
             logger.trace(f'mount: {self.mount}')
-            certbody = client.secrets.kv.v2.read_secret_version(path=fullpathbody, mount_point=self.mount)
-            self.connect()
-            certinfo = client.secrets.kv.v2.read_secret_version(path=fullpathinfo, mount_point=self.mount)
+            body = self.__read_pool.submit(self._call, client.secrets.kv.v2.read_secret_version,
+                                           path=fullpathbody, mount_point=self.mount)
+            try:
+                certinfo = self._call(client.secrets.kv.v2.read_secret_version, path=fullpathinfo, mount_point=self.mount)
+            finally:
+                certbody = body.result()
             return certbody, certinfo
 
         except hvac.exceptions.Forbidden as ve:
@@ -309,8 +623,30 @@ class VaultClient:
             logger.error(f'Credentials not authorized to read {path}/{name}: {ve}')
             sys.exit(2)
 
+    def versions(self, path: str, name: str, type: str = None) -> tuple:
+        """Current KV versions of the cert_body and cert_info of an object, read from their metadata only
+
+            :param path: The path where the StoreObjects data is stored
+            :type path: str
+            :param name: Name of the StoreObject
+            :type name: str
+            :param type: The type of StoreObject i.e. PEM
+            :type type: str
+            :return: tuple of (body version, info version)
+        """
+        client = self.__vault_client
+        fullpath = f'{path}/{name}/{type}' if type else f'{path}/{name}'
+        body = self.__read_pool.submit(self._call, client.secrets.kv.v2.read_secret_metadata,
+                                       path=f'{fullpath}/cert_body', mount_point=self.mount)
+        try:
+            info = self._call(client.secrets.kv.v2.read_secret_metadata, path=f'{fullpath}/cert_info', mount_point=self.mount)
+        finally:
+            body = body.result()
+        return body['data']['current_version'], info['data']['current_version']
+
     def search(self, rootpath: str, rootkey: str, searchresults: list, pattern: str = None) -> list:
-        """Search for 'cert_info' for a given vault path
+        """Search for 'cert_info' for a given vault path. Sub trees are listed and read concurrently, at most
+        KNOX_VAULT_SEARCH_WORKERS requests in flight, results are returned in depth first tree order.
 
             :param rootpath: Beginning search path
             :type rootpath: str
@@ -322,77 +658,186 @@ class VaultClient:
             :type pattern: str
             :return: list
         """
+        searchresults.extend(self.iter_search(rootpath=rootpath, pattern=pattern))
+        return searchresults
+
+    def iter_search(self, rootpath: str, pattern: str = None):
+        """Same as search, yielding each result as soon as it is known. Closing the generator stops the walk.
+
+            :param rootpath: Beginning search path
+            :type rootpath: str
+            :param pattern: Unaltered search pattern
+            :type pattern: str
+            :return: generator of dict
+        """
+        for _, path, cert_info in self._crawl(rootpath=rootpath, leaf=self._read_info):
+            result = self.search_result(path, cert_info, pattern)
+            if result is not None:
+                yield result
+
+    def refresh_index(self, index: StoreIndex, rootpath: str = '/') -> dict:
+        """Synchronize a StoreIndex with the tree below rootpath. Only the KV metadata of each 'cert_info' is read,
+        the document itself is fetched again only when its current_version differs from the indexed one.
+
+            :param index: The index to update
+            :type index: StoreIndex
+            :param rootpath: Beginning search path
+            :type rootpath: str
+            :return: dict of counters
+        """
+        known = index.versions()
+        seen = set()
+        stats = {'unchanged': 0, 'updated': 0, 'removed': 0}
+
+        def leaf(path: str) -> tuple:
+            metadata = self._call(self.__vault_client.secrets.kv.v2.read_secret_metadata,
+                                  path=path + 'cert_info',
+                                  mount_point=self.mount)['data']
+            version = metadata['current_version']
+            if known.get(path) == version:
+                return version, metadata['updated_time'], None
+            return version, metadata['updated_time'], self._read_info(path, version)
+
+        for _, path, (version, updated_time, cert_info) in self._crawl(rootpath=rootpath, leaf=leaf):
+            seen.add(path)
+            if cert_info is None:
+                stats['unchanged'] += 1
+            else:
+                index.upsert(path, version, updated_time, cert_info)
+                stats['updated'] += 1
+
+        prefix = rootpath.replace('//', '/')
+        gone = [path for path in known if path.startswith(prefix) and path not in seen]
+        index.remove(gone)
+        stats['removed'] = len(gone)
+        if prefix == '/':
+            index.touch()
+        logger.debug(f'Store index refreshed {stats}')
+        return stats
+
+    def search_index(self, index: StoreIndex, rootpath: str = None, pattern: str = None) -> list:
+        """Search an already refreshed StoreIndex instead of Vault, same results as search
+
+            :param index: The index to query
+            :type index: StoreIndex
+            :param rootpath: Only entries below this path
+            :type rootpath: str
+            :param pattern: Unaltered search pattern
+            :type pattern: str
+            :return: list
+        """
+        text = pattern if pattern and pattern != '*' else None
+        results = [self.search_result(path, cert_info, pattern or '*')
+                   for path, cert_info in index.find(prefix=rootpath, text=text)]
+        return [result for result in results if result is not None]
+
+    def _crawl(self, rootpath: str, leaf):
+        """Walk the tree below rootpath with a bounded pool of workers, calling leaf on every node holding a
+        'cert_info' and yielding (order, path, value). order is the position of the node in a depth first walk and
+        values are yielded in that order, each one as soon as every node before it has been visited.
+
+            :param rootpath: Beginning search path
+            :type rootpath: str
+            :param leaf: Called with the path of each certificate node, runs on the worker
+            :type leaf: callable
+            :return: generator of (tuple, str, object)
+        """
+        pool = ThreadPoolExecutor(max_workers=self.__search_workers)
+        rootpath = rootpath.replace('//', '/')
+        pending = {pool.submit(self._visit, rootpath, leaf): ((), rootpath)}
+        ready = []
         try:
-            client = self.__vault_client
-            self.connect()
-            rootpath = rootpath.replace('//', '/')
-            logger.trace(f'Searching {rootpath}')
-            secrets = client.secrets.kv.list_secrets(path=rootpath, mount_point=self.mount)
-            secrets_keys = secrets.get('data').get('keys')
-            if isinstance(secrets_keys, list):
-                if 'cert_info' not in secrets_keys:
-                    for key in secrets_keys:
-                        subpaths = rootpath + key
-                        self.search(rootpath=subpaths, rootkey=key, pattern=pattern, searchresults=searchresults)
-                else:
-                    cert_info_path = rootpath + "cert_info"
-                    cert_common_name = rootpath.split('/')[-3]
-                    self.connect()
-                    cert_info = client.secrets.kv.v2.read_secret_version(path=cert_info_path,
-                                                                         mount_point=self.mount)['data']['data']
-                    cert_info_str = json.dumps(cert_info)
-
-                    logger.trace(f'does {pattern} match {cert_info_str}')
-                    if len(cert_info.keys()) > 0 and (pattern == "*" or cert_info_str.find(pattern) > 0):
-                        logger.trace(f'yes, {pattern} matches {cert_info_str}')
-                        current_date = datetime.now()
-                        cert_expiry_date = datetime.strptime(cert_info['validity']['not_valid_after'],
-                                                             '%Y-%m-%d %H:%M:%S')
-                        days_to_expire = cert_expiry_date - current_date
-                        results_dict = {'common_name': cert_common_name,
-                                        'vault_cert_path': f'/{self.mount}{rootpath}',
-                                        'cert_issue_date': cert_info['validity']['not_valid_before'],
-                                        'cert_expiry_date': cert_info['validity']['not_valid_after'],
-                                        'days_to_expire': days_to_expire.days
-                                        }
-                        if 'commonName' in cert_info['issuer']:
-                            results_dict['issuer'] = cert_info['issuer']['commonName']
-                        else:
-                            results_dict['issuer'] = ""
-
-                        if 'alternativeNames' in cert_info['subject']:
-                            results_dict['alternativeNames'] = cert_info['subject']['alternativeNames']
-                        else:
-                            results_dict['alternativeNames'] = ""
-
-                        searchresults.append(results_dict)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    order, path = pending.pop(future)
+                    try:
+                        keys, value = future.result()
+                    except requests.exceptions.ConnectionError as ve:
+                        logger.error(f'Failed to connect to {self.__url}: {ve}')
+                        sys.exit(2)
+                    except hvac.exceptions.Forbidden as ve:
+                        logger.error(f'Permission denied for reading from {path}: {ve}')
+                        sys.exit(2)
+                    except hvac.exceptions.InvalidPath as ve:
+                        if not order:
+                            logger.debug(f'Nothing stored below {path}')
+                            return
+                        logger.error(f'Path not found for {path}: {ve}')
+                        sys.exit(2)
+                    except hvac.exceptions.Unauthorized as ve:
+                        logger.error(f'Credentials not authorized to access {path}: {ve}')
+                        sys.exit(2)
+                    if 'cert_info' in keys:
+                        heapq.heappush(ready, (order, path, value))
                     else:
-                        logger.trace(f'no, {pattern} not found {cert_info_path}')
-        except requests.exceptions.ConnectionError as ve:
-            logger.error(f'Failed to connect to {self.__url}: {ve}')
-            sys.exit(2)
-        except hvac.exceptions.Forbidden as ve:
-            logger.error(f'Permission denied for reading from {rootpath}: {ve}')
-            sys.exit(2)
-        except hvac.exceptions.InvalidPath as ve:
-            logger.error(f'Path not found for {rootpath}: {ve}')
-            sys.exit(2)
-        except hvac.exceptions.Unauthorized as ve:
-            logger.error(f'Credentials not authorized to access {rootpath}: {ve}')
-            sys.exit(2)
-        else:
-            return searchresults
+                        for index, key in enumerate(keys):
+                            pending[pool.submit(self._visit, path + key, leaf)] = (order + (index,), path + key)
+                """Nodes still pending, and their descendants, come after the first of them in the walk"""
+                first = min(order for order, _ in pending.values()) if pending else None
+                while ready and (first is None or ready[0][0] < first):
+                    yield heapq.heappop(ready)
+        finally:
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=False)
+
+    def _visit(self, path: str, leaf) -> tuple:
+        """List a single node, when it holds a certificate hand its path to leaf
+
+            :param path: Vault path of the node
+            :type path: str
+            :param leaf: Called with the path of a certificate node
+            :type leaf: callable
+            :return: tuple of (keys, value), value is None for intermediate nodes
+        """
+        logger.trace(f'Searching {path}')
+        secrets = self._call(self.__vault_client.secrets.kv.list_secrets, path=path, mount_point=self.mount)
+        secrets_keys = secrets.get('data').get('keys')
+        if not isinstance(secrets_keys, list):
+            return [], None
+        if 'cert_info' not in secrets_keys:
+            return secrets_keys, None
+        return secrets_keys, leaf(path)
+
+    def _read_info(self, path: str, version: int = None) -> dict:
+        """Read the 'cert_info' of the certificate node at path"""
+        return self._call(self.__vault_client.secrets.kv.v2.read_secret_version,
+                          path=path + "cert_info",
+                          version=version,
+                          mount_point=self.mount)['data']['data']
+
+    def search_result(self, path: str, cert_info: dict, pattern: str = None) -> dict:
+        """Build the search result for a certificate when its info matches the pattern
+
+            :param path: Vault path of the certificate, i.e. /com/example/www/www.example.com/PEM/
+            :type path: str
+            :param cert_info: The certificates 'cert_info' secret
+            :type cert_info: dict
+            :param pattern: Unaltered search pattern
+            :type pattern: str
+            :return: dict or None
+        """
+        return StoreEngine.search_result(path.split('/')[-3], 'vault_cert_path', f'/{self.mount}{path}', cert_info, pattern)
 
 
 class VaultStoreEngine(StoreEngine):
     """Vault implementation of the StoreEngine interface"""
     __client: VaultClient
+    __cache: StoreCache   #: Optional read-through cache of objects read, KNOX_CACHE_SIZE / KNOX_CACHE_PATH
+    __index: StoreIndex   #: Optional local index of cert_info, KNOX_INDEX_PATH
+    __index_ttl: float    #: Seconds before the index is synchronized with Vault again
 
     def __init__(self, settings) -> None:
         """Constructor for VaultStoreEngine"""
         super().__init__()
         self._settings = settings
         self.__client = VaultClient(settings)
+        self.__index = None
+        self.__index_ttl = float(settings.get('INDEX_TTL', 300))
+        if settings.get('INDEX_PATH'):
+            self.__index = StoreIndex(settings.INDEX_PATH, store=f'{self.__client.url}/{self.__client.mount}')
+        self.__cache = StoreCache.from_settings(settings, store=f'{self.__client.url}/{self.__client.mount}')
         logger.debug(f'🔐 Vault backend configuration loaded. {self.__client.url}')
         if self.initialize():
             logger.debug("🔐 Vault backend initialized.")
@@ -409,23 +854,40 @@ class VaultStoreEngine(StoreEngine):
 
     def close(self) -> bool:
         """Ensure we close the vault connection"""
+        if self.__cache:
+            logger.debug(f'Store cache usage {self.__cache.stats}')
         return self.__client.logout()
 
+    @property
+    def cache_stats(self) -> dict:
+        """Read-through cache counters, empty when caching is off"""
+        return self.__cache.stats if self.__cache else {}
+
     def __del__(self):
         """When the object is destroyed make sure we close the connection to Vault"""
         return self.close()
 
-    def write(self, obj: StoreObject) -> bool:
+    def write(self, obj: StoreObject, force: bool = False) -> bool:
         """Given a StoreObject, store it into vault using mount/path/name == body,info
 
             :param obj: The StoreObject to persist
             :type obj: StoreObject
+            :param force: Write even when Vault already holds the same object
+            :type force: bool
             :return: bool
         """
-        return self.__client.upsert(obj)
+        if self.__cache:
+            self.__cache.discard(obj.path_name)
+        written = self.__client.upsert(obj, force=force)
+        self.discard_san()
+        if written and self.__index is not None:
+            """Other processes trust the index until KNOX_INDEX_TTL, bring the written entry up to date now"""
+            self.__client.refresh_index(self.__index, rootpath=f'/{self.__client.object_path(obj).strip("/")}/')
+        return written
 
     def read(self, path: str, name: str, type=None) -> StoreObject:
-        """Using the provided path and name retrieve the data from the store and create a new StoreObject
+        """Using the provided path and name retrieve the data from the store and create a new StoreObject.
+        With a cache configured, cached objects are returned while their KV versions are current.
 
             :param path: Store path to the object
             :type path: str
@@ -436,15 +898,7 @@ class VaultStoreEngine(StoreEngine):
             :return: StoreObject
         """
         try:
-            certbody, certinfo = self.__client.read(path, name, type)
-            cert = StoreObject(name=name,
-                               path=path,
-                               body=certbody['data']['data'],
-                               info=certinfo['data']['data'],
-                               type=type)
-            cert._data = {'cert_body': certbody['data']['data'],
-                          'cert_info': certinfo['data']['data']}
-
+            cert = self.__fetch(path, name, type)
         except Exception as vex:
             logger.error(f'Failed to read StoreObject /{self.__client.mount}{path}/{name} {vex}')
             sys.exit(2)
@@ -452,13 +906,136 @@ class VaultStoreEngine(StoreEngine):
             logger.info(f' Successfully read {cert.path_name}')
             return cert
 
-    def find(self, pattern) -> list:
-        """Search certificate info for a given search pattern
+    def read_many(self, items) -> list:
+        """Read many objects, at most KNOX_VAULT_READ_WORKERS at a time. Objects that could not be read are
+        logged and returned as None so one missing certificate does not stop the others.
+
+            :param items: (path, name, type) of each object
+            :type items: iterable
+            :return: list of StoreObject, in the order of items
+        """
+        def fetch(item):
+            path, name, type = item
+            try:
+                return self.__fetch(path, name, type)
+            except SystemExit:
+                """VaultClient.read already logged why"""
+                return None
+            except Exception as vex:
+                logger.error(f'Failed to read StoreObject /{self.__client.mount}{path}/{name} {vex}')
+                return None
+
+        with ThreadPoolExecutor(max_workers=int(self._settings.get('VAULT_READ_WORKERS', 8))) as pool:
+            return list(pool.map(fetch, items))
+
+    def __fetch(self, path: str, name: str, type=None) -> StoreObject:
+        key = f'{path}/{name}/{type}' if type else f'{path}/{name}'
+        cached = None
+        if self.__cache:
+            cached = self.__cache.get(key, versions=lambda: self.__client.versions(path, name, type))
+        if cached:
+            _, body, info = cached
+        else:
+            certbody, certinfo = self.__client.read(path, name, type)
+            body, info = certbody['data']['data'], certinfo['data']['data']
+            if self.__cache:
+                self.__cache.put(key,
+                                 (certbody['data']['metadata']['version'], certinfo['data']['metadata']['version']),
+                                 body,
+                                 info)
+        cert = StoreObject(name=name,
+                           path=path,
+                           body=body,
+                           info=info,
+                           type=type)
+        cert._data = {'cert_body': body,
+                      'cert_info': info}
+        return cert
+
+    def find(self, pattern, live: bool = False) -> list:
+        """Search certificate info for a given search pattern. Domain patterns only walk the matching reverse DNS
+        sub tree, anything else is matched against every 'cert_info' in the mount. When KNOX_INDEX_PATH is set the
+        search is answered from the local index unless live is requested.
 
             :param pattern: Search glob pattern
                 ex: *, abc.8x8.com, abc.8x8.com/*, 8x8.com/*
             :type pattern: str
+            :param live: Ignore the local index and search Vault
+            :type live: bool
 
             :return: list
         """
-        return self.__client.search(rootpath='/', rootkey="", pattern=pattern, searchresults=[])
+        return list(self.iterfind(pattern, live=live))
+
+    def iterfind(self, pattern, live: bool = False):
+        """Generator version of find, results are yielded as the tree is walked
+
+            :param pattern: Search glob pattern
+            :type pattern: str
+            :param live: Ignore the local index and search Vault
+            :type live: bool
+            :return: generator of dict
+        """
+        rootpath, glob = self.search_path(pattern)
+        if self.__index is not None and not live:
+            self.refresh()
+            results = self.__client.search_index(self.__index, rootpath=rootpath, pattern=None if rootpath else pattern)
+        elif rootpath is None:
+            results = self.__scan(pattern)
+        else:
+            logger.debug(f'Searching {pattern} below {rootpath}')
+            results = self.__client.iter_search(rootpath=rootpath, pattern="*")
+        for result in results:
+            if not glob or fnmatch(result['common_name'].lower(), glob.lower()):
+                yield result
+
+    def __scan(self, pattern: str):
+        """Full tree search, a complete scan of every certificate also rebuilds the in memory SAN index"""
+        scanned = []
+        for result in self.__client.iter_search(rootpath='/', pattern=pattern):
+            scanned.append(result)
+            yield result
+        if pattern == '*':
+            self.index_san(scanned, 'vault_cert_path')
+
+    def subjectaltfind(self, pattern: str, live: bool = False) -> list:
+        """Find the certificates listing pattern as a subject alternative name
+
+            :param pattern: DNS name
+            :type pattern: str
+            :param live: Ignore the local index and search Vault
+            :type live: bool
+            :return: list
+        """
+        if self.__index is None or live:
+            return self.san_lookup(pattern, lambda: self.find('*', live=True), self.__index_ttl, live=live)
+        self.refresh()
+        return [self.__client.search_result(path, cert_info, '*') for path, cert_info in self.__index.subjectaltfind(pattern)]
+
+    def expiring(self, days: int, live: bool = False) -> list:
+        """Certificates expiring within the given number of days, soonest first
+
+            :param days: Size of the window from now
+            :type days: int
+            :param live: Ignore the local index and search Vault
+            :type live: bool
+            :return: list
+        """
+        if self.__index is None or live:
+            results = self.__client.search(rootpath='/', rootkey="", pattern='*', searchresults=[])
+            return sorted([result for result in results if result['days_to_expire'] < days],
+                          key=lambda result: result['cert_expiry_date'])
+        self.refresh()
+        before = (datetime.now() + timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+        return [self.__client.search_result(path, cert_info, '*') for path, cert_info in self.__index.expiring(before)]
+
+    def refresh(self, force: bool = False) -> dict:
+        """Synchronize the local index with Vault once it is older than KNOX_INDEX_TTL seconds
+
+            :param force: Refresh regardless of the index age
+            :type force: bool
+            :return: dict of counters, empty when nothing was refreshed
+        """
+        if self.__index is None or not (force or self.__index.age() > self.__index_ttl):
+            return {}
+        return self.__client.refresh_index(self.__index)
@@ -0,0 +1,361 @@
+"""
+Apache Software License 2.0
+
+Copyright (c) 2020, 8x8, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License."""
+import asyncio
+from datetime import datetime
+from datetime import timedelta
+from fnmatch import fnmatch
+
+import aiohttp
+import hvac
+import validators
+from loguru import logger
+
+from .store_async import AsyncStoreEngine
+from .store_object import StoreObject
+
+
+class AsyncVaultStoreEngine(AsyncStoreEngine):
+    """Vault implementation of the AsyncStoreEngine interface, KNOX_STORE_ENGINE=vault-async. Talks to the KV v2
+    REST API with aiohttp (pip install knox[async]), up to KNOX_VAULT_ASYNC_CONCURRENCY requests in flight on a
+    single thread. Stores the same layout, policies and find results as VaultStoreEngine.
+
+    KNOX_VAULT_RETRIES, KNOX_VAULT_BACKOFF and KNOX_VAULT_TIMEOUT apply as they do to VaultStoreEngine. There is no
+    local index or read-through cache, KNOX_INDEX_PATH and KNOX_CACHE_* are not used: every find walks Vault, so live
+    only matters to subjectaltfind, whose SAN index follows KNOX_INDEX_TTL.
+    """
+    retry_status = (500, 502, 503, 504)
+    __session: aiohttp.ClientSession
+    __token: str
+    __policies: set       #: Policy names known to exist, listed once per session
+
+    def __init__(self, settings) -> None:
+        """Constructor for AsyncVaultStoreEngine"""
+        super().__init__()
+        self._settings = settings
+        self.__url = settings.VAULT_URL.rstrip('/')
+        self.__mount = settings.VAULT_MOUNT
+        self.__approle = settings.VAULT_APPROLE
+        self.__secretid = settings.VAULT_SECRET_ID
+        self.__timeout = float(settings.get('VAULT_TIMEOUT', 30))
+        self.__concurrency = int(settings.get('VAULT_ASYNC_CONCURRENCY', 100))
+        self.__index_ttl = float(settings.get('INDEX_TTL', 300))
+        self.__retries = int(settings.get('VAULT_RETRIES', 3))
+        self.__backoff = float(settings.get('VAULT_BACKOFF', 0.3))
+        self.__session = None
+        self.__token = None
+        self.__policies = None
+        logger.debug(f'🔐 Async Vault backend configuration loaded. {self.__url}')
+
+    async def open(self) -> bool:
+        """Create the connection pool and log in, within the running event loop"""
+        if self.__session is None:
+            self.__session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.__concurrency),
+                                                   timeout=aiohttp.ClientTimeout(total=self.__timeout))
+            self.__slots = asyncio.Semaphore(self.__concurrency)
+            self.__login_lock = asyncio.Lock()
+        if self.__token is None:
+            await self.__login(None)
+        return True
+
+    async def close(self) -> bool:
+        """Close the connection pool"""
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+        return True
+
+    async def __login(self, rejected) -> None:
+        """Log in with the AppRole, unless another request already replaced the rejected token"""
+        async with self.__login_lock:
+            if self.__token is not None and self.__token != rejected:
+                return
+            logger.trace(f'Connecting to Vault approle: {self.__approle}')
+            async with self.__session.post(f'{self.__url}/v1/auth/approle/login',
+                                           json={'role_id': self.__approle, 'secret_id': self.__secretid}) as resp:
+                if resp.status != 200:
+                    raise hvac.exceptions.Unauthorized(f'AppRole login failed with {resp.status}')
+                self.__token = (await resp.json())['auth']['client_token']
+
+    async def _request(self, method: str, path: str, data: dict = None):
+        """Issue a REST API call with the current token, logging in again once when Vault rejects it
+
+            :param method: HTTP verb, LIST included
+            :type method: str
+            :param path: API path below /v1/
+            :type path: str
+            :param data: Optional JSON body
+            :type data: dict
+            :return: Decoded JSON response, None when Vault answers without content
+        """
+        await self.open()
+        params = None
+        if method == 'LIST':
+            """Same as LIST for Vault, and understood by proxies and HTTP libraries"""
+            method, params = 'GET', {'list': 'true'}
+        for attempt in range(2):
+            token = self.__token
+            status, body = await self.__send(method, path, data, params, token)
+            if status == 403 and attempt == 0:
+                logger.debug('Vault token rejected, logging in again')
+            elif status == 403:
+                raise hvac.exceptions.Forbidden(f'Permission denied {method} {path}')
+            elif status == 404:
+                raise hvac.exceptions.InvalidPath(f'{path} not found')
+            elif status >= 400:
+                raise hvac.exceptions.VaultError(f'{method} {path} failed with {status}: {body}')
+            else:
+                return body
+            await self.__login(token)
+
+    async def __send(self, method: str, path: str, data: dict, params: dict, token: str) -> tuple:
+        """One API call, retried KNOX_VAULT_RETRIES times with KNOX_VAULT_BACKOFF like VaultClient.session does on
+        connection errors and 5xx answers. POST is not retried, same as the blocking engine.
+
+            :return: tuple of (status, decoded JSON, the text of an error or None when there is no content)
+        """
+        retries = self.__retries if method != 'POST' else 0
+        attempt = 0
+        while True:
+            try:
+                async with self.__slots:
+                    async with self.__session.request(method, f'{self.__url}/v1/{path}', json=data, params=params,
+                                                      headers={'X-Vault-Token': token}) as resp:
+                        if resp.status not in self.retry_status or attempt >= retries:
+                            if resp.status == 204:
+                                return resp.status, None
+                            return resp.status, await (resp.json() if resp.status < 400 else resp.text())
+                        logger.debug(f'{method} {path} answered {resp.status}, retrying')
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as err:
+                if attempt >= retries:
+                    raise
+                logger.debug(f'{method} {path} failed {err!r}, retrying')
+            await asyncio.sleep(self.__backoff * 2 ** attempt)
+            attempt += 1
+
+    async def read(self, path: str, name: str, type=None) -> StoreObject:
+        """Read cert_body and cert_info of an object concurrently and create a new StoreObject
+
+            :param path: Store path to the object
+            :type path: str
+            :param name: Name of the object to retrieve
+            :type name: str
+            :param type: StoreObject type, if known
+            :type type: str
+            :return: StoreObject
+        """
+        try:
+            cert = await self.__fetch(path, name, type)
+        except Exception as vex:
+            logger.error(f'Failed to read StoreObject /{self.__mount}{path}/{name} {vex}')
+            raise
+        logger.info(f' Successfully read {cert.path_name}')
+        return cert
+
+    async def read_many(self, items) -> list:
+        """Read many (path, name, type) objects at once, None for those that could not be read
+
+            :param items: (path, name, type) of each object
+            :type items: iterable
+            :return: list of StoreObject, in the order of items
+        """
+        results = await asyncio.gather(*[self.__fetch(*item) for item in items], return_exceptions=True)
+        for (path, name, _), result in zip(items, results):
+            if isinstance(result, Exception):
+                logger.error(f'Failed to read StoreObject /{self.__mount}{path}/{name} {result}')
+        return [None if isinstance(result, Exception) else result for result in results]
+
+    async def __fetch(self, path: str, name: str, type=None) -> StoreObject:
+        base = f'{path}/{name}/{type}' if type else f'{path}/{name}'
+        body, info = await asyncio.gather(self.__secret(f'{base}/cert_body'), self.__secret(f'{base}/cert_info'))
+        cert = StoreObject(name=name, path=path, body=body, info=info, type=type)
+        cert._data = {'cert_body': body, 'cert_info': info}
+        return cert
+
+    async def __secret(self, path: str) -> dict:
+        return (await self._request('GET', f'{self.__mount}/data/{path.lstrip("/")}'))['data']['data']
+
+    async def write(self, obj: StoreObject, force: bool = False) -> bool:
+        """Store cert_body and cert_info of obj, and create its read policy when missing. Objects identical to the
+        stored version are not written again.
+
+            :param obj: The object to store
+            :type obj: StoreObject
+            :param force: Write even when the stored version is identical
+            :type force: bool
+            :return: bool
+        """
+        base = obj.path_name if validators.domain(obj.name) else f'client/{obj.name}/{obj.type}'
+        try:
+            if not force and await self.__unchanged(base, obj):
+                logger.info(f'Skipped {base}, identical to the stored version')
+                await self.__ensure_policy(obj, base)
+                return True
+            self.discard_san()
+            await asyncio.gather(*[self._request('POST', f'{self.__mount}/data/{base.lstrip("/")}/{secret}',
+                                                 {'data': obj.data[secret]})
+                                   for secret in ('cert_body', 'cert_info')])
+            policyname = await self.__ensure_policy(obj, base)
+        except Exception as vex:
+            logger.error(f'Failed to write StoreObject {base} to Vault {vex}')
+            raise
+        logger.info(f'Successfully stored {base} and {policyname}')
+        return True
+
+    async def __ensure_policy(self, obj: StoreObject, base: str) -> str:
+        """Same as VaultClient.ensure_policy, create the read access policy of obj when it does not exist"""
+        commonname = obj.data['cert_info']['subject'].get('commonName', obj.name)
+        policyname = f'knox-read-{commonname}'
+        if not await self.has_policy(policyname):
+            logger.debug(f'Creating explict read access policy {policyname} for {base}/cert_body')
+            await self._request('PUT', f'sys/policy/{policyname}', {'policy': obj.data['cert_policy']})
+            self.__policies.add(policyname)
+        return policyname
+
+    async def __unchanged(self, base: str, obj: StoreObject) -> bool:
+        """Same comparison as VaultClient.unchanged, the private cert_body is only read when the fingerprints match"""
+        try:
+            stored_info = await self.__secret(f'{base}/cert_info')
+        except hvac.exceptions.InvalidPath:
+            return False
+        fingerprint = obj.data['cert_info'].get('key_details', {}).get('fingerprint_sha256')
+        if fingerprint != stored_info.get('key_details', {}).get('fingerprint_sha256'):
+            return False
+        if StoreObject.md5(stored_info) != StoreObject.md5(obj.data['cert_info']):
+            return False
+        try:
+            stored_body = await self.__secret(f'{base}/cert_body')
+        except hvac.exceptions.InvalidPath:
+            return False
+        return StoreObject.md5(stored_body) == StoreObject.md5(obj.data['cert_body'])
+
+    async def has_policy(self, name: str) -> bool:
+        """Whether the policy exists, policies are listed once per session, unknown names are read one at a time.
+        Same as VaultClient.has_policy, a forbidden read counts as missing."""
+        if self.__policies is None:
+            try:
+                self.__policies = set((await self._request('GET', 'sys/policy'))['policies'])
+            except hvac.exceptions.Forbidden:
+                logger.debug('Not allowed to list policies, reading them one at a time')
+                self.__policies = set()
+        if name in self.__policies:
+            return True
+        try:
+            await self._request('GET', f'sys/policy/{name}')
+        except hvac.exceptions.InvalidPath:
+            return False
+        except hvac.exceptions.Forbidden:
+            logger.debug(f'Not allowed to read policy {name}, treating it as missing')
+            return False
+        self.__policies.add(name)
+        return True
+
+    async def delete(self, path: str, name: str) -> bool:
+        """Remove every version of every type of an object
+
+            :param path: Store path to the object
+            :type path: str
+            :param name: Name of the object
+            :type name: str
+            :return: bool, False when there was nothing to delete
+        """
+        base = f'{path}/{name}'.lstrip('/')
+        try:
+            keys = (await self._request('LIST', f'{self.__mount}/metadata/{base}'))['data']['keys']
+        except hvac.exceptions.InvalidPath:
+            return False
+        secrets = [f'{base}/{key}' for key in keys if not key.endswith('/')]
+        for key in [key for key in keys if key.endswith('/')]:
+            secrets += [f'{base}/{key}{secret}' for secret in ('cert_body', 'cert_info')]
+        self.discard_san()
+        await asyncio.gather(*[self._request('DELETE', f'{self.__mount}/metadata/{secret}') for secret in secrets])
+        return True
+
+    async def iterfind(self, pattern: str, live: bool = False):
+        """Search certificate info for a given pattern, results are yielded in the order they are found. Domain
+        patterns only walk the matching sub tree, sibling nodes are listed and read concurrently.
+
+            :param pattern: Search glob pattern
+                ex: *, abc.8x8.com, abc.8x8.com/*, 8x8.com/*
+            :type pattern: str
+            :param live: Accepted for compatibility, there is no local index and Vault is always walked
+            :type live: bool
+            :return: asynchronous generator of dict
+        """
+        rootpath, glob = self.search_path(pattern)
+        match = '*' if rootpath else pattern
+        scanned = [] if pattern == '*' else None
+        pending = {asyncio.ensure_future(self.__visit(rootpath or '/', match, root=True))}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    children, result = task.result()
+                    pending.update(asyncio.ensure_future(self.__visit(child, match)) for child in children)
+                    if result is None:
+                        continue
+                    if scanned is not None:
+                        scanned.append(result)
+                    if not glob or fnmatch(result['common_name'].lower(), glob.lower()):
+                        yield result
+        except hvac.exceptions.VaultError as vex:
+            logger.error(f'Failed to search {pattern} in /{self.__mount}: {vex}')
+            raise
+        finally:
+            for task in pending:
+                task.cancel()
+        if scanned is not None:
+            self.index_san(scanned, 'vault_cert_path')
+
+    async def find(self, pattern: str, live: bool = False) -> list:
+        """Same as iterfind, returned in the depth first order of VaultStoreEngine.find"""
+        return sorted([result async for result in self.iterfind(pattern, live=live)],
+                      key=lambda result: result['vault_cert_path'])
+
+    async def __visit(self, path: str, pattern: str, root: bool = False) -> tuple:
+        """List one node, read its cert_info when it holds a certificate
+
+            :return: tuple of (child paths, search result or None)
+        """
+        try:
+            keys = (await self._request('LIST', f'{self.__mount}/metadata{path}'))['data']['keys']
+        except hvac.exceptions.InvalidPath:
+            if root:
+                return [], None
+            raise
+        if 'cert_info' not in keys:
+            return [path + key for key in keys if key.endswith('/')], None
+        cert_info = await self.__secret(path + 'cert_info')
+        return [], self.search_result(path.split('/')[-3], 'vault_cert_path', f'/{self.__mount}{path}', cert_info, pattern)
+
+    async def subjectaltfind(self, pattern: str, live: bool = False) -> list:
+        """Find the certificates listing pattern as a subject alternative name
+
+            :param pattern: DNS name
+            :type pattern: str
+            :param live: Scan Vault again instead of using the last scan
+            :type live: bool
+            :return: list
+        """
+        if self.san_stale(self.__index_ttl, live):
+            await self.find('*')
+        return [self._san_results[key] for key in self._san.lookup(pattern)]
+
+    async def expiring(self, days: int, live: bool = False) -> list:
+        """Certificates expiring within the given number of days, soonest first"""
+        before = (datetime.now() + timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+        return sorted([result for result in await self.find('*') if result['cert_expiry_date'] < before],
+                      key=lambda result: result['cert_expiry_date'])
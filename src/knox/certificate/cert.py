@@ -15,6 +15,7 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License."""
 import ast
+import copy
 import datetime
 import enum
 import json
@@ -30,10 +31,11 @@ from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives.serialization import Encoding
 from dynaconf import LazySettings
 from jinja2 import Environment
-from jinja2 import FileSystemLoader
 from loguru import logger
 
+from ..backend import StoreEngine
 from ..backend import StoreObject
+from ..config import Templates
 from .cert_engine import CertDnsEngine
 
 
@@ -72,11 +74,11 @@ class Cert(StoreObject):
         self._info = ""
         self._type = ""
         super().__init__(name=self.name, path=self.path, body=self._body, info=self._info)
-        self._jinja = Environment(loader=FileSystemLoader('templates'))
-        self._tmpl_body = self._jinja.get_template('body_template.js')
-        self._tmpl_info = self._jinja.get_template('info_template.js')
-        self._tmpl_data = self._jinja.get_template('data_template.js')
-        self._tmpl_policy = self._jinja.get_template('policy_template.js')
+        self._jinja = Templates.environment(settings)
+        self._tmpl_body = Templates.get('body_template.js', settings)
+        self._tmpl_info = Templates.get('info_template.js', settings)
+        self._tmpl_data = Templates.get('data_template.js', settings)
+        self._tmpl_policy = Templates.get('policy_template.js', settings)
 
     def load_x509(self, path: str) -> None:
         """Given path to PEM x509 read in certificate
@@ -90,10 +92,21 @@ class Cert(StoreObject):
             self._file = fp.read()
             self._x509 = x509.load_pem_x509_certificate(bytes(self._file, 'utf-8'), default_backend())
 
-        """Generate data structures using custom Jinja2 templates"""
-        self._info = ast.literal_eval(self._tmpl_info.render(cert=self))
-        self._body = ast.literal_eval(self._tmpl_body.render(cert=self))
-        self._data = ast.literal_eval(self._tmpl_data.render(cert=self))
+        if self._settings.get('CERT_TEMPLATES'):
+            """Generate data structures using custom Jinja2 templates"""
+            self._info = ast.literal_eval(self._tmpl_info.render(cert=self))
+            self._body = ast.literal_eval(self._tmpl_body.render(cert=self))
+            self._data = ast.literal_eval(self._tmpl_data.render(cert=self))
+        else:
+            """Build the same data structures directly from the parsed certificate"""
+            cert_info = {'subject': self._subject(),
+                         'issuer': self._issuer(),
+                         'validity': self._validity(),
+                         'key_details': self._key_details()}
+            self._info = {'cert_info': cert_info}
+            self._body = {'cert_body': {'private': '', 'chain': '', 'public': ''}}
+            self._data = {'cert_info': copy.deepcopy(cert_info),
+                          'cert_body': dict(self._body['cert_body'])}
 
         """Ensure raw file contents in public key, Jinja2 fails to parse if there are CR LF"""
         self.public = self._file
@@ -168,9 +181,12 @@ class Cert(StoreObject):
 
     def subject(self) -> str:
         """Return the certificate subject details"""
+        return json.dumps(self._subject(), indent=8)
+
+    def _subject(self) -> dict:
         subj = {attr.oid._name: attr.value for attr in self._x509.subject}
         subj['alternativeNames'] = self.subjectaltnames()
-        return json.dumps(subj, indent=8)
+        return subj
 
     def subjectaltnames(self) -> str:
         """Return Subject alternate names"""
@@ -192,18 +208,27 @@ class Cert(StoreObject):
 
     def issuer(self) -> str:
         """Return the certificate issuer details"""
-        return json.dumps({attr.oid._name: attr.value for attr in self._x509.issuer}, indent=8)
+        return json.dumps(self._issuer(), indent=8)
+
+    def _issuer(self) -> dict:
+        return {attr.oid._name: attr.value for attr in self._x509.issuer}
 
     def validity(self) -> str:
         """Return the certificates dates of validity"""
+        return json.dumps(self._validity(), indent=8)
+
+    def _validity(self) -> dict:
         cert = self._x509
-        return json.dumps({
+        return {
             'not_valid_before': f'{cert.not_valid_before}',
             'not_valid_after': f'{cert.not_valid_after}',
-        }, indent=8)
+        }
 
     def key_details(self) -> str:
         """Return characteristics of key used to generate the certificate"""
+        return json.dumps(self._key_details(), indent=8)
+
+    def _key_details(self) -> dict:
         cert = self._x509
         public_key = self._x509.public_key()
         key_info = {'size': public_key.key_size}
@@ -217,12 +242,12 @@ class Cert(StoreObject):
         else:
             raise ValueError('Invalid key type.')
         key_info['type'] = key_type
-        return json.dumps({
+        return {
             'version': cert.version.name,
             'fingerprint_sha256': hexlify(cert.fingerprint(hashes.SHA256())).decode(),
             'serial_number': f'{cert.serial_number}',
             'key': key_info
-        }, indent=8)
+        }
 
     def isValid(self) -> bool:
         """Check certificate validity period"""
@@ -234,12 +259,11 @@ class Cert(StoreObject):
     @staticmethod
     def to_store_path(common_name: str) -> str:
         """Generate a backend store path based on the certificates common name
-        www.example.com becomes /com/example/www
+        www.example.com becomes /com/example/www, the layout StoreEngine.search_path prunes find with
 
             :return: str
         """
-        domainsplit = common_name.split('.')
-        return "/" + "/".join(reversed(domainsplit))
+        return StoreEngine.to_store_path(common_name)
 
     @property
     def name(self) -> str:
@@ -248,12 +272,19 @@ class Cert(StoreObject):
 
     @property
     def path(self) -> str:
-        if validators.domain(self.name):
-            self._path = Cert.to_store_path(self.name)
-        else:
-            self._path = ''
+        self._path = Cert.locate(self._common_name)[1]
         return self._path
 
+    @classmethod
+    def locate(cls, common_name: str) -> tuple:
+        """Name and store path of a certificate without loading it, *.example.com is stored as
+        wildcard.example.com under /com/example/wildcard
+
+            :return: tuple of (name, path)
+        """
+        name = cls.valid_name(common_name)
+        return name, Cert.to_store_path(name) if validators.domain(name) else ''
+
     def __str__(self) -> str:
         return json.dumps(self._data, indent=4)
 
@@ -304,14 +335,21 @@ class Cert(StoreObject):
         """Content to persist, typically JSON"""
         return self._data
 
-    def generate(self) -> None:
-        """ Generate certificate for a given common name"""
+    def generate(self) -> bool:
+        """ Generate certificate for a given common name
+
+            :return: bool, False when certbot or loading its certificate failed, the failure is logged
+        """
         try:
             cde = CertDnsEngine(self._settings)
-            certfile, chainfile, privkey = cde.call_provider(self._common_name)
+            """Names are kept as wildcard.example.com, certbot is asked for *.example.com"""
+            name = f'*.{self._common_name[len("wildcard."):]}' if self._common_name.startswith('wildcard.') else self._common_name
+            certfile, chainfile, privkey = cde.call_provider(name)
             self.load(pub=certfile, key=privkey, chain=chainfile, certtype=Cert.PEM.name)
+            return True
         except Exception:
             logger.error(f'Failed to generate certificate {self._common_name}')
+            return False
 
 
 class CertUnsupportedTypeException(Exception):
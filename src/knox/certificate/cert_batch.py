@@ -0,0 +1,164 @@
+"""
+Apache Software License 2.0
+
+Copyright (c) 2020, 8x8, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License."""
+
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+from .cert import Cert
+
+
+class CertBatch:
+    """Load, validate and store many certificates through a single store instance.
+
+    Every item is a dict with the certificate common name and, when saving an existing certificate, the files
+    holding it. Items without a public key are generated with certbot instead::
+
+        {"name": "www.example.com", "pub": "www-pub.pem", "key": "www-key.pem", "chain": "www-chain.pem"}
+        {"name": "api.example.com"}
+    """
+
+    def __init__(self, settings, store, workers: int = 8, force: bool = False) -> None:
+        """Constructor for CertBatch
+
+            :param settings: Dynaconf settings
+            :type settings: LazySettings
+            :param store: Store every certificate is saved to
+            :type store: Store
+            :param workers: Certificates loaded and uploaded concurrently
+            :type workers: int
+            :param force: Write certificates the store already holds unchanged
+            :type force: bool
+        """
+        self._settings = settings
+        self._store = store
+        self._workers = max(1, workers)
+        self._force = force
+        """certbot holds a lock on its config directory, generate one certificate at a time"""
+        self._generate_lock = threading.Lock()
+
+    @staticmethod
+    def read_manifest(stream) -> list:
+        """Parse JSON lines, one item per line. Blank lines and lines starting with # are skipped
+
+            :param stream: Open text file, i.e. sys.stdin
+            :return: list
+        """
+        items = []
+        for number, line in enumerate(stream, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError as err:
+                raise ValueError(f'Manifest line {number} is not valid JSON: {err}')
+            if 'name' not in item:
+                raise ValueError(f'Manifest line {number} is missing "name"')
+            items.append(item)
+        return items
+
+    @staticmethod
+    def scan_dir(path: str) -> list:
+        """Find <name>-pub.pem, <name>-key.pem and optional <name>-chain.pem triples, the layout written by cert get
+
+            :param path: Directory to scan
+            :type path: str
+            :return: list
+        """
+        items = []
+        for entry in sorted(os.listdir(path)):
+            if not entry.endswith('-pub.pem'):
+                continue
+            name = entry[:-len('-pub.pem')]
+            item = {'name': name,
+                    'pub': os.path.join(path, entry),
+                    'key': os.path.join(path, f'{name}-key.pem')}
+            if os.path.exists(os.path.join(path, f'{name}-chain.pem')):
+                item['chain'] = os.path.join(path, f'{name}-chain.pem')
+            items.append(item)
+        return items
+
+    def load(self, item: dict) -> Cert:
+        """Build the certificate described by item, reading or generating it
+
+            :param item: Manifest entry
+            :type item: dict
+            :return: Cert
+        """
+        certificate = Cert(self._settings, common_name=item['name'])
+        if item.get('pub'):
+            certificate.load(pub=item['pub'],
+                             key=item['key'],
+                             chain=item.get('chain'),
+                             certtype=item.get('type', 'PEM').upper())
+        else:
+            with self._generate_lock:
+                generated = certificate.generate()
+            if not generated:
+                raise ValueError(f'certbot did not issue a certificate for {item["name"]}, see log')
+        if not certificate.isValid():
+            raise ValueError(f'{certificate.name} is invalid. Check validity Dates: '
+                             f'{certificate.data["cert_info"]["validity"]}')
+        return certificate
+
+    def save(self, items: list) -> list:
+        """Load every item, then store the valid certificates concurrently
+
+            :param items: Manifest entries
+            :type items: list
+            :return: list of per item results {'name', 'status', 'error'}
+        """
+        with ThreadPoolExecutor(max_workers=self._workers) as pool:
+            loaded = list(pool.map(self.attempt, [self.load] * len(items), items))
+            results = [{'name': item['name'], 'status': 'invalid', 'error': error}
+                       for item, (_, error) in zip(items, loaded)]
+            uploads = {index: pool.submit(self.attempt, self._store.save, certificate, self._force)
+                       for index, (certificate, error) in enumerate(loaded) if error is None}
+            for index, future in uploads.items():
+                _, error = future.result()
+                results[index]['status'] = 'failed' if error else 'saved'
+                results[index]['error'] = error
+
+        for result in results:
+            if result['error']:
+                logger.error(f'{result["name"]} {result["status"]}: {result["error"]}')
+        return results
+
+    @staticmethod
+    def attempt(method, *args) -> tuple:
+        """Run method(*args) and capture its failure, engines exit on errors so SystemExit is captured as well
+
+            :return: tuple of (value, error message or None)
+        """
+        try:
+            return method(*args), None
+        except SystemExit as err:
+            return None, f'exited with status {err.code}, see log'
+        except Exception as err:
+            return None, str(err) or err.__class__.__name__
+
+    @staticmethod
+    def summary(results: list) -> dict:
+        """Count results by status"""
+        counts = {'total': len(results)}
+        for result in results:
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+        return counts
@@ -16,6 +16,7 @@ See the License for the specific language governing permissions and
 limitations under the License."""
 
 import os
+import shlex
 import subprocess
 
 from loguru import logger
@@ -94,7 +95,7 @@ class CertDnsEngine:
             :type name: str
             :returns str
         """
-        command = f'certbot certonly -n --agree-tos --{plugin} -d {name}'
+        command = f'certbot certonly -n --agree-tos --{plugin} -d {shlex.quote(name)}'
         return command
 
     def call_provider(self, name: str) -> tuple:
@@ -128,9 +129,11 @@ class CertDnsEngine:
                                           stdout=subprocess.PIPE,
                                           stderr=subprocess.STDOUT)
                 if response.returncode == 0:
-                    certfile_path = f'{conf_dir}/live/{name}/cert.pem'
-                    chainfile_path = f'{conf_dir}/live/{name}/chain.pem'
-                    privkey_path = f'{conf_dir}/live/{name}/privkey.pem'
+                    """certbot names the lineage of *.example.com example.com"""
+                    lineage = name[2:] if name.startswith('*.') else name
+                    certfile_path = f'{conf_dir}/live/{lineage}/cert.pem'
+                    chainfile_path = f'{conf_dir}/live/{lineage}/chain.pem'
+                    privkey_path = f'{conf_dir}/live/{lineage}/privkey.pem'
                     return certfile_path, chainfile_path, privkey_path
                 else:
                     logger.error(f'Certbot return code {response.returncode} none zero')
@@ -0,0 +1,88 @@
+"""
+Apache Software License 2.0
+
+Copyright (c) 2020, 8x8, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License."""
+import os
+import tempfile
+
+from loguru import logger
+
+from ..backend.store_object import StoreObject
+
+
+class CertFiles:
+    """Write retrieved certificates as <name>-pub.pem, <name>-key.pem and <name>-chain.pem. Files are replaced
+    atomically, private keys are only readable by their owner and certificates whose content did not change are
+    left untouched, so restarts do not rewrite, or trigger reloads of, hundreds of files."""
+    files = {'public': 'pub', 'private': 'key', 'chain': 'chain'}
+    modes = {'public': 0o644, 'private': 0o600, 'chain': 0o644}
+
+    def __init__(self, directory: str = '.') -> None:
+        """Constructor for CertFiles
+
+            :param directory: Where the files are written, created if missing
+            :type directory: str
+        """
+        self._directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def filename(self, name: str, part: str) -> str:
+        return os.path.join(self._directory, f'{name}-{self.files[part]}.pem')
+
+    def current(self, name: str) -> dict:
+        """The body of name as it is on disk, empty parts for missing files"""
+        body = {}
+        for part in self.files:
+            try:
+                with open(self.filename(name, part), 'r') as fp:
+                    body[part] = fp.read()
+            except FileNotFoundError:
+                body[part] = None
+        return body
+
+    def write(self, obj: StoreObject) -> bool:
+        """Write the public certificate, private key and chain of obj unless they are already on disk
+
+            :param obj: Certificate read from the store
+            :type obj: StoreObject
+            :return: bool, False when the files were already up to date
+        """
+        body = {part: obj.body.get(part) for part in self.files}
+        if StoreObject.md5(body) == StoreObject.md5(self.current(obj.name)):
+            key = self.filename(obj.name, 'private')
+            if os.path.exists(key) and os.stat(key).st_mode & 0o777 != self.modes['private']:
+                os.chmod(key, self.modes['private'])
+            logger.debug(f'{obj.name} is unchanged')
+            return False
+        for part, content in body.items():
+            if content is not None:
+                self.replace(self.filename(obj.name, part), content, self.modes[part])
+        logger.info(f'Wrote {obj.name} to {self._directory}')
+        return True
+
+    @staticmethod
+    def replace(filename: str, content: str, mode: int) -> None:
+        """Write content next to filename and rename it into place, readers see either the old or new file"""
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(filename) or '.', prefix=f'.{os.path.basename(filename)}.')
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                fp.write(content)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.chmod(temp, mode)
+            os.replace(temp, filename)
+        except BaseException:
+            os.unlink(temp)
+            raise
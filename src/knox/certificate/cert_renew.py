@@ -0,0 +1,211 @@
+"""
+Apache Software License 2.0
+
+Copyright (c) 2020, 8x8, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License."""
+import heapq
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from datetime import timedelta
+
+import validators
+from loguru import logger
+
+from .cert import Cert
+from .cert_batch import CertBatch
+from .cert_files import CertFiles
+
+
+class CertRenew:
+    """Renew the certificates of a store that expire within a window, soonest first.
+
+    Candidates come from Store.expiring, which the engines answer from their index when they keep one. They are
+    queued by not_valid_after and generated with certbot by a bounded pool of workers. Orders placed with one ACME
+    account are serialized, certbot locks its config directory, and spaced by KNOX_RENEW_RATE orders per hour.
+    Progress is kept in a JSON state file so an interrupted run resumes without ordering certificates again. The
+    state also remembers every certificate renewed beyond the window, so a later run does not order them again while
+    the store index still lists their previous expiry.
+    """
+
+    def __init__(self, settings, store, days: int = 30, workers: int = 4, state: str = None, force: bool = False) -> None:
+        """Constructor for CertRenew
+
+            :param settings: Dynaconf settings
+            :type settings: LazySettings
+            :param store: Store scanned for expiring certificates and the renewed ones are saved to
+            :type store: Store
+            :param days: Renewal window, certificates expiring within this many days are renewed
+            :type days: int
+            :param workers: Certificates renewed concurrently
+            :type workers: int
+            :param state: State file, defaults to KNOX_RENEW_STATE
+            :type state: str
+            :param force: Write certificates the store already holds unchanged
+            :type force: bool
+        """
+        self._settings = settings
+        self._store = store
+        self._days = days
+        self._workers = max(1, workers)
+        self._force = force
+        self._state_path = os.path.abspath(os.path.expanduser(state or settings.get('RENEW_STATE', '~/.knox/renew-state.json')))
+        self._state = {}
+        self._state_lock = threading.Lock()
+        """Seconds between two orders of the same ACME account"""
+        self._interval = 3600.0 / float(settings.get('RENEW_RATE', 50))
+        self._accounts = {}
+        self._accounts_lock = threading.Lock()
+
+    def queue(self, live: bool = False) -> list:
+        """Priority queue of the certificates inside the window, the first to expire at the top. A certificate found
+        under several store paths is queued once.
+
+            :param live: Scan the store instead of its index
+            :type live: bool
+            :return: list heap of (not_valid_after, name, search result)
+        """
+        heap, seen = [], set()
+        for result in self._store.expiring(self._days, live=live):
+            if result['common_name'] not in seen:
+                seen.add(result['common_name'])
+                heapq.heappush(heap, (result['cert_expiry_date'], result['common_name'], result))
+        return heap
+
+    def account(self) -> str:
+        """The ACME account name is ordered with, certbot registers one account per email and config directory"""
+        certbot = self._settings.as_dict().get('KNOX_CERTBOT_CONFIG', {})
+        return f'{certbot.get("KNOX_CERTBOT_ACCOUNT_EMAIL")}@{certbot.get("KNOX_CERTBOT_ROOT_DIR")}'
+
+    def renew(self, live: bool = False, resume: bool = True, dry_run: bool = False) -> list:
+        """Renew every queued certificate, soonest expiry first
+
+            :param live: Scan the store instead of its index
+            :type live: bool
+            :param resume: Skip certificates an unfinished previous run already renewed, and the ones earlier runs
+                renewed beyond the window, reported as current
+            :type resume: bool
+            :param dry_run: Only report what would be renewed
+            :type dry_run: bool
+            :return: list of per certificate results {'name', 'not_valid_after', 'status', 'error'}
+        """
+        heap = self.queue(live=live)
+        self._load_state(resume)
+        window = (datetime.now() + timedelta(days=self._days)).strftime('%Y-%m-%d %H:%M:%S')
+        results = []
+        with ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='knox-renew') as pool:
+            futures = []
+            while heap:
+                not_after, name, _ = heapq.heappop(heap)
+                previous = self._state['items'].get(name, {})
+                if previous.get('status') in ('renewed', 'skipped'):
+                    results.append({'name': name, 'not_valid_after': previous['not_valid_after'], 'status': previous['status'],
+                                    'error': previous['error']})
+                elif self._state['renewed'].get(name, '') > window:
+                    """Renewed by an earlier run, the store index has not caught up with the new certificate yet"""
+                    results.append({'name': name, 'not_valid_after': self._state['renewed'][name], 'status': 'current',
+                                    'error': None})
+                elif dry_run:
+                    results.append({'name': name, 'not_valid_after': not_after, 'status': 'due', 'error': None})
+                else:
+                    futures.append(pool.submit(self._renew, name, not_after))
+            results += [future.result() for future in futures]
+        if dry_run:
+            return results
+
+        self._state['finished'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self._save_state()
+        for result in results:
+            if result['error']:
+                logger.error(f'{result["name"]} {result["status"]}: {result["error"]}')
+        return results
+
+    def _renew(self, name: str, not_after: str) -> dict:
+        """Generate and save one certificate, recording the outcome in the state file"""
+        result = {'name': name, 'not_valid_after': not_after, 'status': 'failed', 'error': None}
+        if not validators.domain(name):
+            result.update(status='skipped', error='not a domain name, it cannot be ordered from ACME')
+        else:
+            certificate, error = CertBatch.attempt(self._order, name)
+            if error:
+                result['error'] = error
+            elif certificate is None:
+                result['error'] = 'certbot did not issue a certificate, see log'
+            else:
+                _, error = CertBatch.attempt(self._store.save, certificate, self._force)
+                result.update(status='failed' if error else 'renewed', error=error)
+                if not error:
+                    result['not_valid_after'] = certificate.data['cert_info']['validity']['not_valid_after']
+        with self._state_lock:
+            self._state['items'][name] = dict(result, at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            if result['status'] == 'renewed':
+                self._state['renewed'][name] = result['not_valid_after']
+            self._save_state()
+        return result
+
+    def _order(self, name: str):
+        """Order a certificate for name with certbot, within the rate of the ACME account
+
+            :return: Cert, None when certbot did not issue one
+        """
+        certificate = Cert(self._settings, common_name=name)
+        with self._throttle(self.account()):
+            return certificate if certificate.generate() else None
+
+    @contextmanager
+    def _throttle(self, account: str):
+        """Hold the lock of an ACME account, waiting until its previous order is at least the rate interval ago"""
+        with self._accounts_lock:
+            limit = self._accounts.setdefault(account, {'lock': threading.Lock(), 'last': None})
+        with limit['lock']:
+            if limit['last'] is not None:
+                wait = limit['last'] + self._interval - time.monotonic()
+                if wait > 0:
+                    logger.debug(f'Waiting {wait:.1f}s before the next order of {account}')
+                    time.sleep(wait)
+            try:
+                yield
+            finally:
+                limit['last'] = time.monotonic()
+
+    def _load_state(self, resume: bool) -> None:
+        """Continue the state of an unfinished run, otherwise start a new one. The certificates renewed by earlier runs
+        are carried over until they expire."""
+        previous = {}
+        if resume and os.path.exists(self._state_path):
+            try:
+                with open(self._state_path) as fp:
+                    previous = json.load(fp)
+            except ValueError:
+                logger.warning(f'Ignoring unreadable renewal state {self._state_path}')
+        if not previous or previous.get('finished') or previous.get('days') != self._days:
+            state = {'started': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'finished': None, 'days': self._days, 'items': {}}
+        else:
+            state = previous
+            if state['items']:
+                logger.info(f'Resuming renewal started {state["started"]}, {len(state["items"])} certificates already processed')
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        renewed = dict(previous.get('renewed', {}))
+        renewed.update({name: item['not_valid_after'] for name, item in previous.get('items', {}).items()
+                        if item.get('status') == 'renewed'})
+        state['renewed'] = {name: not_after for name, not_after in renewed.items() if not_after > now}
+        self._state = state
+
+    def _save_state(self) -> None:
+        os.makedirs(os.path.dirname(self._state_path), exist_ok=True)
+        CertFiles.replace(self._state_path, json.dumps(self._state, indent=2), 0o600)
@@ -16,15 +16,13 @@ See the License for the specific language governing permissions and
 limitations under the License. """
 import csv
 import json
+import os
 import sys
 
 import click
-import pkg_resources
 from loguru import logger
 
-from .certificate import Cert  # noqa: F401
-from .config import Conf
-from .knox import Knox
+from . import __version__
 
 
 @click.group()
@@ -41,15 +39,21 @@ from .knox import Knox
               help="Sets the level of logging displayed")
 @click.option("--verbose", "-v", is_flag=True, default=False, help="Display log output to console")
 @click.option("--admin", is_flag=True, default=False, help="Enable admin actions", hidden=True)
-@click.version_option(version=pkg_resources.get_distribution('knox').version)
+@click.option("--socket", "socket_path", default=None, help="knox serve socket, default $KNOX_SERVE_SOCKET or knox-<uid>.sock")
+@click.option("--no-daemon", is_flag=True, default=False, help="Do not forward to a running knox serve daemon")
+@click.version_option(version=__version__)
 @click.pass_context
 @logger.catch()
-def cli(ctx, verbose: bool = False, log: str = 'INFO', admin: bool = False):
+def cli(ctx, verbose: bool = False, log: str = 'INFO', admin: bool = False, socket_path: str = None, no_daemon: bool = False):
     """Utilities for managing and storing TLS certificates using backing store (Vault)."""
+    from .config import Conf
+
     ctx.ensure_object(dict)
     ctx.obj['VERBOSE'] = verbose
     ctx.obj['LOG_LEVEL'] = log
     ctx.obj['ADMIN_MODE'] = admin
+    ctx.obj['SERVE_SOCKET'] = socket_path
+    ctx.obj['NO_DAEMON'] = no_daemon
     logger.remove()
     if verbose:
         logger.add(sys.stdout,
@@ -74,9 +78,10 @@ def cli(ctx, verbose: bool = False, log: str = 'INFO', admin: bool = False):
 @click.option("--pub", help="Public key file")
 @click.option("--chain", help="Intermediate chain")
 @click.option("--key", help="Private key file")
+@click.option("--force", is_flag=True, default=False, help="Write certificates even when the store already holds them")
 @click.pass_context
 @logger.catch()
-def cert(ctx, pub: str, key: str, type: str = 'PEM', chain: str = None):
+def cert(ctx, pub: str, key: str, type: str = 'PEM', chain: str = None, force: bool = False):
     """Certificate utilities.
 
     NAME is the common name for the certificate. i.e. www.example.com
@@ -85,6 +90,7 @@ def cert(ctx, pub: str, key: str, type: str = 'PEM', chain: str = None):
     ctx.obj['CERT_CHAIN'] = chain
     ctx.obj['CERT_KEY'] = key
     ctx.obj['CERT_TYPE'] = type.upper()
+    ctx.obj['CERT_FORCE'] = force
 
 
 @cert.command(name="save", no_args_is_help=True)
@@ -94,43 +100,89 @@ def cert(ctx, pub: str, key: str, type: str = 'PEM', chain: str = None):
 def cert_save(ctx, name):
     """Store an existing certificate
     """
+    from .certificate import Cert
+    from .knox import Knox
+
     ctx.obj['CERT_NAME'] = name
     pub = ctx.obj['CERT_PUB']
     key = ctx.obj['CERT_KEY']
     chain = ctx.obj['CERT_CHAIN']
     certtype = ctx.obj['CERT_TYPE']
 
-    knox = Knox(ctx)
-    certificate = Cert(knox.settings, common_name=name)
+    client = daemon(ctx)
+    knox = None if client else Knox(ctx)
+    certificate = Cert(knox.settings if knox else daemon_settings(ctx), common_name=name)
     certificate.load(pub=pub,
                      key=key,
                      chain=chain,
                      certtype=certtype)
     if certificate.isValid():
-        knox.store.save(certificate)
+        if client:
+            forward(client.save, certificate, force=ctx.obj['CERT_FORCE'])
+        else:
+            knox.store.save(certificate, force=ctx.obj['CERT_FORCE'])
     else:
         logger.error(f'{certificate.name} is invalid. Check validity Dates:\n {certificate.info()}')
         sys.exit(2)
 
 
 @cert.command(name="get", no_args_is_help=True)
-@click.argument("name")
+@click.argument("names", nargs=-1)
+@click.option("--file", "-f", "names_file", type=click.File('r'), help="File of names to retrieve, one per line, - for stdin")
+@click.option("--find", "pattern", default=None, help="Retrieve every certificate matching a store find pattern")
+@click.option("--out", "-o", default='.', show_default=True, type=click.Path(file_okay=False),
+              help="Directory the certificates are written to")
 @click.pass_context
 @logger.catch()
-def cert_get(ctx, name):
-    """Retrieve an existing certificate for a given common name
+def cert_get(ctx, names, names_file, pattern: str, out: str):
+    """Retrieve existing certificates for the given common names
+
+    Writes NAME-pub.pem, NAME-key.pem and NAME-chain.pem into the output directory. Certificates are retrieved
+    concurrently, files whose content did not change are left untouched.
+
+      knox cert get www.example.com api.example.com --out /etc/ssl/edge
     """
-    ctx.obj['CERT_NAME'] = name
-    knox = Knox(ctx)
-    certificate = Cert(knox.settings, common_name=name)
-    certificate.type = ctx.obj['CERT_TYPE']
-    certificate = knox.store.get(certificate.path, name=name, type=certificate.type)
-    with open(f'{certificate.name}-pub.pem', "w") as pubf:
-        pubf.write(certificate.body['public'])
-    with open(f'{certificate.name}-key.pem', "w") as keyf:
-        keyf.write(certificate.body['private'])
-    with open(f'{certificate.name}-chain.pem', "w") as chainf:
-        chainf.write(certificate.body['chain'])
+    from concurrent.futures import ThreadPoolExecutor
+
+    from .certificate import Cert
+    from .certificate import CertFiles
+    from .knox import Knox
+    from .server import KnoxServerError
+
+    names = list(names)
+    if names_file:
+        names.extend(line.strip() for line in names_file if line.strip() and not line.startswith('#'))
+    client = daemon(ctx)
+    knox = None if client else Knox(ctx)
+    if pattern:
+        results = client.iterfind(pattern=pattern) if client else knox.store.iterfind(pattern=pattern)
+        names.extend(result['common_name'] for result in results)
+    if not names:
+        raise click.UsageError('Give NAMES, --file or --find')
+
+    ctx.obj['CERT_NAME'] = names[0]
+    certtype = ctx.obj['CERT_TYPE']
+    items = list(dict.fromkeys(Cert.locate(name)[::-1] + (certtype,) for name in names))
+    if client:
+        def get(item):
+            try:
+                return client.get(item[0], name=item[1], type=item[2])
+            except (KnoxServerError, OSError) as err:
+                logger.error(f'knox serve: {err}')
+                return None
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            certificates = list(pool.map(get, items))
+    else:
+        certificates = knox.store.get_many(items)
+
+    files = CertFiles(out)
+    written = sum(files.write(certificate) for certificate in certificates if certificate is not None)
+    failed = [name for (_, name, _), certificate in zip(items, certificates) if certificate is None]
+    logger.info(f'{written} written, {len(items) - written - len(failed)} unchanged, {len(failed)} failed')
+    if failed:
+        logger.error(f'Could not retrieve {", ".join(failed)}')
+        sys.exit(2)
 
 
 @cert.command(name="gen", no_args_is_help=True)
@@ -140,23 +192,66 @@ def cert_get(ctx, name):
 def cert_gen(ctx, name):
     """Create and store a new certificate for a given common name
     """
+    from .certificate import Cert
+    from .knox import Knox
+
     ctx.obj['CERT_NAME'] = name
 
     knox = Knox(ctx)
     certificate = Cert(knox.settings, common_name=name)
-    certificate.generate()
-    knox.store.save(certificate)
+    if not certificate.generate():
+        sys.exit(2)
+    knox.store.save(certificate, force=ctx.obj['CERT_FORCE'])
+
+
+@cert.command(name="batch", no_args_is_help=True)
+@click.option("--manifest", "-m", type=click.File('r'),
+              help="JSON lines, one certificate per line, - for stdin. "
+                   "i.e. {\"name\": \"www.example.com\", \"pub\": \"pub.pem\", \"key\": \"key.pem\"}, "
+                   "lines without pub are generated")
+@click.option("--dir", "-d", "directory", type=click.Path(exists=True, file_okay=False),
+              help="Directory of <name>-pub.pem, <name>-key.pem and <name>-chain.pem files")
+@click.option("--workers", "-w", default=8, show_default=True, help="Certificates processed concurrently")
+@click.pass_context
+@logger.catch()
+def cert_batch(ctx, manifest, directory: str, workers: int):
+    """Store or generate many certificates in one invocation
+    """
+    from .certificate import CertBatch
+    from .knox import Knox
+
+    items = []
+    if manifest:
+        items += CertBatch.read_manifest(manifest)
+    if directory:
+        items += CertBatch.scan_dir(directory)
+
+    knox = Knox(ctx)
+    results = CertBatch(knox.settings, knox.store, workers=workers, force=ctx.obj['CERT_FORCE']).save(items)
+    for result in results:
+        click.echo(json.dumps(result))
+    summary = CertBatch.summary(results)
+    click.echo(json.dumps(summary), err=True)
+    if summary['total'] != summary.get('saved', 0):
+        sys.exit(2)
 
 
 @cert.command(name="aws", no_args_is_help=True)
 @click.argument("name")
-@click.option("--region", default=None, help="Default AWS region")
-@click.option("--profile", default=None, help="Default AWS profile to use")
+@click.option("--region", default=None, multiple=True, help="AWS region, repeat to import to several regions")
+@click.option("--profile", default=None, multiple=True, help="AWS profile, repeat to import to several accounts")
+@click.option("--target", "-t", default=None, multiple=True, help="PROFILE:REGION to import to, repeatable")
+@click.option("--timeout", default=None, type=float, help="Seconds to wait for each store, default KNOX_REPLICATE_TIMEOUT")
 @click.pass_context
 @logger.catch()
-def cert_aws(ctx, name, region, profile):
+def cert_aws(ctx, name, region, profile, target, timeout):
     """Store a certificate for a given common name in AWS
+
+    Every --profile is combined with every --region, --target adds single pairs. Without any, KNOX_AWS_TARGETS
+    or KNOX_AWS_PROFILE:KNOX_AWS_REGION is used. The outcome on each target is printed as a JSON line.
     """
+    from .certificate import Cert
+    from .knox import Knox
 
     ctx.obj['CERT_NAME'] = name
     pub = ctx.obj['CERT_PUB']
@@ -165,13 +260,22 @@ def cert_aws(ctx, name, region, profile):
     certtype = ctx.obj['CERT_TYPE']
 
     knox = Knox(ctx)
+    targets = list(target)
+    if region or profile:
+        targets += [f'{p or ""}:{r or ""}' for p in profile or [None] for r in region or [None]]
+    if targets:
+        knox.settings.set('AWS_TARGETS', targets)
     certificate = Cert(knox.settings, common_name=name)
     certificate.load(pub=pub, key=key, chain=chain, certtype=certtype)
     knox.attach("aws")
-    # Save to the attached AWS ACM store
-    knox.stores("aws").save(certificate)
-    # Save to the default store
-    knox.store.save(certificate)
+    # Save to the default store and the attached AWS ACM stores concurrently
+    results = knox.replicate(certificate, ['default', 'aws'], timeout=timeout, force=ctx.obj['CERT_FORCE'])
+    if results['aws']['status'] != 'timeout':
+        for result in knox.stores("aws").engine.results:
+            click.echo(json.dumps(result))
+    click.echo(json.dumps(results), err=True)
+    if any(result['status'] != 'saved' for result in results.values()):
+        sys.exit(2)
 
 
 @cli.group(no_args_is_help=True)
@@ -184,14 +288,16 @@ def store(ctx) -> dict:
 @store.command(name="find", no_args_is_help=True)
 @click.option("--file", "-f", help="Output file, default stdout")
 @click.option("--output", "-o",
-              type=click.Choice(['JSON', 'CSV'], case_sensitive=False),
+              type=click.Choice(['JSON', 'NDJSON', 'CSV'], case_sensitive=False),
               default='JSON',
               show_default=True,
-              help="Type of output")
+              help="Type of output, results are written as they are found")
+@click.option("--live", is_flag=True, default=False, help="Search the store directly, bypassing the local index")
+@click.option("--san", is_flag=True, default=False, help="Find the certificates whose alternative names cover NAME")
 @click.argument("name")
 @click.pass_context
 @logger.catch()
-def find(ctx, name, file: str = 'stdout', output: str = 'JSON') -> dict:
+def find(ctx, name, file: str = 'stdout', output: str = 'JSON', live: bool = False, san: bool = False) -> dict:
     """Given a certificate NAME pattern search the store.
 
     NAME can be similar to a full file path or the certificates common name.
@@ -203,30 +309,160 @@ def find(ctx, name, file: str = 'stdout', output: str = 'JSON') -> dict:
       knox store find \*
 
     Otherwise your shell may try and interpret it and not pass it to python
+
+    With --san, NAME is a host name and the certificates covering it, directly or through a wildcard, are listed.
     """
+    from .knox import Knox
+    from .server import KnoxServerError
+
     ctx.obj['STORE_FIND_NAME'] = name
     ctx.obj['STORE_FIND_OUTPUT'] = output
     ctx.obj['STORE_FIND_OUTFILE'] = file
-    knox = Knox(ctx)
-    results = knox.store.find(pattern=name)  # noqa F841
-    handle = open(file, 'w') if file else sys.stdout
-    if output == 'JSON':
-        handle.write(json.dumps(results, indent=4))
+    client = daemon(ctx)
+    if client:
+        results = client.iterfind(pattern=name, live=live, san=san)
+    elif san:
+        knox = Knox(ctx)
+        results = knox.store.subjectaltfind(pattern=name, live=live)
     else:
-        csv_writer = csv.writer(handle)
-        count = 0
-        for rec in results:
-            if count == 0:
-                header = rec.keys()
-                csv_writer.writerow(header)
-                count += 1
-            csv_writer.writerow(rec.values())
+        knox = Knox(ctx)
+        results = knox.store.iterfind(pattern=name, live=live)
+    handle = open(file, 'w') if file else sys.stdout
+    writer = {'JSON': write_json, 'NDJSON': write_ndjson, 'CSV': write_csv}[output.upper()]
+    try:
+        writer(handle, results)
+    except KnoxServerError as err:
+        logger.error(f'knox serve: {err}')
+        sys.exit(2)
+    except BrokenPipeError:
+        """Reader went away, i.e. piped into head, stop searching and silence the final flush"""
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    finally:
+        if hasattr(results, 'close'):
+            results.close()
 
     handle.close()
 
     return ctx
 
 
+@cli.command(name="serve")
+@click.pass_context
+@logger.catch()
+def serve(ctx):
+    """Run knox as a daemon on a local Unix socket.
+
+    The store connection, Vault token and caches stay warm between invocations, other knox commands forward
+    cert get, cert save and store find to the daemon while it is running. Use --no-daemon to bypass it.
+    """
+    from .knox import Knox
+    from .server import KnoxServer
+
+    knox = Knox(ctx)
+    with KnoxServer(knox, ctx.obj['SERVE_SOCKET'] or KnoxServer.default_socket(knox.settings)) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info('knox serve stopped')
+
+
+@cli.command(name="renew")
+@click.option("--days", "-d", default=None, type=int,
+              help="Renew certificates expiring within this many days, default KNOX_RENEW_WINDOW or 30")
+@click.option("--workers", "-w", default=4, show_default=True, help="Certificates renewed concurrently")
+@click.option("--state", default=None, help="Resumable state file, default KNOX_RENEW_STATE")
+@click.option("--fresh", is_flag=True, default=False, help="Start over instead of resuming an unfinished run")
+@click.option("--live", is_flag=True, default=False, help="Scan the store instead of its local index")
+@click.option("--dry-run", is_flag=True, default=False, help="List the certificates that would be renewed")
+@click.option("--force", is_flag=True, default=False, help="Write certificates even when the store already holds them")
+@click.pass_context
+@logger.catch()
+def renew(ctx, days, workers, state, fresh, live, dry_run, force):
+    """Renew every stored certificate that expires soon, the first to expire first.
+
+    Certificates are generated with certbot like cert gen and saved to the default store, one JSON line per
+    certificate is printed. An interrupted run continues where it stopped when started again.
+    """
+    from .certificate import CertBatch
+    from .certificate import CertRenew
+    from .knox import Knox
+
+    knox = Knox(ctx)
+    days = days if days is not None else int(knox.settings.get('RENEW_WINDOW', 30))
+    results = CertRenew(knox.settings, knox.store, days=days, workers=workers, state=state, force=force).renew(
+        live=live, resume=not fresh, dry_run=dry_run)
+    for result in results:
+        click.echo(json.dumps(result))
+    summary = CertBatch.summary(results)
+    click.echo(json.dumps(summary), err=True)
+    if summary.get('failed'):
+        sys.exit(2)
+
+
+def daemon(ctx):
+    """Client for a running knox serve daemon, None when there is none or --no-daemon was given"""
+    if ctx.obj.get('NO_DAEMON'):
+        return None
+    from .server import KnoxClient
+    from .server import KnoxServer
+
+    settings = daemon_settings(ctx)
+    client = KnoxClient(ctx.obj.get('SERVE_SOCKET') or KnoxServer.default_socket(settings),
+                        timeout=float(settings.get('SERVE_TIMEOUT', 120)))
+    return client if client.available() else None
+
+
+def daemon_settings(ctx):
+    """Settings for work done locally while the store is reached through the daemon, the Conf is built once per
+    invocation and reused by Knox"""
+    from .config import Conf
+
+    if ctx.obj.get('CONF') is None:
+        ctx.obj['CONF'] = Conf(ctx.obj['LOG_LEVEL'])
+    return ctx.obj['CONF'].settings
+
+
+def forward(operation, *args, **kwargs):
+    """Call the daemon, exiting like the store engines do when it reports a failure"""
+    from .server import KnoxServerError
+
+    try:
+        return operation(*args, **kwargs)
+    except KnoxServerError as err:
+        logger.error(f'knox serve: {err}')
+        sys.exit(2)
+
+
+def write_json(handle, results) -> None:
+    """Stream results as a JSON array, formatted like json.dumps(results, indent=4)"""
+    separator = '[\n'
+    for rec in results:
+        handle.write(separator + '\n'.join('    ' + line for line in json.dumps(rec, indent=4).splitlines()))
+        handle.flush()
+        separator = ',\n'
+    handle.write('[]' if separator == '[\n' else '\n]')
+
+
+def write_ndjson(handle, results) -> None:
+    """Stream results as newline delimited JSON, one object per line"""
+    for rec in results:
+        handle.write(json.dumps(rec) + '\n')
+        handle.flush()
+
+
+def write_csv(handle, results) -> None:
+    """Stream results as CSV, the header is taken from the first record"""
+    csv_writer = csv.writer(handle)
+    count = 0
+    for rec in results:
+        if count == 0:
+            header = rec.keys()
+            csv_writer.writerow(header)
+            count += 1
+        csv_writer.writerow(rec.values())
+        handle.flush()
+
+
 def main():
     cli(prog_name="knox", obj={})
 
@@ -14,4 +14,28 @@ distributed under the License is distributed on an "AS IS" BASIS,
 WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License."""
-from .conf import Conf  # noqa: F401
+import importlib
+import sys
+
+_exports = {
+    'Conf': '.conf',
+    'Templates': '.templates',
+}
+__all__ = list(_exports)
+
+
+def __getattr__(name: str):
+    """Import configuration modules on first use, they depend on dynaconf and jinja2"""
+    if name in _exports:
+        return getattr(importlib.import_module(_exports[name], __name__), name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
+
+
+if sys.version_info < (3, 7):
+    """Module __getattr__ (PEP 562) is not available, import everything up front"""
+    for _name in __all__:
+        globals()[_name] = __getattr__(_name)
@@ -17,10 +17,16 @@ limitations under the License.
 
 from dynaconf.loaders.vault_loader import list_envs
 """
-import pkg_resources
 from dynaconf import settings
 from loguru import logger
 
+from .. import __version__
+
+try:
+    from importlib import metadata
+except ImportError:  # Python < 3.8
+    metadata = None
+
 
 class Conf:
     """Manage application settings"""
@@ -38,12 +44,20 @@ class Conf:
             self.set_loglevel(settings.LOG_LEVEL)
         if loglevel:
             self.set_loglevel(loglevel)
-        self._version = pkg_resources.get_distribution("knox").version
+        self._version = self.installed_version()
         self._settings = settings
         logger.debug(f'{self._banner} 🏰 Knox version {self._version}\n')
         logger.debug("Settings managed with Dynaconf, learn more at http://github.com/rochacbruno/dynaconf")
         logger.debug(f'dynaconf loaded? {self._settings.configured}')
 
+    @staticmethod
+    def installed_version() -> str:
+        """Version of the installed knox distribution, the package version when running from source"""
+        try:
+            return metadata.version('knox')
+        except Exception:
+            return __version__
+
     @classmethod
     def log_filter(cls, record) -> bool:
         levelno = logger.level(cls.log_level).no
@@ -0,0 +1,78 @@
+"""
+Apache Software License 2.0
+
+Copyright (c) 2020, 8x8, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License."""
+import os
+import threading
+
+from jinja2 import Environment
+from jinja2 import FileSystemBytecodeCache
+from jinja2 import FileSystemLoader
+from jinja2 import Template
+from loguru import logger
+
+
+class Templates:
+    """Process wide registry of compiled Jinja2 templates, shared by every Cert and store engine.
+
+    Templates are loaded from KNOX_TEMPLATE_DIR, when set, then from the templates shipped with the package. Each
+    template is compiled once per process, KNOX_TEMPLATE_CACHE names a directory to keep the compiled bytecode
+    between runs.
+    """
+    package_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'templates')
+    _environment: Environment = None
+    _templates: dict = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def environment(cls, settings=None) -> Environment:
+        """The shared Jinja2 environment, created on first use
+
+            :param settings: Dynaconf settings, only read when the environment is created
+            :type settings: LazySettings
+            :return: Environment
+        """
+        with cls._lock:
+            if cls._environment is None:
+                settings = settings if settings is not None else {}
+                search_path = [cls.package_dir]
+                if settings.get('TEMPLATE_DIR'):
+                    search_path.insert(0, os.path.expanduser(settings.get('TEMPLATE_DIR')))
+                bytecode_cache = None
+                if settings.get('TEMPLATE_CACHE'):
+                    cache_dir = os.path.expanduser(settings.get('TEMPLATE_CACHE'))
+                    os.makedirs(cache_dir, exist_ok=True)
+                    bytecode_cache = FileSystemBytecodeCache(cache_dir)
+                cls._environment = Environment(loader=FileSystemLoader(search_path),
+                                               bytecode_cache=bytecode_cache,
+                                               auto_reload=False)
+                logger.debug(f'Templates loaded from {search_path}')
+            return cls._environment
+
+    @classmethod
+    def get(cls, name: str, settings=None) -> Template:
+        """Compiled template by file name, i.e. body_template.js
+
+            :param name: Template file name
+            :type name: str
+            :param settings: Dynaconf settings, only read when the environment is created
+            :type settings: LazySettings
+            :return: Template
+        """
+        template = cls._templates.get(name)
+        if template is None:
+            template = cls.environment(settings).get_template(name)
+            cls._templates[name] = template
+        return template
@@ -14,6 +14,11 @@ distributed under the License is distributed on an "AS IS" BASIS,
 WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License."""
+import threading
+import time
+
+from loguru import logger
+
 from . import backend as backend
 from . import config as config
 
@@ -23,15 +28,21 @@ class Knox:
     _conf: config.Conf
     _store: backend.Store
     _stores: dict
+    _writers: list    #: (alias, thread) of replicate writes still running after their timeout
     _ctx: dict
 
     def __init__(self, ctx: dict) -> None:
         """Constructor for Knox """
         self._ctx = ctx
-        self._conf = config.Conf(ctx.obj['LOG_LEVEL'])
+        """Reuse the Conf cli.daemon_settings built while looking for a daemon"""
+        self._conf = ctx.obj.get('CONF') or config.Conf(ctx.obj['LOG_LEVEL'])
+        ctx.obj['CONF'] = self._conf
         self._conf.settings.set('CTX', ctx)
         self._store = backend.Store(self._conf.settings)
         self._stores = {}
+        self._writers = []
+        """Connection pools and event loop threads of the stores are released when the command finishes"""
+        ctx.call_on_close(self.close)
 
     @property
     def settings(self) -> config.Conf.settings:
@@ -52,6 +63,89 @@ class Knox:
         """Retrieve a named store, otherwise the default store"""
         return self._stores[engine_name] if engine_name is not None else self._store
 
-    def attach(self, engine_name: str) -> bool:
-        """Instantiate an additional store"""
-        self._stores[engine_name] = backend.Store(self._conf.settings, engine_name)
+    def attach(self, engine_name: str, alias: str = None) -> bool:
+        """Instantiate an additional store
+
+            :param engine_name: Key of Store._engine_map
+            :type engine_name: str
+            :param alias: Name the store is retrieved and replicated by, defaults to engine_name
+            :type alias: str
+            :return: bool
+        """
+        previous = self._stores.get(alias or engine_name)
+        self._stores[alias or engine_name] = backend.Store(self._conf.settings, engine_name)
+        if previous is not None:
+            previous.close()
+        return True
+
+    def close(self) -> None:
+        """Close the default store and every attached store. Writes replicate abandoned are waited for, at most
+        KNOX_REPLICATE_TIMEOUT seconds in total, a store still being written to after that is left open. A store
+        failing to close is logged, the others are still closed."""
+        busy = set()
+        if self._writers:
+            deadline = time.monotonic() + float(self.settings.get('REPLICATE_TIMEOUT', 120))
+            for alias, thread in self._writers:
+                thread.join(max(0.0, deadline - time.monotonic()))
+                if thread.is_alive():
+                    logger.warning(f'Not closing store {alias}, a replicated write to it is still running')
+                    busy.add(alias)
+            self._writers = []
+        stores = [('default', self._store)] + list(self._stores.items())
+        self._stores = {}
+        for alias, store in stores:
+            if alias in busy:
+                continue
+            try:
+                store.close()
+            except SystemExit as e:
+                logger.error(f'Failed to close store {alias} exit {e.code}')
+            except Exception as e:
+                logger.error(f'Failed to close store {alias} {e}')
+
+    def replicate(self, obj: backend.StoreObject, stores: list = None, timeout=None, force: bool = False) -> dict:
+        """Save obj to several stores concurrently, waiting at most timeout seconds for each. A store that fails or
+        times out does not stop the others, its thread is abandoned and keeps running in the background until close
+        waits for it.
+
+            :param obj: Certificate to save
+            :type obj: StoreObject
+            :param stores: Aliases of attached stores, 'default' for the default store, defaults to all of them
+            :type stores: list
+            :param timeout: Seconds, or a dict of alias -> seconds, defaults to KNOX_REPLICATE_TIMEOUT
+            :type timeout: float or dict
+            :param force: Write even if a store already holds the certificate
+            :type force: bool
+            :return: dict alias -> {'status': saved|failed|timeout, 'seconds': float, 'error': str}
+        """
+        stores = list(stores) if stores is not None else ['default'] + list(self._stores)
+        default_timeout = float(self.settings.get('REPLICATE_TIMEOUT', 120))
+        timeouts = {alias: float((timeout.get(alias, default_timeout) if isinstance(timeout, dict) else timeout) or default_timeout)
+                    for alias in stores}
+        results = {alias: {'status': 'timeout', 'seconds': None, 'error': None} for alias in stores}
+
+        def save(alias, store, started):
+            try:
+                saved = store.save(obj, force=force)
+                results[alias].update(status='saved' if saved is not False else 'failed')
+            except SystemExit as e:
+                results[alias].update(status='failed', error=f'exit {e.code}')
+            except Exception as e:
+                results[alias].update(status='failed', error=str(e))
+            results[alias]['seconds'] = round(time.monotonic() - started, 3)
+
+        threads = {}
+        started = time.monotonic()
+        for alias in stores:
+            store = self._store if alias == 'default' else self._stores[alias]
+            threads[alias] = threading.Thread(target=save, args=(alias, store, started), name=f'knox-replicate-{alias}', daemon=True)
+            threads[alias].start()
+        for alias, thread in threads.items():
+            thread.join(max(0.0, started + timeouts[alias] - time.monotonic()))
+            if thread.is_alive():
+                self._writers.append((alias, thread))
+                results[alias]['error'] = f'no result after {timeouts[alias]}s'
+                logger.error(f'Saving {obj.name} to {alias} timed out after {timeouts[alias]}s')
+            elif results[alias]['status'] != 'saved':
+                logger.error(f'Saving {obj.name} to {alias} failed {results[alias]["error"] or ""}')
+        return {alias: dict(result) for alias, result in results.items()}
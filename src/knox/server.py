@@ -0,0 +1,249 @@
+"""
+Apache Software License 2.0
+
+Copyright (c) 2020, 8x8, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+https://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License."""
+import json
+import os
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+
+from loguru import logger
+
+from .backend.store_object import StoreObject
+
+
+class KnoxServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Long running knox daemon. Keeps one Knox instance, its stores and their Vault tokens warm and serves get,
+    save and find over a Unix socket only the current user can connect to.
+
+    Requests and responses are JSON, one object per line. A request names the operation::
+
+        {"op": "get", "path": "/com/example/www", "name": "www.example.com", "type": "PEM"}
+        {"op": "save", "object": {"name": ..., "path": ..., "type": ..., "data": {...}}}
+        {"op": "find", "pattern": "*.example.com", "live": false, "san": false}
+
+    find answers with one {"item": {...}} line per result, every request ends with {"ok": true, "result": ...} or
+    {"ok": false, "error": "..."}.
+    """
+    daemon_threads = True
+    request_queue_size = 128  #: Pending connections, cert get connects once per certificate from several threads
+
+    def __init__(self, knox, path: str) -> None:
+        """Constructor for KnoxServer
+
+            :param knox: The Knox instance requests are served from
+            :type knox: Knox
+            :param path: Unix socket to listen on, replaced if stale
+            :type path: str
+        """
+        self.knox = knox
+        """Knox.attach replaces the store of that name, handlers must not attach the same store twice"""
+        self.attach_lock = threading.Lock()
+        if os.path.exists(path):
+            if not KnoxClient.owned(path):
+                raise OSError(f'{path} belongs to another user, set KNOX_SERVE_SOCKET to a path only you can write')
+            if KnoxClient(path).available():
+                raise OSError(f'knox is already serving on {path}')
+            os.unlink(path)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, KnoxRequestHandler)
+        finally:
+            os.umask(umask)
+        logger.info(f'🏰 knox serving on {path}')
+
+    def server_close(self) -> None:
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+    @staticmethod
+    def default_socket(settings=None) -> str:
+        """KNOX_SERVE_SOCKET, otherwise knox-<uid>.sock in the user's runtime or temp directory
+
+            :param settings: Dynaconf settings, KNOX_SERVE_SOCKET is read from the environment without them
+            :type settings: LazySettings
+            :return: str
+        """
+        runtime_dir = os.environ.get('XDG_RUNTIME_DIR', tempfile.gettempdir())
+        uid = os.getuid() if hasattr(os, 'getuid') else 0
+        configured = settings.get('SERVE_SOCKET') if settings is not None else os.environ.get('KNOX_SERVE_SOCKET')
+        return os.path.expanduser(configured) if configured else os.path.join(runtime_dir, f'knox-{uid}.sock')
+
+
+class KnoxRequestHandler(socketserver.StreamRequestHandler):
+    """Serve the requests of one client connection, see KnoxServer for the protocol"""
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                operation = getattr(self, f'op_{request.get("op")}', None)
+                if operation is None:
+                    raise ValueError(f'Unknown operation {request.get("op")}')
+                self.reply({'ok': True, 'result': operation(request)})
+            except SystemExit as err:
+                """Engines exit on store errors, that must not stop the daemon"""
+                self.reply({'ok': False, 'error': f'store exited with status {err.code}, see the knox serve log'})
+            except BrokenPipeError:
+                return
+            except Exception as err:
+                logger.error(f'knox serve request failed: {err}')
+                self.reply({'ok': False, 'error': str(err)})
+
+    def reply(self, message: dict) -> None:
+        self.wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+    def store(self, request: dict):
+        name = request.get('store')
+        knox = self.server.knox
+        if name and name not in knox._stores:
+            with self.server.attach_lock:
+                if name not in knox._stores:
+                    knox.attach(name)
+        return knox.stores(name)
+
+    def op_ping(self, request: dict) -> dict:
+        from . import __version__
+        return {'version': __version__, 'pid': os.getpid()}
+
+    def op_get(self, request: dict) -> dict:
+        obj = self.store(request).get(request['path'], name=request['name'], type=request.get('type'))
+        return {'name': obj.name, 'path': obj.path, 'type': obj.type, 'body': obj.body, 'info': obj.info}
+
+    def op_save(self, request: dict) -> bool:
+        data = request['object']
+        obj = StoreObject(name=data['name'],
+                          path=data['path'],
+                          body=data['data'].get('cert_body'),
+                          info=data['data'].get('cert_info'),
+                          type=data.get('type'))
+        obj._data = data['data']
+        return self.store(request).save(obj, force=request.get('force', False))
+
+    def op_find(self, request: dict) -> int:
+        store = self.store(request)
+        if request.get('san'):
+            results = store.subjectaltfind(pattern=request['pattern'], live=request.get('live', False))
+        else:
+            results = store.iterfind(pattern=request['pattern'], live=request.get('live', False))
+        count = 0
+        try:
+            for result in results:
+                self.reply({'item': result})
+                count += 1
+        finally:
+            if hasattr(results, 'close'):
+                results.close()
+        return count
+
+
+class KnoxClient:
+    """Thin client forwarding Store operations to a running knox serve daemon"""
+
+    def __init__(self, path: str = None, timeout: float = 120) -> None:
+        """Constructor for KnoxClient
+
+            :param path: Unix socket of the daemon
+            :type path: str
+            :param timeout: Seconds to wait for each reply of the daemon
+            :type timeout: float
+        """
+        self._path = path or KnoxServer.default_socket()
+        self._timeout = timeout
+
+    def available(self) -> bool:
+        """True when a daemon of the current user answers on the socket"""
+        if not hasattr(socket, 'AF_UNIX') or not os.path.exists(self._path):
+            return False
+        if not self.owned(self._path):
+            logger.warning(f'Ignoring knox serve socket {self._path}, it is not private to the current user')
+            return False
+        try:
+            self._request({'op': 'ping'}, timeout=2)
+        except (OSError, ValueError, KnoxServerError):
+            return False
+        return True
+
+    @staticmethod
+    def owned(path: str) -> bool:
+        """Whether path is owned by the current user and nobody else may use it, certificates and private keys
+        travel over the socket"""
+        stat = os.stat(path)
+        return stat.st_uid == os.getuid() and stat.st_mode & 0o077 == 0
+
+    def get(self, path: str, name: str, type=None, store: str = None) -> StoreObject:
+        response = self._request({'op': 'get', 'path': path, 'name': name, 'type': type, 'store': store})
+        obj = StoreObject(name=response['name'], path=response['path'], body=response['body'],
+                          info=response['info'], type=response['type'])
+        obj._data = {'cert_body': response['body'], 'cert_info': response['info']}
+        return obj
+
+    def save(self, obj: StoreObject, store: str = None, force: bool = False) -> bool:
+        return self._request({'op': 'save',
+                              'store': store,
+                              'force': force,
+                              'object': {'name': obj.name, 'path': obj.path, 'type': obj.type, 'data': obj.data}})
+
+    def iterfind(self, pattern: str, live: bool = False, san: bool = False, store: str = None):
+        """Yield find results as the daemon streams them"""
+        yield from self._stream({'op': 'find', 'pattern': pattern, 'live': live, 'san': san, 'store': store})
+
+    def _request(self, request: dict, timeout: float = None):
+        """Send a request, discarding streamed items, and return its result"""
+        stream = self._stream(request, timeout=timeout)
+        while True:
+            try:
+                next(stream)
+            except StopIteration as done:
+                return done.value
+
+    def _stream(self, request: dict, timeout: float = None):
+        """Yield the streamed items of a request, the generator returns the request's result. Nothing is kept on the
+        client so one client may be used from several threads"""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout or self._timeout)
+            sock.connect(self._path)
+            self.verify_peer(sock)
+            sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            with sock.makefile('rb') as stream:
+                for line in stream:
+                    message = json.loads(line)
+                    if 'item' in message:
+                        yield message['item']
+                    elif message.get('ok'):
+                        return message.get('result')
+                    else:
+                        raise KnoxServerError(message.get('error'))
+        raise KnoxServerError('knox serve closed the connection')
+
+    @staticmethod
+    def verify_peer(sock: socket.socket) -> None:
+        """Refuse a daemon run by another user, the socket could have been replaced after it was checked"""
+        if hasattr(socket, 'SO_PEERCRED'):
+            _, uid, _ = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+            if uid != os.getuid():
+                raise KnoxServerError(f'knox serve on {sock.getpeername()} runs as uid {uid}, not as the current user')
+
+
+class KnoxServerError(Exception):
+    """Exception raised when the knox daemon could not complete a request"""
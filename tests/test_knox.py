@@ -1,4 +1,22 @@
 
+import io
+import json
+import os
+import random
+import stat
+import subprocess
+import sys
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import pytest
+
 #from click.testing import CliRunner
 
 #from knox import cli
@@ -11,3 +29,988 @@ def test_main():
 #
 #    assert result.output == '()\n'
 #    assert result.exit_code == 0
+
+
+def test_cli_import_time():
+    """knox --help must not load the store SDKs, and the CLI must import within the startup budget"""
+    pytest.importorskip('click')
+    pytest.importorskip('loguru')
+    budget_ms = int(os.environ.get('KNOX_IMPORT_BUDGET_MS', 250))
+    heavy = ['boto3', 'botocore', 'hvac', 'requests', 'cryptography', 'jinja2', 'validators', 'dynaconf',
+             'pkg_resources']
+    code = f'import sys, knox.cli; print(",".join(m for m in {heavy!r} if m in sys.modules))'
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+    assert proc.stdout.strip() == ''
+    cumulative = [int(line.split('|')[1]) for line in proc.stderr.splitlines()
+                  if line.startswith('import time:') and line.split('|')[-1].strip() == 'knox.cli']
+    assert cumulative and cumulative[0] / 1000 < budget_ms
+
+
+class FakeStore:
+    """Store answering get with a certificate derived from its name, slowly enough for requests to overlap"""
+
+    def get(self, path, name, type=None):
+        from knox.backend import StoreObject
+
+        time.sleep(random.random() / 100)
+        body = {'public': f'pub {name}', 'private': f'key {name}', 'chain': ''}
+        return StoreObject(name=name, path=path, body=body, info={'name': name}, type=type)
+
+
+class FakeKnox:
+    _stores = {}
+
+    def stores(self, name=None):
+        return FakeStore()
+
+
+@pytest.fixture
+def knox_server(tmp_path):
+    pytest.importorskip('loguru')
+    from knox.server import KnoxServer
+
+    server = KnoxServer(FakeKnox(), str(tmp_path / 'knox.sock'))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_serve_concurrent_get(knox_server):
+    """Replies to concurrent requests on one client must not be mixed up"""
+    from knox.server import KnoxClient
+
+    client = KnoxClient(knox_server.server_address, timeout=10)
+    names = [f'www{i}.example.com' for i in range(500)]
+    with ThreadPoolExecutor(max_workers=32) as pool:
+        certificates = list(pool.map(lambda name: client.get('/com/example', name=name, type='PEM'), names))
+
+    assert [certificate.name for certificate in certificates] == names
+    assert [certificate.body['private'] for certificate in certificates] == [f'key {name}' for name in names]
+
+
+def test_serve_attach_once(tmp_path):
+    """Concurrent requests naming the same store attach it once, a second attach would close the store in use"""
+    pytest.importorskip('loguru')
+    from knox.server import KnoxClient
+    from knox.server import KnoxServer
+
+    class AttachingKnox(FakeKnox):
+        def __init__(self):
+            self._stores = {}
+            self.attached = []
+
+        def attach(self, name):
+            self.attached.append(name)
+            time.sleep(0.05)
+            self._stores[name] = FakeStore()
+
+    knox = AttachingKnox()
+    server = KnoxServer(knox, str(tmp_path / 'knox.sock'))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = KnoxClient(server.server_address, timeout=10)
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            list(pool.map(lambda number: client.get('/com/example', f'www{number}.example.com', 'PEM', store='aws'), range(32)))
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert knox.attached == ['aws']
+
+
+def test_daemon_settings_built_once():
+    """Looking for the daemon and building Knox share one Conf per invocation"""
+    pytest.importorskip('dynaconf')
+    from knox import cli
+
+    ctx = types.SimpleNamespace(obj={'LOG_LEVEL': 'INFO'})
+    settings = cli.daemon_settings(ctx)
+    conf = ctx.obj['CONF']
+    assert cli.daemon_settings(ctx) is settings and ctx.obj['CONF'] is conf
+
+
+def test_cert_files(tmp_path):
+    """cert get writes keys readable by their owner only and leaves files that did not change untouched"""
+    pytest.importorskip('cryptography')
+    from knox.backend import StoreObject
+    from knox.certificate import CertFiles
+
+    def certificate(serial):
+        body = {'public': f'pub {serial}', 'private': f'key {serial}', 'chain': f'chain {serial}'}
+        return StoreObject(name='www.example.com', path='/com/example/www', body=body, info={}, type='PEM')
+
+    files = CertFiles(str(tmp_path / 'out'))
+    assert files.write(certificate(1))
+    key = tmp_path / 'out' / 'www.example.com-key.pem'
+    assert stat.S_IMODE(key.stat().st_mode) == 0o600
+    assert stat.S_IMODE((tmp_path / 'out' / 'www.example.com-pub.pem').stat().st_mode) == 0o644
+
+    os.chmod(key, 0o644)
+    inodes = {path.name: path.stat().st_ino for path in (tmp_path / 'out').iterdir()}
+    assert not files.write(certificate(1))
+    assert {path.name: path.stat().st_ino for path in (tmp_path / 'out').iterdir()} == inodes
+    assert stat.S_IMODE(key.stat().st_mode) == 0o600
+
+    assert files.write(certificate(2))
+    assert key.read_text() == 'key 2'
+    assert sorted(path.name for path in (tmp_path / 'out').iterdir()) == [
+        'www.example.com-chain.pem', 'www.example.com-key.pem', 'www.example.com-pub.pem']
+
+
+def test_serve_socket_private(knox_server, tmp_path):
+    """The daemon socket is private, sockets other users could use are refused"""
+    from knox.server import KnoxClient
+
+    assert stat.S_IMODE(os.stat(knox_server.server_address).st_mode) == 0o600
+    assert KnoxClient(knox_server.server_address).available()
+    os.chmod(knox_server.server_address, 0o666)
+    assert not KnoxClient(knox_server.server_address).available()
+
+
+def test_serve_socket_from_settings(tmp_path):
+    """KNOX_SERVE_SOCKET set in .env reaches the daemon and its clients through the settings"""
+    pytest.importorskip('loguru')
+    from knox.server import KnoxServer
+
+    assert KnoxServer.default_socket({'SERVE_SOCKET': str(tmp_path / 'env.sock')}) == str(tmp_path / 'env.sock')
+    assert KnoxServer.default_socket({}).endswith(f'knox-{os.getuid()}.sock')
+
+
+class FakeVault:
+    """hvac client stand-in enforcing token_num_uses like Vault does"""
+
+    def __init__(self, num_uses):
+        self.num_uses = num_uses
+        self.remaining = {}
+        self.token = None
+        self.lock = threading.Lock()
+        self.logins = 0
+
+    def auth_approle(self, role_id, secret_id, use_token=True):
+        with self.lock:
+            self.logins += 1
+            self.token = f'token-{self.logins}'
+            self.remaining[self.token] = self.num_uses
+        return {'auth': {'client_token': self.token, 'num_uses': self.num_uses, 'lease_duration': 3600, 'renewable': True}}
+
+    def request(self):
+        token = self.token
+        time.sleep(random.random() / 1000)
+        with self.lock:
+            if self.num_uses == 0:
+                return
+            if self.remaining.get(token, 0) <= 0:
+                raise PermissionError(f'{token} has no uses left')
+            self.remaining[token] -= 1
+
+
+def test_vault_token_logins_avoided():
+    """Only requests reusing the token of an earlier login count as avoided logins"""
+    pytest.importorskip('hvac')
+    from knox.backend.store_vault import VaultToken
+
+    vault = FakeVault(0)
+    tokens = VaultToken(vault, 'role', 'secret')
+    tokens.get()
+    for _ in range(3):
+        with tokens.use():
+            vault.request()
+    assert tokens.stats == {'logins': 1, 'renewals': 0, 'logins_avoided': 2}
+    with tokens.use(renew=True):
+        vault.request()
+    assert tokens.stats == {'logins': 2, 'renewals': 0, 'logins_avoided': 2}
+
+
+@pytest.mark.parametrize('num_uses', [0, 1, 3])
+def test_vault_token_limited_uses_concurrent(num_uses):
+    """Concurrent requests never send a token whose uses other threads already spent"""
+    pytest.importorskip('hvac')
+    from knox.backend.store_vault import VaultToken
+
+    vault = FakeVault(num_uses)
+    tokens = VaultToken(vault, approle='role', secretid='secret')
+
+    def request(_):
+        with tokens.use():
+            vault.request()
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(request, range(60)))
+
+    assert vault.logins == (60 // num_uses if num_uses else 1)
+
+
+class FakeKV:
+    """In memory hvac.Client serving a KV v2 mount, clients created with the same FakeKV share its secrets"""
+
+    def __init__(self):
+        self.secrets_by_path = {}
+        self.policies = set()
+        self.policy_reads = False   #: The shipped cert_admin policy can list policies but not read a single one
+        self.delay = 0              #: Upper bound of the random latency of list and read requests
+
+    def client(self, url=None, session=None, timeout=None):
+        from hvac.exceptions import Forbidden
+        from hvac.exceptions import InvalidPath
+
+        def read_policy(name):
+            if not self.policy_reads:
+                raise Forbidden(f'sys/policy/{name}')
+            if name not in self.policies:
+                raise InvalidPath(f'sys/policy/{name}')
+            return {'name': name}
+
+        def list_secrets(path, mount_point):
+            time.sleep(random.random() * self.delay)
+            prefix = f'{path.strip("/")}/' if path.strip('/') else ''
+            keys = {key[len(prefix):].split('/')[0] + ('/' if '/' in key[len(prefix):] else '')
+                    for key in self.secrets_by_path if key.startswith(prefix)}
+            if not keys:
+                raise InvalidPath(path)
+            return {'data': {'keys': sorted(keys)}}
+
+        def versions(path):
+            if path.strip('/') not in self.secrets_by_path:
+                raise InvalidPath(path)
+            return self.secrets_by_path[path.strip('/')]
+
+        def read_secret_version(path, mount_point, version=None):
+            time.sleep(random.random() * self.delay)
+            stored = versions(path)
+            return {'data': {'data': stored[-1], 'metadata': {'version': len(stored)}}}
+
+        def read_secret_metadata(path, mount_point):
+            return {'data': {'current_version': len(versions(path)), 'updated_time': f'{len(versions(path))}'}}
+
+        def create_or_update_secret(path, mount_point, secret):
+            self.secrets_by_path.setdefault(path.strip('/'), []).append(json.loads(json.dumps(secret)))
+
+        client = types.SimpleNamespace(url=url, token=None, logout=lambda: None)
+        client.auth_approle = lambda role_id, secret_id, use_token: {'auth': {'client_token': 'token', 'lease_duration': 0}}
+        client.secrets = types.SimpleNamespace(kv=types.SimpleNamespace(
+            list_secrets=list_secrets,
+            v2=types.SimpleNamespace(read_secret_version=read_secret_version,
+                                     read_secret_metadata=read_secret_metadata,
+                                     create_or_update_secret=create_or_update_secret)))
+        client.sys = types.SimpleNamespace(list_policies=lambda: {'data': {'policies': sorted(self.policies)}},
+                                           read_policy=read_policy,
+                                           create_or_update_policy=lambda name, policy: self.policies.add(name))
+        return client
+
+
+class FakeSettings(dict):
+    __getattr__ = dict.__getitem__
+
+
+@pytest.fixture
+def vault_engine(monkeypatch, tmp_path):
+    """Factory of VaultStoreEngines, each like a separate knox process, sharing one in memory Vault"""
+    pytest.importorskip('hvac')
+    from knox.backend import store_vault
+
+    kv = FakeKV()
+    monkeypatch.setattr(store_vault.hvac, 'Client', kv.client)
+
+    def engine(**settings):
+        return store_vault.VaultStoreEngine(FakeSettings(
+            dict(VAULT_URL='http://vault', VAULT_APPROLE='role', VAULT_SECRET_ID='secret', VAULT_MOUNT='certificate',
+                 CTX=types.SimpleNamespace(obj={'ADMIN_MODE': False})), **settings))
+    engine.kv = kv
+    return engine
+
+
+def vault_object(name: str, alternative_names: list, days: int = 90):
+    """StoreObject shaped like a Cert, stored under its reverse DNS path"""
+    from knox.backend import StoreEngine
+    from knox.backend import StoreObject
+
+    not_after = (datetime.now() + timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+    info = {'subject': {'commonName': name, 'alternativeNames': alternative_names},
+            'issuer': {'commonName': 'Test CA'},
+            'validity': {'not_valid_before': '2020-01-01 00:00:00', 'not_valid_after': not_after},
+            'key_details': {'fingerprint_sha256': f'{name}-{days}'}}
+    obj = StoreObject(name=name, path=StoreEngine.to_store_path(name), body={}, info=info, type='PEM')
+    obj._data = {'cert_info': info, 'cert_body': {'public': name, 'private': '', 'chain': ''}, 'cert_policy': ''}
+    return obj
+
+
+def test_vault_crawl_depth_first(vault_engine):
+    """The concurrent walk returns certificates in the order of a serial depth first walk of the tree"""
+    engine = vault_engine(VAULT_SEARCH_WORKERS=8)
+    names = ['example.com', 'www.example.com', 'api.eu.example.com', 'api.us.example.com', 'example.org',
+             'a.b.c.example.net', 'b.example.net', 'mail.example.org', 'www.example.org', 'api.example.com']
+    for name in names:
+        engine.write(vault_object(name, [name]))
+    kv = vault_engine.kv
+    client = kv.client()
+
+    def serial(path):
+        keys = client.secrets.kv.list_secrets(path=path, mount_point='certificate')['data']['keys']
+        if 'cert_info' in keys:
+            yield f'/certificate{path}'
+            return
+        for key in keys:
+            yield from serial(path + key)
+
+    expected = list(serial('/'))
+    assert len(expected) == len(names)
+    kv.delay = 0.005
+    for _ in range(3):
+        assert [result['vault_cert_path'] for result in engine.find('*', live=True)] == expected
+
+
+def test_store_index(vault_engine, tmp_path):
+    """The index answers find by prefix, text and expiry, and a refresh only re-reads changed cert_info"""
+    from knox.backend.store_index import StoreIndex
+
+    engine = vault_engine()
+    for name, days in (('www.example.com', 10), ('api.example.com', 60), ('www.example.org', 5)):
+        engine.write(vault_object(name, [name], days=days))
+    client = engine._VaultStoreEngine__client
+    index = StoreIndex(str(tmp_path / 'index.db'), 'vault/certificate')
+
+    assert client.refresh_index(index) == {'unchanged': 0, 'updated': 3, 'removed': 0}
+    assert [path for path, _ in index.find(prefix='/com/example/')] == [
+        '/com/example/api/api.example.com/PEM/', '/com/example/www/www.example.com/PEM/']
+    found = index.find(text='www.example')
+    assert [info['subject']['commonName'] for _, info in found] == ['www.example.com', 'www.example.org']
+    before = (datetime.now() + timedelta(days=30)).strftime('%Y-%m-%d %H:%M:%S')
+    assert [info['subject']['commonName'] for _, info in index.expiring(before)] == ['www.example.org', 'www.example.com']
+
+    engine.write(vault_object('api.example.com', ['api.example.com'], days=20))
+    for key in [key for key in vault_engine.kv.secrets_by_path if key.startswith('org/')]:
+        del vault_engine.kv.secrets_by_path[key]
+    assert client.refresh_index(index) == {'unchanged': 1, 'updated': 1, 'removed': 1}
+    assert [info['subject']['commonName'] for _, info in index.expiring(before)] == ['www.example.com', 'api.example.com']
+    assert [path for path, _ in index.subjectaltfind('api.example.com')] == ['/com/example/api/api.example.com/PEM/']
+    index.close()
+
+
+def test_vault_read_many(vault_engine):
+    """Objects are read concurrently and returned in the order asked for, None for the ones that are missing"""
+    engine = vault_engine(VAULT_READ_WORKERS=4)
+    names = [f'www{number}.example.com' for number in range(12)]
+    for name in names:
+        engine.write(vault_object(name, [name]))
+    vault_engine.kv.delay = 0.005
+
+    items = [(f'/com/example/{name.split(".")[0]}', name, 'PEM') for name in names]
+    items.insert(5, ('/com/example/missing', 'missing.example.com', 'PEM'))
+    objects = engine.read_many(items)
+    assert [obj.name if obj else None for obj in objects] == names[:5] + [None] + names[5:]
+    assert [obj.info['subject']['commonName'] for obj in objects if obj] == names
+    assert engine.read('/com/example/www3', 'www3.example.com', 'PEM').body['public'] == 'www3.example.com'
+
+
+def test_vault_index_follows_writes(vault_engine, tmp_path):
+    """A certificate saved by one process is found by another trusting the same index within KNOX_INDEX_TTL"""
+    index = str(tmp_path / 'index.db')
+    reader, writer = vault_engine(INDEX_PATH=index), vault_engine(INDEX_PATH=index)
+    assert writer.write(vault_object('www.example.com', ['www.example.com']))
+    assert [result['common_name'] for result in reader.find('*')] == ['www.example.com']
+
+    assert writer.write(vault_object('api.example.com', ['api.example.com']))
+    assert writer.write(vault_object('www.example.com', ['www.example.com'], days=10))
+
+    assert sorted(result['common_name'] for result in reader.find('*')) == ['api.example.com', 'www.example.com']
+    assert [result['common_name'] for result in reader.expiring(30)] == ['www.example.com']
+
+
+@pytest.mark.parametrize('policy_reads', [False, True])
+def test_vault_policy_created_without_read_access(vault_engine, policy_reads):
+    """The shipped admin policy can update but not read sys/policy/<name>, new certificates still get their policy"""
+    vault_engine.kv.policy_reads = policy_reads
+    engine = vault_engine()
+    assert engine.write(vault_object('www.example.com', ['www.example.com']))
+    assert engine.write(vault_object('api.example.com', ['api.example.com']))
+    assert vault_engine.kv.policies == {'knox-read-www.example.com', 'knox-read-api.example.com'}
+
+
+def test_vault_upsert_skips_unchanged(vault_engine):
+    """An identical certificate adds no KV version, a changed one or force does"""
+    engine = vault_engine()
+
+    def versions():
+        return {path: len(stored) for path, stored in vault_engine.kv.secrets_by_path.items()}
+
+    assert engine.write(vault_object('www.example.com', ['www.example.com']))
+    first = versions()
+    assert set(first.values()) == {1}
+    assert engine.write(vault_object('www.example.com', ['www.example.com']))
+    assert versions() == first
+    assert engine.write(vault_object('www.example.com', ['www.example.com']), force=True)
+    assert set(versions().values()) == {2}
+    assert engine.write(vault_object('www.example.com', ['www.example.com'], days=30))
+    assert set(versions().values()) == {3}
+
+
+def test_vault_unchanged_write_repairs_policy(vault_engine):
+    """An identical certificate is not written again, its missing read policy is still created"""
+    assert vault_engine().write(vault_object('www.example.com', ['www.example.com']))
+    versions = {path: len(stored) for path, stored in vault_engine.kv.secrets_by_path.items()}
+    vault_engine.kv.policies.clear()
+
+    assert vault_engine().write(vault_object('www.example.com', ['www.example.com']))
+    assert {path: len(stored) for path, stored in vault_engine.kv.secrets_by_path.items()} == versions
+    assert vault_engine.kv.policies == {'knox-read-www.example.com'}
+
+
+def test_vault_san_lookup_expires(vault_engine):
+    """Without an index SAN lookups come from a scan, kept until a write or KNOX_INDEX_TTL"""
+    engine, other = vault_engine(INDEX_TTL=3600), vault_engine(INDEX_TTL=0)
+    engine.write(vault_object('www.example.com', ['www.example.com', 'api.example.com']))
+    assert [result['common_name'] for result in engine.subjectaltfind('api.example.com')] == ['www.example.com']
+    assert other.subjectaltfind('web.example.com') == []
+
+    engine.write(vault_object('wildcard.example.com', ['*.example.com']))
+    assert [result['common_name'] for result in engine.subjectaltfind('web.example.com')] == ['wildcard.example.com']
+    assert [result['common_name'] for result in other.subjectaltfind('web.example.com')] == ['wildcard.example.com']
+
+
+def test_file_san_lookup_follows_writes(tmp_path):
+    """The file engine shares the SAN index of the Vault engine, dropped on write and delete"""
+    pytest.importorskip('loguru')
+    from knox.backend.store_file import FileStoreEngine
+
+    engine = FileStoreEngine(FakeSettings(FILE_HOME=str(tmp_path)))
+    engine.write(vault_object('www.example.com', ['www.example.com']))
+    assert engine.subjectaltfind('web.example.com') == []
+
+    engine.write(vault_object('wildcard.example.com', ['*.example.com']))
+    assert [result['common_name'] for result in engine.subjectaltfind('web.example.com')] == ['wildcard.example.com']
+    engine.delete('/com/example/wildcard', 'wildcard.example.com')
+    assert engine.subjectaltfind('web.example.com') == []
+
+
+def packed_bodies(home) -> list:
+    return sorted(path.name for path in (home / 'bodies').rglob('*.body'))
+
+
+def test_packed_log_replay(tmp_path):
+    """Deleted and superseded bodies are removed, a reopened log comes back from its index or by replaying"""
+    pytest.importorskip('cryptography')
+    from knox.backend.store_packed import PackedLog
+
+    log = PackedLog(str(tmp_path), key=None)
+    log.put('com/example/www/www.example.com/PEM', {'serial': 1}, {'private': 'one'})
+    log.put('com/example/api/api.example.com/PEM', {'serial': 2}, {'private': 'two'})
+    log.put('com/example/www/www.example.com/PEM', {'serial': 3}, {'private': 'three'})
+    assert log.delete('com/example/api/api.example.com/PEM')
+    assert not log.delete('com/example/api/api.example.com/PEM')
+    assert len(packed_bodies(tmp_path)) == 1
+    log.close()
+    assert (tmp_path / 'cert_info.idx').exists()
+
+    for reopen in ('index', 'replay'):
+        if reopen == 'replay':
+            (tmp_path / 'cert_info.idx').unlink()
+        log = PackedLog(str(tmp_path), key=None)
+        assert log.keys() == ['com/example/www/www.example.com/PEM']
+        assert log.get('com/example/www/www.example.com/PEM') == ({'serial': 3}, {'private': 'three'})
+        assert log.get('com/example/api/api.example.com/PEM') is None
+        log.close()
+
+
+def test_packed_log_torn_tail(tmp_path):
+    """A record cut short by a crash is ignored by readers and truncated by the next writer"""
+    pytest.importorskip('cryptography')
+    from knox.backend.store_packed import PackedLog
+
+    log = PackedLog(str(tmp_path), key=None)
+    log.put('com/example/www/www.example.com/PEM', {'serial': 1}, {'private': 'one'})
+    log.close()
+    with open(tmp_path / 'cert_info.log', 'ab') as fp:
+        fp.write(PackedLog.header.pack(100, 0, PackedLog.PUT) + b'{"k":"com/exa')
+
+    log = PackedLog(str(tmp_path), key=None)
+    assert log.keys() == ['com/example/www/www.example.com/PEM']
+    log.put('com/example/api/api.example.com/PEM', {'serial': 2}, {'private': 'two'})
+    log.close()
+    (tmp_path / 'cert_info.idx').unlink()
+    log = PackedLog(str(tmp_path), key=None)
+    assert log.keys() == ['com/example/api/api.example.com/PEM', 'com/example/www/www.example.com/PEM']
+    assert log.get('com/example/api/api.example.com/PEM') == ({'serial': 2}, {'private': 'two'})
+    log.close()
+
+
+def test_packed_log_compact(tmp_path):
+    """Compaction keeps the live records, and a second reader picks up the new log"""
+    pytest.importorskip('cryptography')
+    from knox.backend.store_packed import PackedLog
+
+    log = PackedLog(str(tmp_path), key=None)
+    reader = PackedLog(str(tmp_path), key=None)
+    names = [f'com/example/host{number}/host{number}.example.com/PEM' for number in range(50)]
+    for turn in range(3):
+        for name in names:
+            log.put(name, {'round': turn}, {'private': f'{name}-{turn}'})
+    for name in names[25:]:
+        log.delete(name)
+    before = (tmp_path / 'cert_info.log').stat().st_size
+    assert log.compact()
+    assert (tmp_path / 'cert_info.log').stat().st_size < before / 3
+    assert len(packed_bodies(tmp_path)) == 25
+
+    assert reader.keys() == sorted(names[:25])
+    assert reader.get(names[0]) == ({'round': 2}, {'private': f'{names[0]}-2'})
+    assert dict(reader.scan('com/example/host1')) == {name: {'round': 2} for name in names[:25] if '/host1' in name}
+    reader.close()
+    log.close()
+    log = PackedLog(str(tmp_path), key=None)
+    assert log.keys() == sorted(names[:25])
+    log.close()
+
+
+@pytest.fixture
+def vault_http():
+    """Local HTTP server standing in for Vault, vault_http(answer) serves answer(method, path, body) -> (status, body)
+    and returns its URL"""
+    servers = []
+
+    def start(answer):
+        class Handler(BaseHTTPRequestHandler):
+            def handle_one(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                status, body = answer(self.command, self.path.split('?')[0], json.loads(self.rfile.read(length) or 'null'))
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                if status != 204:
+                    self.wfile.write(json.dumps(body).encode('utf-8'))
+
+            do_GET = do_POST = do_PUT = do_DELETE = handle_one
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f'http://127.0.0.1:{server.server_address[1]}'
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def async_store(url: str):
+    from knox.backend.store import Store
+
+    return Store(FakeSettings(VAULT_URL=url, VAULT_MOUNT='certificate', VAULT_APPROLE='role', VAULT_SECRET_ID='secret',
+                              VAULT_BACKOFF=0), 'vault-async')
+
+
+def test_vault_async_retries_and_close(vault_http):
+    """vault-async retries 5xx answers like the blocking engine, closing the store releases its loop thread"""
+    pytest.importorskip('aiohttp')
+    answers = {'/v1/auth/approle/login': [(200, {'auth': {'client_token': 'token'}})],
+               '/v1/sys/policy': [(503, {}), (502, {}), (200, {'policies': ['knox-read-www.example.com']})]}
+    requests = []
+
+    def answer(method, path, body):
+        requests.append(path)
+        return answers[path][0] if len(answers[path]) == 1 else answers[path].pop(0)
+
+    store = async_store(vault_http(answer))
+    assert store._wait(store.engine.has_policy('knox-read-www.example.com'))
+    assert requests.count('/v1/sys/policy') == 3
+    thread = store._thread
+    store.close()
+    store.close()
+    assert not thread.is_alive()
+    assert store.engine._AsyncVaultStoreEngine__session is None
+
+
+def test_vault_async_policy_created_without_read_access(vault_http):
+    """Under the shipped admin policy sys/policy/<name> can only be updated, vault-async still creates it"""
+    pytest.importorskip('aiohttp')
+    secrets, policies = {}, {}
+
+    def answer(method, path, body):
+        if path == '/v1/auth/approle/login':
+            return 200, {'auth': {'client_token': 'token'}}
+        if path == '/v1/sys/policy':
+            return 200, {'policies': sorted(policies)}
+        if path.startswith('/v1/sys/policy/'):
+            if method != 'PUT':
+                return 403, {'errors': ['permission denied']}
+            policies[path.split('/')[-1]] = body['policy']
+            return 204, None
+        if method == 'POST':
+            secrets[path.replace('/data/', '/', 1)] = body['data']
+            return 200, {}
+        key = path.replace('/data/', '/', 1)
+        return (200, {'data': {'data': secrets[key]}}) if key in secrets else (404, {'errors': []})
+
+    store = async_store(vault_http(answer))
+    try:
+        assert store.save(vault_object('www.example.com', ['www.example.com']))
+        assert store.save(vault_object('api.example.com', ['api.example.com']))
+    finally:
+        store.close()
+    assert sorted(policies) == ['knox-read-api.example.com', 'knox-read-www.example.com']
+
+
+def test_knox_close_stores():
+    """Knox closes the default and attached stores, a store failing to close does not keep the others open"""
+    pytest.importorskip('dynaconf')
+    from knox.knox import Knox
+
+    closed = []
+
+    class ClosingStore:
+        def __init__(self, alias, fail=False):
+            self.alias, self.fail = alias, fail
+
+        def close(self):
+            closed.append(self.alias)
+            if self.fail:
+                sys.exit(2)
+
+    knox = Knox.__new__(Knox)
+    knox._writers = []
+    knox._store = ClosingStore('default')
+    knox._stores = {'vault': ClosingStore('vault', fail=True), 'aws': ClosingStore('aws')}
+    knox.close()
+    assert closed == ['default', 'vault', 'aws']
+    assert knox._stores == {}
+
+
+@pytest.fixture
+def acm_engine(monkeypatch, tmp_path):
+    """ACMStoreEngine factory against moto, with a second profile acct2"""
+    pytest.importorskip('moto')
+    from moto import mock_aws
+
+    from knox.backend.store_acm import ACMStoreEngine
+
+    credentials = tmp_path / 'credentials'
+    credentials.write_text('[default]\naws_access_key_id=x\naws_secret_access_key=x\n'
+                           '[acct2]\naws_access_key_id=y\naws_secret_access_key=y\n')
+    monkeypatch.setenv('AWS_SHARED_CREDENTIALS_FILE', str(credentials))
+    for variable in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN', 'AWS_PROFILE'):
+        monkeypatch.delenv(variable, raising=False)
+    with mock_aws():
+        yield lambda targets: ACMStoreEngine(FakeSettings(AWS_PROFILE='default', AWS_REGION='us-east-1', AWS_TARGETS=targets))
+
+
+def acm_object(name: str):
+    """StoreObject holding a new self signed certificate for name, with the cert_info knox derives from it"""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    from knox.backend import StoreEngine
+    from knox.backend import StoreObject
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, name)])
+    certificate = (x509.CertificateBuilder().subject_name(subject).issuer_name(subject).public_key(key.public_key())
+                   .serial_number(x509.random_serial_number())
+                   .not_valid_before(datetime.utcnow()).not_valid_after(datetime.utcnow() + timedelta(days=30))
+                   .add_extension(x509.SubjectAlternativeName([x509.DNSName(name)]), False)
+                   .sign(key, hashes.SHA256()))
+    body = {'public': certificate.public_bytes(serialization.Encoding.PEM).decode(),
+            'private': key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                         serialization.NoEncryption()).decode(),
+            'chain': ''}
+    info = {'subject': {'commonName': name},
+            'key_details': {'serial_number': str(certificate.serial_number),
+                            'fingerprint_sha256': certificate.fingerprint(hashes.SHA256()).hex()}}
+    obj = StoreObject(name=name.replace('*', 'wildcard', 1), path=StoreEngine.to_store_path(name), body=body, info=info,
+                      type='PEM')
+    obj._data = {'cert_body': body, 'cert_info': info}
+    obj.public, obj.chain = body['public'], ''
+    return obj
+
+
+def test_acm_fanout(acm_engine):
+    """A write is imported to every account and region, find lists the certificate in each of them"""
+    engine = acm_engine('default:us-east-1,default:eu-west-1,acct2:ap-south-1')
+    assert engine.write(acm_object('www.example.com'))
+    assert [(result['profile'], result['region'], result['status']) for result in engine.results] == [
+        ('default', 'us-east-1', 'imported'), ('default', 'eu-west-1', 'imported'), ('acct2', 'ap-south-1', 'imported')]
+    assert sorted((result['profile'], result['region']) for result in engine.find('www.example.com')) == [
+        ('acct2', 'ap-south-1'), ('default', 'eu-west-1'), ('default', 'us-east-1')]
+    assert engine.read('/com/example/www', 'www.example.com').body['public'].startswith('-----BEGIN CERTIFICATE')
+
+
+def test_acm_fanout_partial_failure(acm_engine):
+    """A target failing does not stop the others, its error is kept in results and write reports the failure"""
+    from botocore.exceptions import ClientError
+
+    engine = acm_engine('us-east-1,eu-west-1')
+    broken = engine.targets[1]
+
+    def denied(**kwargs):
+        raise ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'denied'}}, 'ImportCertificate')
+
+    broken.acm.import_certificate = denied
+    assert not engine.write(acm_object('www.example.com'))
+    assert [(result['region'], result['status']) for result in engine.results] == [('us-east-1', 'imported'),
+                                                                                     ('eu-west-1', 'failed')]
+    assert engine.results[0]['arn'] and 'AccessDenied' in engine.results[1]['error']
+    assert [result['region'] for result in engine.find('www.example.com', live=True)] == ['us-east-1']
+
+
+def test_acm_index_pages(acm_engine):
+    """Summaries of every list_certificates page end up in the index, not only those of the first one"""
+    engine = acm_engine('us-east-1')
+    target = engine.targets[0]
+    names = [f'host{number}.example.com' for number in range(5)]
+    for name in names:
+        assert engine.write(acm_object(name))
+    listing = target.acm.list_certificates()['CertificateSummaryList']
+    assert len(listing) == len(names)
+
+    class OnePerPage:
+        def paginate(self, **kwargs):
+            return ({'CertificateSummaryList': [summary]} for summary in listing)
+
+    target.acm.get_paginator = lambda operation: OnePerPage()
+    index = target.index(refresh=True)
+    assert sorted(summary['DomainName'] for summary in index.summaries.values()) == names
+    assert [summary['DomainName'] for summary in index.covering('host4.example.com')] == ['host4.example.com']
+
+
+def test_acm_reimport(acm_engine):
+    """The same certificate is left unchanged, a renewed one or one that can not be compared is re-imported in place"""
+    engine = acm_engine('us-east-1,eu-west-1')
+    cert = acm_object('*.example.com')
+    for expected in ('imported', 'unchanged'):
+        assert engine.write(cert)
+        assert [result['status'] for result in engine.results] == [expected, expected]
+    arns = [result['arn'] for result in engine.results]
+
+    assert engine.write(acm_object('*.example.com'))
+    assert [result['status'] for result in engine.results] == ['reimported', 'reimported']
+    assert [result['arn'] for result in engine.results] == arns
+
+    cert = acm_object('*.example.com')
+    assert engine.write(cert)
+    cert.data['cert_info']['key_details']['serial_number'] = 'not a number'
+    assert engine.write(cert)
+    assert [result['status'] for result in engine.results] == ['reimported', 'reimported']
+    assert len(engine.find('*', live=True)) == 2
+
+
+def test_renew_skips_renewed_and_records_failures(monkeypatch, tmp_path):
+    """A certificate that can not be created is recorded as failed without stopping the others, and a later run does
+    not order again what the store index still lists with its previous expiry"""
+    pytest.importorskip('cryptography')
+    from knox.certificate import cert_renew
+
+    due = (datetime.now() + timedelta(days=5)).strftime('%Y-%m-%d %H:%M:%S')
+    renewed_until = f'{datetime.now().replace(microsecond=0) + timedelta(days=90)}'
+    ordered, saved = [], []
+
+    class StaleStore:
+        def expiring(self, days, live=False):
+            return [{'common_name': name, 'cert_expiry_date': due}
+                    for name in ('www.example.com', 'broken.example.com', 'api.example.com')]
+
+        def save(self, certificate, force=False):
+            saved.append(certificate.name)
+            return True
+
+    class FakeCert:
+        def __init__(self, settings, common_name=None):
+            if common_name == 'broken.example.com':
+                raise ValueError('no DNS engine for example.com')
+            self.name = common_name
+            self.data = {'cert_info': {'validity': {'not_valid_after': renewed_until}}}
+
+        def generate(self):
+            ordered.append(self.name)
+            return True
+
+    settings = FakeSettings(RENEW_RATE=3600000)
+    settings.as_dict = lambda: {}
+    monkeypatch.setattr(cert_renew, 'Cert', FakeCert)
+    renew = cert_renew.CertRenew(settings, StaleStore(), days=30, workers=3, state=str(tmp_path / 'state.json'))
+
+    results = {result['name']: result for result in renew.renew()}
+    assert {name: result['status'] for name, result in results.items()} == {
+        'www.example.com': 'renewed', 'broken.example.com': 'failed', 'api.example.com': 'renewed'}
+    assert 'no DNS engine' in results['broken.example.com']['error']
+    assert sorted(ordered) == sorted(saved) == ['api.example.com', 'www.example.com']
+
+    ordered.clear()
+    results = {result['name']: result for result in renew.renew()}
+    assert {name: result['status'] for name, result in results.items()} == {
+        'www.example.com': 'current', 'broken.example.com': 'failed', 'api.example.com': 'current'}
+    assert results['www.example.com']['not_valid_after'] == renewed_until
+    assert ordered == []
+    assert [result['status'] for result in renew.renew(resume=False) if result['name'] == 'www.example.com'] == ['renewed']
+
+
+def test_batch_generate_failure(monkeypatch):
+    """An item certbot could not issue is reported as invalid with the reason, the others are saved"""
+    pytest.importorskip('cryptography')
+    from knox.certificate import cert_batch
+
+    saved = []
+
+    class FakeCert:
+        def __init__(self, settings, common_name=None):
+            self.name = common_name
+
+        def generate(self):
+            return self.name != 'broken.example.com'
+
+        def isValid(self):
+            return True
+
+    class SavingStore:
+        def save(self, certificate, force=False):
+            saved.append(certificate.name)
+            return True
+
+    monkeypatch.setattr(cert_batch, 'Cert', FakeCert)
+    results = cert_batch.CertBatch(FakeSettings(), SavingStore()).save([{'name': 'www.example.com'}, {'name': 'broken.example.com'}])
+    assert results == [{'name': 'www.example.com', 'status': 'saved', 'error': None},
+                       {'name': 'broken.example.com', 'status': 'invalid',
+                        'error': 'certbot did not issue a certificate for broken.example.com, see log'}]
+    assert saved == ['www.example.com']
+
+
+@pytest.mark.parametrize('pattern, expected', [
+    ('www.example.com', ('/com/example/www/www.example.com/', None)),
+    ('*.example.com', ('/com/example/', '*.example.com')),
+    ('example.com/*', ('/com/example/', None)),
+    ('com/example/www', ('/com/example/www/', None)),
+    ('*', (None, None)),
+    ('', (None, None)),
+    ("Let's Encrypt", (None, None)),
+    ('8x8', (None, None)),
+])
+def test_search_path(pattern, expected):
+    """Domain patterns are pruned to their reverse DNS sub tree, free text scans everything"""
+    pytest.importorskip('validators')
+    from knox.backend import StoreEngine
+
+    assert StoreEngine.search_path(pattern) == expected
+
+
+def test_store_path_shared():
+    """Certificates are saved under the path find prunes to"""
+    pytest.importorskip('cryptography')
+    from knox.backend import StoreEngine
+    from knox.certificate import Cert
+
+    for name in ('www.example.com', 'example.com', '*.eu.example.com'):
+        assert Cert.to_store_path(name) == StoreEngine.to_store_path(name)
+    assert StoreEngine.to_store_path('www.example.com') == '/com/example/www'
+
+
+def test_knox_replicate_timeout():
+    """A store slower than its timeout is reported without holding up the others, close waits for its write"""
+    pytest.importorskip('dynaconf')
+    from knox.knox import Knox
+
+    events = []
+
+    class TimedStore:
+        def __init__(self, alias, seconds):
+            self.alias, self.seconds = alias, seconds
+
+        def save(self, obj, force=False):
+            time.sleep(self.seconds)
+            events.append(f'saved {self.alias}')
+            return True
+
+        def close(self):
+            events.append(f'closed {self.alias}')
+
+    knox = Knox.__new__(Knox)
+    knox._conf = types.SimpleNamespace(settings=FakeSettings(REPLICATE_TIMEOUT=5))
+    knox._writers = []
+    knox._store = TimedStore('default', 0)
+    knox._stores = {'aws': TimedStore('aws', 0.5)}
+    results = knox.replicate(types.SimpleNamespace(name='www.example.com'), timeout={'aws': 0.05})
+    assert results['default']['status'] == 'saved'
+    assert results['aws']['status'] == 'timeout' and results['aws']['error'] == 'no result after 0.05s'
+    assert events == ['saved default']
+
+    knox.close()
+    assert events == ['saved default', 'saved aws', 'closed default', 'closed aws']
+
+
+@pytest.mark.parametrize('count', [0, 1, 3])
+def test_find_output_streams(count):
+    """find writes each result as soon as it is found, JSON output matches json.dumps(results, indent=4)"""
+    pytest.importorskip('click')
+    from knox import cli
+
+    records = [{'common_name': f'www{number}.example.com', 'alternativeNames': [f'www{number}.example.com'],
+                'days_to_expire': number} for number in range(count)]
+    handle = io.StringIO()
+    written = []
+
+    def results():
+        for record in records:
+            yield record
+            written.append(handle.getvalue())
+
+    cli.write_json(handle, results())
+    assert handle.getvalue() == json.dumps(records, indent=4)
+    assert all(record['common_name'] in text for record, text in zip(records, written))
+
+    handle = io.StringIO()
+    cli.write_ndjson(handle, iter(records))
+    assert [json.loads(line) for line in handle.getvalue().splitlines()] == records
+
+
+def test_templates_compiled_once(monkeypatch, tmp_path):
+    """Templates are compiled once per process, KNOX_TEMPLATE_DIR overrides the shipped ones"""
+    pytest.importorskip('jinja2')
+    from knox.config import Templates
+
+    monkeypatch.setattr(Templates, '_environment', None)
+    monkeypatch.setattr(Templates, '_templates', {})
+    (tmp_path / 'templates').mkdir()
+    (tmp_path / 'templates' / 'tags_template.js').write_text("[{'Key': 'name', 'Value': '{{ cert.name }}'}]")
+    settings = FakeSettings(TEMPLATE_DIR=str(tmp_path / 'templates'), TEMPLATE_CACHE=str(tmp_path / 'cache'))
+
+    tags = Templates.get('tags_template.js', settings)
+    assert Templates.get('tags_template.js') is tags
+    assert tags.render(cert=types.SimpleNamespace(name='www.example.com')) == "[{'Key': 'name', 'Value': 'www.example.com'}]"
+    assert Templates.get('body_template.js').filename.startswith(Templates.package_dir)
+    assert len(list((tmp_path / 'cache').iterdir())) == 2
+
+
+def test_store_cache(tmp_path):
+    """Entries are served within the TTL, revalidated against the store versions after it, least recently used out"""
+    pytest.importorskip('cryptography')
+    from cryptography.fernet import Fernet
+
+    from knox.backend.store_cache import StoreCache
+
+    cache = StoreCache('vault/certificate', size=2, ttl=0.05)
+    cache.put('/a', (1, 1), {'private': 'a'}, {'name': 'a'})
+    cache.put('/b', (1, 1), {'private': 'b'}, {'name': 'b'})
+    assert cache.get('/a') == ((1, 1), {'private': 'a'}, {'name': 'a'})
+    cache.put('/c', (1, 1), {'private': 'c'}, {'name': 'c'})
+    assert cache.get('/b') is None
+    assert cache.stats == {'hits': 1, 'revalidated': 0, 'misses': 1, 'evictions': 1}
+
+    time.sleep(0.1)
+    assert cache.get('/a') is None
+    assert cache.get('/c', versions=lambda: (1, 1)) == ((1, 1), {'private': 'c'}, {'name': 'c'})
+    assert cache.get('/c') is not None
+    time.sleep(0.1)
+    assert cache.get('/c', versions=lambda: (1, 2)) is None
+    assert cache.get('/c', versions=lambda: (1, 1)) is None
+    assert cache.stats == {'hits': 2, 'revalidated': 1, 'misses': 4, 'evictions': 1}
+
+    key = Fernet.generate_key().decode()
+    StoreCache('vault/certificate', size=0, ttl=60, directory=str(tmp_path), key=key).put('/a', (2, 3), {'private': 'a'}, {})
+    assert StoreCache('vault/certificate', size=1, ttl=60, directory=str(tmp_path), key=key).get('/a') == ((2, 3), {'private': 'a'}, {})
+    assert StoreCache('vault/other', size=1, ttl=60, directory=str(tmp_path), key=key).get('/a') is None
+    assert all(stat.S_IMODE(os.stat(path).st_mode) == 0o600 for path in tmp_path.iterdir())
+    assert b'private' not in b''.join(path.read_bytes() for path in tmp_path.iterdir())